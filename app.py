@@ -1,19 +1,52 @@
 import streamlit as st
-import yfinance as yf
 import pandas as pd
 import numpy as np
 import time
-import twstock
 import os
+import sys
+import argparse
 import requests
-import feedparser
+import importlib
+import types
 import urllib3
 import shutil
-from collections import Counter
+import multiprocessing
+import threading
+import json
+import sqlite3
+import hashlib
+import calendar
+import functools
+from collections import Counter, deque
+from io import StringIO
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
-import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 重型模組延遲載入：Streamlit 每次互動都重跑整支程式，用到時才 import
+class _LazyModule(types.ModuleType):
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None: self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+yf = _LazyModule("yfinance")
+twstock = _LazyModule("twstock")
+feedparser = _LazyModule("feedparser")
+go = _LazyModule("plotly.graph_objects")
+px = _LazyModule("plotly.express")
+plotly_subplots = _LazyModule("plotly.subplots")
+pa = _LazyModule("pyarrow")
+pq = _LazyModule("pyarrow.parquet")
 
 # ==========================================
 # 0. 系統設定
@@ -25,8 +58,51 @@ except: pass
 # 忽略 SSL 警告 (解決爬蟲報錯)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-HISTORY_FILE = "screening_history.csv"
+HISTORY_FILE = "screening_history.csv"  # 舊版 CSV (啟動時自動匯入資料庫)
+HISTORY_DB = "screening_history.db"
+HISTORY_KEY = ['篩選日期', '代號', '策略']
+HISTORY_PAGE_DATES = 7
+# 籌碼 / 融資日資料庫 (日期 × 代號 矩陣，不放在 stock_cache 以免清快取時被刪)
+CHIP_ARCHIVE_DIR = "chip_archive"
+CHIP_FLUSH_EVERY = 20
+# 每日收盤行情資料庫 (熱力圖回放用)：個股精簡表 + 族群彙總
+MARKET_ARCHIVE_DIR = "market_archive"
+HEATMAP_TOP_N = 400
+# TWSE 查無資料的回應 (休市日)；限流 / 尚未公布不會是這個訊息
+TWSE_NO_DATA = "沒有符合條件"
+# 月營收資料庫 (代號 × 月份矩陣)：營收趨勢濾網與回測共用
+REVENUE_ARCHIVE_DIR = "revenue_archive"
+REVENUE_HISTORY_MONTHS = 24
+REVENUE_FIELDS = ('revenue', 'yoy', 'mom')
+# 類股成交 (BFIAMU) 日資料：存於收盤行情資料庫，資金流向 N 日趨勢用
+SECTOR_FLOW_WINDOWS = (5, 10, 20)
+# 新聞庫 (增量合併、去重，保留超過單次 RSS 的歷史)
+NEWS_STORE_FILE = "news_store.json"
+NEWS_FEED_TIMEOUT = 6
+NEWS_STORE_LIMIT = 2000
+NEWS_DISPLAY_LIMIT = 60
+RSS_SOURCES = {
+    "Yahoo個股": "https://tw.stock.yahoo.com/rss?category=tw-individual",
+    "Yahoo產業": "https://tw.stock.yahoo.com/rss?category=tw-industry",
+    "MoneyDJ個股": "https://www.moneydj.com/KMDJ/RssCenter.aspx?svc=NW&a=X0100000",
+    "MoneyDJ產業": "https://www.moneydj.com/KMDJ/RssCenter.aspx?svc=NW&a=X0200000"
+}
 CACHE_DIR = "stock_cache"
+# 欄式價格庫 (Parquet，依 ticker 分區，每次更新只追加一個小檔)
+PRICE_STORE_DIR = os.path.join(CACHE_DIR, "prices")
+PRICE_COLUMNS = {'Open': 'float32', 'High': 'float32', 'Low': 'float32', 'Close': 'float32', 'Volume': 'int64'}
+PRICE_COMPACT_PARTS = 8
+# 每日以 MI_INDEX 收盤行情補 K 棒 (只補最近 N 天內還有更新的股票，更舊的交給 yfinance)
+SNAPSHOT_UPDATE_MAX_DAYS = 14
+SNAPSHOT_UPDATE_MARKER = os.path.join(CACHE_DIR, "snapshot_update.json")
+# 證券主檔 (twstock.codes + 細產業)，存檔後 7 天內直接讀檔，不必載入 twstock
+SECURITY_MASTER_TTL = 7 * 86400
+# 指標滾動狀態 (與 OHLCV 同存)：第幾根 K 棒 + 各視窗滾動和
+INDICATOR_STATE_WINDOWS = {
+    '_sum_c5': ('Close', 5), '_sum_c20': ('Close', 20), '_sum_c60': ('Close', 60), '_sum_c200': ('Close', 200),
+    '_sum_v5': ('Volume', 5), '_sum_v60': ('Volume', 60), '_sum_g14': ('_gain', 14), '_sum_l14': ('_loss', 14)
+}
+INDICATOR_STATE_COLUMNS = ['_n'] + list(INDICATOR_STATE_WINDOWS)
 
 # 確保快取目錄存在
 if not os.path.exists(CACHE_DIR):
@@ -39,6 +115,57 @@ VALID_STRATEGIES = [
     "浴火重生 (假跌破)"
 ]
 
+# 基本面快取 (各欄位各自的有效期限，秒)
+FUNDAMENTALS_FILE = os.path.join(CACHE_DIR, "fundamentals.json")
+FUNDAMENTAL_TTL = {'eps': 30 * 86400, 'pe': 86400, 'roe': 30 * 86400}
+FUNDAMENTAL_WORKERS = 4
+
+# 全市場掃描下載併發數 (預設)
+DEFAULT_FETCH_WORKERS = 16
+# 命令列 / 排程掃描
+SCAN_CONFIG_FILE = "scan_config.json"
+SCHEDULER_STATE_FILE = "scheduler_state.json"
+SCHEDULER_POLL_SECONDS = 60
+# 時段到了但還查不到當日收盤行情：每 10 分鐘再查；18:00 後仍查無資料視為休市
+SCHEDULER_DATA_RETRY_MINUTES = 10
+SCHEDULER_HOLIDAY_HOUR = 18
+DEFAULT_SCAN_CONFIG = {
+    'strategies': list(VALID_STRATEGIES),
+    'vol_min': 1000, 'bias_range': 5.0, 'chip_threshold': 10.0,
+    'vol_surge': False, 'check_rsi_rising': False, 'check_trend_high': False, 'check_red_candle': False,
+    'exclude_negative_pe': True, 'exclude_margin_surge': False, 'min_revenue_yoy': -100, 'min_revenue_streak': 0,
+    'fetch_workers': DEFAULT_FETCH_WORKERS, 'line_token': "",
+    # 收盤後執行時段：15:00 後有 T86，21:00 後有融資
+    'schedule': ["15:00", "21:00"]
+}
+
+# TWSE / MOPS 端點 (可用環境變數指向本地替身伺服器做測試)
+TWSE_BASE_URL = os.environ.get("BW_TWSE_BASE_URL", "https://www.twse.com.tw").rstrip('/')
+MOPS_BASE_URL = os.environ.get("BW_MOPS_BASE_URL", "https://mops.twse.com.tw").rstrip('/')
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, "http")
+HTTP_MEMORY_TTL = 600
+# 同一主機兩次請求最短間隔 (秒)，避免被 TWSE 封鎖
+TWSE_MIN_INTERVAL = float(os.environ.get("BW_TWSE_MIN_INTERVAL", "0.6"))
+
+# 重跑效能：大盤溫度快取秒數、每次重跑的時間預算 (毫秒)
+MARKET_TEMP_TTL = 120
+RERUN_BUDGET_MS = 300
+RERUN_HISTORY = 20
+
+# 效能剖析：每階段保留的樣本數、延遲直方圖分桶 (毫秒)、列出最慢的股票數
+PROFILE_SAMPLES = 5000
+PROFILE_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+PROFILE_SLOW_TICKERS = 20
+
+# 盤中即時模式：每批報價檔數、預設更新間隔 (分鐘)、報價來源 (twstock / replay 替身)
+INTRADAY_BATCH_SIZE = 50
+INTRADAY_REFRESH_MINUTES = 3
+QUOTE_SOURCE = os.environ.get("BW_QUOTE_SOURCE", "twstock")
+
+# 即時結果刷新頻率：最多每 0.5 秒或每 200 檔刷新一次畫面
+LIVE_REFRESH_SECONDS = 0.5
+LIVE_REFRESH_EVERY = 200
+
 # 偽裝瀏覽器 Headers
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -61,72 +188,207 @@ def send_line_notify(token, message):
         requests.post(url, headers=headers, data=data, timeout=5, verify=False)
     except: pass
 
+# --- 效能剖析 (各階段延遲、逐檔耗時、快取命中；程序內共用) ---
+@st.cache_resource
+def get_profiler():
+    return {'lock': threading.Lock(), 'stages': {}, 'counters': Counter(), 'tickers': {}, 'started': time.time()}
+
+def record_timing(stage, seconds, ticker=None):
+    prof = get_profiler()
+    with prof['lock']:
+        prof['stages'].setdefault(stage, deque(maxlen=PROFILE_SAMPLES)).append(seconds)
+        if ticker:
+            per = prof['tickers'].setdefault(ticker, {})
+            per[stage] = per.get(stage, 0.0) + seconds
+
+def count_event(name, n=1):
+    prof = get_profiler()
+    with prof['lock']: prof['counters'][name] += n
+
+@contextmanager
+def profile_stage(stage, ticker=None):
+    t0 = time.perf_counter()
+    try: yield
+    finally: record_timing(stage, time.perf_counter() - t0, ticker)
+
+# 函式計時；ticker_arg 指定第幾個參數是股票代號 (逐檔統計用)
+def profiled(stage, ticker_arg=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ticker = None
+            if ticker_arg is not None: ticker = args[ticker_arg] if len(args) > ticker_arg else kwargs.get('ticker')
+            with profile_stage(stage, ticker): return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset_profiler():
+    prof = get_profiler()
+    with prof['lock']:
+        prof['stages'].clear(); prof['counters'].clear(); prof['tickers'].clear()
+        prof['started'] = time.time()
+
+def profiler_summary():
+    prof = get_profiler()
+    with prof['lock']:
+        stages = {k: np.array(v, dtype=float) * 1000 for k, v in prof['stages'].items()}
+        counters = dict(prof['counters'])
+        tickers = {k: dict(v) for k, v in prof['tickers'].items()}
+        started = prof['started']
+    edges = [0] + PROFILE_BUCKETS_MS + [np.inf]
+    labels = [f"<{b}ms" for b in PROFILE_BUCKETS_MS] + [f">={PROFILE_BUCKETS_MS[-1]}ms"]
+    stage_rows = {}
+    for name, ms in sorted(stages.items()):
+        hist, _ = np.histogram(ms, bins=edges)
+        stage_rows[name] = {
+            'count': int(len(ms)), 'total_ms': round(float(ms.sum()), 1), 'mean_ms': round(float(ms.mean()), 2),
+            'p50_ms': round(float(np.percentile(ms, 50)), 2), 'p90_ms': round(float(np.percentile(ms, 90)), 2),
+            'p99_ms': round(float(np.percentile(ms, 99)), 2), 'max_ms': round(float(ms.max()), 2),
+            'histogram': dict(zip(labels, map(int, hist)))
+        }
+    hits, stale, misses = counters.get('fetch.cache_hit', 0), counters.get('fetch.cache_stale', 0), counters.get('fetch.cache_miss', 0)
+    lookups = hits + stale + misses
+    slowest = sorted(tickers.items(), key=lambda kv: sum(kv[1].values()), reverse=True)[:PROFILE_SLOW_TICKERS]
+    return {
+        'since': datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S'),
+        'stages': stage_rows, 'counters': counters,
+        'cache_hit_rate': round(hits / lookups, 4) if lookups else None,
+        'slowest_tickers': [{'ticker': t, 'total_ms': round(sum(v.values()) * 1000, 1), **{k: round(x * 1000, 1) for k, x in v.items()}} for t, v in slowest]
+    }
+
+# --- 歷史紀錄 (SQLite：以 篩選日期/代號/策略 為主鍵 upsert) ---
+def _sql_value(v):
+    if isinstance(v, np.generic): v = v.item()
+    if isinstance(v, float) and np.isnan(v): return None
+    return v
+
+def _history_columns(conn):
+    return [r[1] for r in conn.execute('PRAGMA table_info(history)')]
+
+# 新欄位自動加入 (不需改 schema)
+def _ensure_history_columns(conn, columns):
+    existing = set(_history_columns(conn))
+    for col in columns:
+        if col not in existing: conn.execute(f'ALTER TABLE history ADD COLUMN "{col}"')
+
+def _upsert_history(conn, df):
+    df = df.copy()
+    df['代號'] = df['代號'].astype(str)
+    cols = list(df.columns)
+    _ensure_history_columns(conn, cols)
+    col_sql = ", ".join(f'"{c}"' for c in cols)
+    updates = ", ".join(f'"{c}"=excluded."{c}"' for c in cols if c not in HISTORY_KEY)
+    sql = f'INSERT INTO history ({col_sql}) VALUES ({", ".join("?" * len(cols))}) ON CONFLICT("篩選日期", "代號", "策略") DO '
+    sql += f'UPDATE SET {updates}' if updates else 'NOTHING'
+    conn.executemany(sql, [tuple(_sql_value(v) for v in row) for row in df.itertuples(index=False, name=None)])
+
+# 舊版 CSV 匯入一次後改名保留
+def _import_history_csv(conn):
+    if not os.path.exists(HISTORY_FILE): return
+    try:
+        df = pd.read_csv(HISTORY_FILE, dtype={'代號': str})
+        if all(k in df.columns for k in HISTORY_KEY):
+            _upsert_history(conn, df.drop_duplicates(subset=HISTORY_KEY, keep='last'))
+            conn.commit()
+        os.replace(HISTORY_FILE, f"{HISTORY_FILE}.imported")
+    except: pass
+
+@contextmanager
+def _history_conn():
+    conn = sqlite3.connect(HISTORY_DB, timeout=30)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS history ("篩選日期" TEXT NOT NULL, "代號" TEXT NOT NULL, "策略" TEXT NOT NULL, PRIMARY KEY ("篩選日期", "代號", "策略"))')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_date ON history ("篩選日期")')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_strategy ON history ("策略", "篩選日期")')
+        _import_history_csv(conn)
+        yield conn
+        conn.commit()
+    finally: conn.close()
+
+def _history_where(date=None, strategies=None, since=None):
+    strategies = [s for s in (strategies or VALID_STRATEGIES) if s in VALID_STRATEGIES]
+    clauses = [f'"策略" IN ({", ".join("?" * len(strategies))})']
+    params = list(strategies)
+    if date is not None: clauses.append('"篩選日期" = ?'); params.append(str(date))
+    if since is not None: clauses.append('"篩選日期" >= ?'); params.append(str(since))
+    return " AND ".join(clauses), params
+
 def clean_invalid_data():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            df = pd.read_csv(HISTORY_FILE)
-            if '策略' in df.columns:
-                df_clean = df[df['策略'].isin(VALID_STRATEGIES)]
-                if len(df_clean) < len(df):
-                    df_clean.to_csv(HISTORY_FILE, index=False, encoding='utf-8-sig')
-        except: pass
+    try:
+        with _history_conn() as conn:
+            conn.execute(f'DELETE FROM history WHERE "策略" NOT IN ({", ".join("?" * len(VALID_STRATEGIES))})', VALID_STRATEGIES)
+    except: pass
 
-def save_to_history(new_results):
-    if not new_results: return
+def save_to_history(new_results, replace_strategies=None):
+    if not new_results and not replace_strategies: return
     df_new = pd.DataFrame(new_results)
     current_date = get_taiwan_time().strftime("%Y-%m-%d")
     df_new.insert(0, "篩選日期", current_date)
     if "進場價" not in df_new.columns and "收盤" in df_new.columns:
         df_new["進場價"] = df_new["收盤"]
+    df_new = df_new[df_new['策略'].isin(VALID_STRATEGIES)] if not df_new.empty else df_new
     
-    if os.path.exists(HISTORY_FILE):
-        df_old = pd.read_csv(HISTORY_FILE)
-        for col in df_new.columns:
-             if col not in df_old.columns: df_old[col] = "N/A"
-        for col in df_old.columns:
-             if col not in df_new.columns: df_new[col] = "N/A"
-        df_combined = pd.concat([df_old, df_new], ignore_index=True)
-        df_combined = df_combined[df_combined['策略'].isin(VALID_STRATEGIES)]
-        df_combined.drop_duplicates(subset=['篩選日期', '代號', '策略'], keep='last', inplace=True)
-    else:
-        df_combined = df_new
-    
-    df_combined.to_csv(HISTORY_FILE, index=False, encoding='utf-8-sig')
-    st.toast(f"✅ 紀錄已儲存")
-
-def load_history():
-    if os.path.exists(HISTORY_FILE): 
-        df = pd.read_csv(HISTORY_FILE)
-        if '產業' not in df.columns: df['產業'] = '其他'
-        if '營收年增(%)' not in df.columns: df['營收年增(%)'] = "N/A"
-        return df[df['策略'].isin(VALID_STRATEGIES)]
-    return None
+    with _history_conn() as conn:
+        # 排程重跑：先清掉當日同策略結果，避免留下已不符合的舊紀錄
+        if replace_strategies:
+            conn.execute(f'DELETE FROM history WHERE "篩選日期" = ? AND "策略" IN ({", ".join("?" * len(replace_strategies))})',
+                         [current_date] + list(replace_strategies))
+        if not df_new.empty: _upsert_history(conn, df_new)
+    if _running_in_streamlit(): st.toast(f"✅ 紀錄已儲存")
+
+# 由資料庫過濾 (日期 / 策略 / 起始日)，不必整表載入
+def load_history(date=None, strategies=None, since=None):
+    try:
+        with _history_conn() as conn:
+            where, params = _history_where(date, strategies, since)
+            df = pd.read_sql_query(f'SELECT * FROM history WHERE {where} ORDER BY "篩選日期" DESC', conn, params=params)
+    except: return None
+    if df.empty: return None
+    if '產業' not in df.columns: df['產業'] = '其他'
+    if '營收年增(%)' not in df.columns: df['營收年增(%)'] = "N/A"
+    return df
+
+# 分頁用：篩選日期清單 (新到舊)
+def get_history_dates(strategies=None, limit=None, offset=0):
+    try:
+        with _history_conn() as conn:
+            where, params = _history_where(strategies=strategies)
+            sql = f'SELECT DISTINCT "篩選日期" FROM history WHERE {where} ORDER BY "篩選日期" DESC'
+            if limit is not None: sql += f' LIMIT {int(limit)} OFFSET {int(offset)}'
+            return [r[0] for r in conn.execute(sql, params)]
+    except: return []
+
+def count_history_dates(strategies=None):
+    try:
+        with _history_conn() as conn:
+            where, params = _history_where(strategies=strategies)
+            return conn.execute(f'SELECT COUNT(DISTINCT "篩選日期") FROM history WHERE {where}', params).fetchone()[0]
+    except: return 0
 
 def clear_history():
+    with _history_conn() as conn: conn.execute('DELETE FROM history')
     if os.path.exists(HISTORY_FILE): os.remove(HISTORY_FILE)
 
-clean_invalid_data()
+# 每個程序只清一次，不在每次重跑時掃資料庫
+@st.cache_resource
+def _history_startup():
+    clean_invalid_data()
+    return True
+
+_history_startup()
 
 # ==========================================
 # 2. 數據獲取 (僅限上市 TWSE)
 # ==========================================
 
-@st.cache_data(ttl=86400)
+# ★★★ 修正：只抓取「上市」股票 ★★★
 def get_tw_stock_list():
-    try:
-        codes = twstock.codes
-        tw_list = []
-        for code in codes:
-            # ★★★ 修正：只抓取「上市」股票 ★★★
-            if codes[code].type == "股票" and codes[code].market == "上市":
-                tw_list.append(f"{code}.TW")
-        return tw_list
-    except: return []
+    master = get_security_master()
+    listed = (master['type'] == "股票") & (master['market'] == "上市")
+    return [f"{code}.TW" for code in master['code'][listed]]
 
-@st.cache_data(ttl=86400)
 def get_stock_name(code):
-    try: return twstock.codes[code].name
-    except: return code
+    return get_security_master()['name_of'].get(code, code)
 
 SUB_SECTOR_MAP = {
     '2408': '記憶體', '2344': '記憶體', '2337': '記憶體', '3260': '記憶體', '8299': '記憶體',
@@ -144,9 +406,46 @@ SUB_SECTOR_MAP = {
 }
 
 def get_stock_sector(code):
-    if code in SUB_SECTOR_MAP: return SUB_SECTOR_MAP[code]
-    try: return twstock.codes[code].group
-    except: return "其他"
+    return get_security_master()['sector_of'].get(code, "其他")
+
+# --- 證券主檔：代號 / 名稱 / 市場 / 類別 / 產業 / 細產業 (SUB_SECTOR_MAP 優先) ---
+def _security_master_path():
+    version = hashlib.md5(json.dumps(SUB_SECTOR_MAP, sort_keys=True).encode()).hexdigest()[:8]
+    return os.path.join(CACHE_DIR, f"security_master_{version}.parquet")
+
+def build_security_master():
+    try: rows = [(code, info.name, info.market, info.type, info.group) for code, info in twstock.codes.items()]
+    except: rows = []
+    df = pd.DataFrame(rows, columns=['code', 'name', 'market', 'type', 'group'])
+    df['sector'] = df['code'].map(SUB_SECTOR_MAP).fillna(df['group'])
+    return df
+
+# 每個程序建一次；欄位以陣列提供 (向量化篩選 / 合併用)，單檔查詢用 dict
+@st.cache_resource
+def get_security_master():
+    path = _security_master_path()
+    df = None
+    try:
+        if time.time() - os.path.getmtime(path) < SECURITY_MASTER_TTL: df = pd.read_parquet(path)
+    except: pass
+    if df is None or df.empty:
+        df = build_security_master()
+        if not df.empty:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            df.to_parquet(path, index=False)
+    frame = df.set_index('code', drop=False)
+    master = {col: df[col].to_numpy() for col in df.columns}
+    master.update({'frame': frame, 'name_of': dict(zip(df['code'], df['name'])), 'sector_of': dict(zip(df['code'], df['sector']))})
+    return master
+
+# 依代號欄一次合併名稱 / 產業 (取代逐列查詢)
+def attach_security_info(df, code_col='代號', columns=None):
+    columns = columns or {'name': '名稱', 'sector': '產業'}
+    info = get_security_master()['frame'][list(columns)].rename(columns=columns)
+    out = df.drop(columns=[c for c in columns.values() if c in df.columns]).merge(info, left_on=code_col, right_index=True, how='left')
+    if '名稱' in columns.values(): out['名稱'] = out['名稱'].fillna(out[code_col])
+    if '產業' in columns.values(): out['產業'] = out['產業'].fillna("其他")
+    return out
 
 def get_last_trading_day(date_obj):
     offset = 1
@@ -155,7 +454,7 @@ def get_last_trading_day(date_obj):
         if prev.weekday() < 5: return prev
         offset += 1
 
-def get_market_temperature():
+def _fetch_market_temperature():
     try:
         tickers = ['^TWII', '^VIX']
         data = yf.download(tickers, period='5d', progress=False)['Close']
@@ -174,6 +473,30 @@ def get_market_temperature():
     except: return None
     return None
 
+@st.cache_resource
+def get_market_temperature_store():
+    return {'data': None, 'ts': 0.0, 'lock': threading.Lock(), 'refreshing': False}
+
+def _refresh_market_temperature(store):
+    try:
+        data = _fetch_market_temperature()
+        if data: store['data'] = data
+        store['ts'] = time.time()
+    finally: store['refreshing'] = False
+
+# 先回傳快取，過期才在背景更新，重跑不必等 yfinance
+def get_market_temperature(max_age=MARKET_TEMP_TTL):
+    store = get_market_temperature_store()
+    with store['lock']:
+        stale = time.time() - store['ts'] > max_age
+        if stale and not store['refreshing']:
+            store['refreshing'] = True
+            worker = threading.Thread(target=_refresh_market_temperature, args=(store,), daemon=True)
+            worker.start()
+            # 冷啟動最多等 3 秒，之後一律用舊值
+            if store['data'] is None: worker.join(timeout=3)
+    return store['data']
+
 def calculate_rsi(data, window=14):
     delta = data['Close'].diff()
     gain = (delta.where(delta > 0, 0)).rolling(window=window).mean()
@@ -181,49 +504,237 @@ def calculate_rsi(data, window=14):
     rs = gain / loss
     return 100 - (100 / (1 + rs))
 
+# ------------------------------------------
+# 價格庫：stock_cache/prices/ticker=XXXX.TW/part-*.parquet
+# ------------------------------------------
+def _price_partition(ticker):
+    return os.path.join(PRICE_STORE_DIR, f"ticker={ticker}")
+
+def _normalize_price_frame(df):
+    idx = pd.DatetimeIndex(df.index)
+    if idx.tz is not None: idx = idx.tz_localize(None)
+    out = pd.DataFrame(index=idx.normalize().rename('Date'))
+    for col, dtype in PRICE_COLUMNS.items():
+        vals = pd.to_numeric(df[col], errors='coerce').to_numpy()
+        if dtype == 'int64': vals = np.nan_to_num(vals, nan=0.0)
+        out[col] = vals.astype(dtype)
+    for col in INDICATOR_STATE_COLUMNS:
+        if col in df.columns: out[col] = df[col].to_numpy(dtype='float64')
+    return out[~out.index.duplicated(keep='last')].sort_index()
+
+def _price_frame_for_use(df):
+    # 庫內 float32 → 運算用 float64 (首次下載與讀快取的數值一致)
+    df = df.copy()
+    for col, dtype in PRICE_COLUMNS.items():
+        if dtype == 'float32': df[col] = df[col].astype('float64')
+    return df
+
+def write_price_bars(ticker, df):
+    if df is None or df.empty: return
+    part_dir = _price_partition(ticker)
+    os.makedirs(part_dir, exist_ok=True)
+    frame = _normalize_price_frame(df).reset_index()
+    frame.to_parquet(os.path.join(part_dir, f"part-{time.time_ns():020d}.parquet"), index=False)
+    if len(os.listdir(part_dir)) > PRICE_COMPACT_PARTS: compact_price_parts(ticker)
+
+def read_price_bars(ticker):
+    part_dir = _price_partition(ticker)
+    if not os.path.isdir(part_dir): return None
+    files = sorted(f for f in os.listdir(part_dir) if f.endswith('.parquet'))
+    if not files: return None
+    df = pd.concat([pd.read_parquet(os.path.join(part_dir, f)) for f in files], ignore_index=True)
+    df = df.drop_duplicates('Date', keep='last').set_index('Date').sort_index()
+    return _price_frame_for_use(df[[c for c in list(PRICE_COLUMNS) + INDICATOR_STATE_COLUMNS if c in df.columns]])
+
+# 整檔改寫為單一分片 (合併 / 補寫指標狀態)
+def rewrite_price_bars(ticker, df):
+    part_dir = _price_partition(ticker)
+    os.makedirs(part_dir, exist_ok=True)
+    old_files = sorted(f for f in os.listdir(part_dir) if f.endswith('.parquet'))
+    _normalize_price_frame(df).reset_index().to_parquet(os.path.join(part_dir, f"part-{time.time_ns():020d}.parquet"), index=False)
+    for f in old_files: os.remove(os.path.join(part_dir, f))
+
+def compact_price_parts(ticker):
+    df = read_price_bars(ticker)
+    if df is not None: rewrite_price_bars(ticker, df)
+
+# 價格庫完整欄位：舊分片 (CSV 匯入 / 尚未補寫狀態) 缺的指標狀態欄讀成 NaN，不致整欄被丟掉
+def _price_store_schema():
+    fields = [('Date', pa.timestamp('ns'))] + [(c, pa.from_numpy_dtype(np.dtype(t))) for c, t in PRICE_COLUMNS.items()]
+    fields += [(c, pa.float64()) for c in INDICATOR_STATE_COLUMNS] + [('ticker', pa.string())]
+    return pa.schema(fields)
+
+# 全市場面板一次讀取 (長表：ticker / Date / OHLCV)
+def load_market_panel(tickers=None):
+    if not os.path.isdir(PRICE_STORE_DIR): return None
+    filters = [('ticker', 'in', list(tickers))] if tickers is not None else None
+    try: df = pd.read_parquet(PRICE_STORE_DIR, filters=filters, schema=_price_store_schema())
+    except: return None
+    if df.empty: return None
+    df['ticker'] = df['ticker'].astype(str)
+    df = df.drop_duplicates(['ticker', 'Date'], keep='last').sort_values(['ticker', 'Date'], kind='stable')
+    return df.reset_index(drop=True)
+
+# 舊版 CSV 快取匯入 (單檔)
+def import_csv_cache(ticker):
+    csv_path = os.path.join(CACHE_DIR, f"{ticker}.csv")
+    if not os.path.exists(csv_path): return None
+    try:
+        df = pd.read_csv(csv_path, index_col=0, parse_dates=True)
+        if df.empty: return None
+        # 匯入時一併寫入指標狀態 (與首次下載相同)
+        write_price_bars(ticker, compute_indicator_state(_price_frame_for_use(_normalize_price_frame(df))))
+        os.remove(csv_path)
+        return read_price_bars(ticker)
+    except: return None
+
+# 舊版 CSV 快取匯入 (全部)
+def migrate_csv_cache():
+    migrated = 0
+    for fname in os.listdir(CACHE_DIR):
+        if fname.endswith('.csv') and import_csv_cache(fname[:-4]) is not None: migrated += 1
+    return migrated
+
+# ------------------------------------------
+# 增量指標：快取內存滾動和，新增一根 K 棒只需 O(1) 更新
+# ------------------------------------------
+def _gain_loss(close):
+    delta = np.diff(close, prepend=np.nan)
+    return np.where(delta > 0, delta, 0.0), np.where(delta < 0, -delta, 0.0)
+
+def has_indicator_state(df):
+    return all(c in df.columns for c in INDICATOR_STATE_COLUMNS) and not df[INDICATOR_STATE_COLUMNS].isna().any().any()
+
+# 完整計算滾動狀態 (首次下載 / 舊快取補寫)
+def compute_indicator_state(df):
+    df = df.copy()
+    close = df['Close'].to_numpy(dtype='float64')
+    gain, loss = _gain_loss(close)
+    src = {'Close': close, 'Volume': df['Volume'].to_numpy(dtype='float64'), '_gain': gain, '_loss': loss}
+    df['_n'] = np.arange(1, len(df) + 1, dtype='float64')
+    for col, (field, window) in INDICATOR_STATE_WINDOWS.items():
+        csum = np.cumsum(src[field])
+        df[col] = csum - np.concatenate([np.zeros(window), csum[:-window]])[:len(csum)]
+    return df
+
+# 追加新 K 棒：每根只加入新值、扣掉離開視窗的舊值
+def extend_indicator_state(df_old, df_new):
+    df_new = df_new.copy()
+    state = {c: float(df_old[c].iloc[-1]) for c in INDICATOR_STATE_COLUMNS}
+    closes = df_old['Close'].to_numpy(dtype='float64')[-200:].tolist()
+    vols = df_old['Volume'].to_numpy(dtype='float64')[-60:].tolist()
+    gain, loss = _gain_loss(df_old['Close'].to_numpy(dtype='float64')[-15:])
+    tails = {'Close': closes, 'Volume': vols, '_gain': gain[-14:].tolist(), '_loss': loss[-14:].tolist()}
+    rows = []
+    for c, v in zip(df_new['Close'].to_numpy(dtype='float64'), df_new['Volume'].to_numpy(dtype='float64')):
+        delta = c - tails['Close'][-1]
+        new_vals = {'Close': c, 'Volume': v, '_gain': max(delta, 0.0), '_loss': max(-delta, 0.0)}
+        pos = int(state['_n'])
+        for col, (field, window) in INDICATOR_STATE_WINDOWS.items():
+            tail = tails[field]
+            leaving = tail[-window] if pos >= window else 0.0
+            state[col] += new_vals[field] - leaving
+        for field, val in new_vals.items(): tails[field].append(val)
+        state['_n'] += 1
+        rows.append(dict(state))
+    for col in INDICATOR_STATE_COLUMNS: df_new[col] = [r[col] for r in rows]
+    return df_new
+
+# 由滾動狀態換算指標 (結果同 rolling 完整重算)
+def indicators_from_state(df):
+    n = df['_n'].to_numpy()
+    for name, col, window in [('MA5', '_sum_c5', 5), ('MA20', '_sum_c20', 20), ('MA60', '_sum_c60', 60), ('MA200', '_sum_c200', 200),
+                              ('Volume_MA5', '_sum_v5', 5), ('Volume_MA60', '_sum_v60', 60)]:
+        df[name] = np.where(n >= window, df[col].to_numpy() / window, np.nan)
+    # 累加誤差的極小值歸零，避免平盤時 0/0 變成亂數
+    gain = df['_sum_g14'].to_numpy(); gain = np.where(np.abs(gain) < 1e-9, 0.0, gain)
+    loss = df['_sum_l14'].to_numpy(); loss = np.where(np.abs(loss) < 1e-9, 0.0, loss)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['RSI'] = np.where(n >= 14, 100 - (100 / (1 + gain / loss)), np.nan)
+    return df
+
+# 驗證模式：增量結果 vs 完整重算
+def verify_indicator_state(df, rtol=1e-6):
+    if df is None or not has_indicator_state(df): return False, {}
+    fast = indicators_from_state(df.copy())
+    full = add_technical_indicators(df[list(PRICE_COLUMNS)].copy(), full_recompute=True)
+    diffs = {}
+    for col in ['MA5', 'MA20', 'MA60', 'MA200', 'Volume_MA5', 'Volume_MA60', 'RSI']:
+        a, b = fast[col].to_numpy(), full[col].to_numpy()
+        if not np.allclose(a, b, rtol=rtol, atol=1e-6, equal_nan=True): diffs[col] = float(np.nanmax(np.abs(a - b)))
+    return not diffs, diffs
+
 # 抓取原始數據 (智慧快取 - 只針對 .TW)
 def fetch_raw_data(ticker, period="2y"):
     ticker = ticker.strip().upper()
     if not ticker.endswith(".TW"): ticker = f"{ticker}.TW"
     
-    cache_path = os.path.join(CACHE_DIR, f"{ticker}.csv")
     today = get_taiwan_time().date()
+    stale = False  # 每次查詢只計一種結果 (補資料失敗後改走完整下載仍算補資料)
     
     try:
-        # 1. 嘗試讀取本地快取
-        if os.path.exists(cache_path):
-            try:
-                df_old = pd.read_csv(cache_path, index_col=0, parse_dates=True)
-                if not df_old.empty:
-                    last_date = df_old.index[-1].date()
-                    if last_date >= today - timedelta(days=1):
-                         return df_old
-
-                    if last_date < today:
-                        start_date = last_date + timedelta(days=1)
-                        if start_date <= today:
-                            df_new = yf.Ticker(ticker).history(start=start_date)
-                            if not df_new.empty:
-                                df_new.index = df_new.index.tz_localize(None)
-                                df_final = pd.concat([df_old, df_new])
-                                df_final = df_final[~df_final.index.duplicated(keep='last')]
-                                df_final.to_csv(cache_path)
-                                return df_final
-                            else: return df_old
-            except: pass
+        # 1. 嘗試讀取本地快取 (舊 CSV 自動匯入)
+        try:
+            with profile_stage('fetch.cache_read', ticker):
+                df_old = read_price_bars(ticker)
+                if df_old is None: df_old = import_csv_cache(ticker)
+            if df_old is not None and not df_old.empty:
+                if not has_indicator_state(df_old):
+                    df_state = compute_indicator_state(df_old)
+                    if has_indicator_state(df_state):
+                        df_old = df_state
+                        rewrite_price_bars(ticker, df_old)
+                last_date = df_old.index[-1].date()
+                # 已有最近一個交易日 (週一 / 假日不必再抓上週五)
+                if last_date >= min(today - timedelta(days=1), get_last_trading_day(today)):
+                    count_event('fetch.cache_hit')
+                    return df_old
+
+                count_event('fetch.cache_stale')
+                stale = True
+                start_date = last_date + timedelta(days=1)
+                with profile_stage('fetch.network', ticker):
+                    df_new = yf.Ticker(ticker).history(start=start_date)
+                df_new = _price_frame_for_use(_normalize_price_frame(df_new)) if not df_new.empty else df_new
+                if not df_new.empty: df_new = df_new[df_new.index > df_old.index[-1]]
+                if not df_new.empty:
+                    # 只追加新 K 棒 (含指標狀態)，不重寫整檔
+                    if has_indicator_state(df_old): df_new = extend_indicator_state(df_old, df_new)
+                    write_price_bars(ticker, df_new)
+                    df_final = pd.concat([df_old, df_new])
+                    return df_final[~df_final.index.duplicated(keep='last')]
+                else: return df_old
+        except: pass
 
         # 2. 無快取，下載新資料
-        data = yf.Ticker(ticker).history(period=period)
+        if not stale: count_event('fetch.cache_miss')
+        with profile_stage('fetch.network', ticker):
+            data = yf.Ticker(ticker).history(period=period)
         if len(data) > 20: 
-            if data.index.tz is not None:
-                data.index = data.index.tz_localize(None)
-            data.to_csv(cache_path)
+            data = compute_indicator_state(_price_frame_for_use(_normalize_price_frame(data)))
+            write_price_bars(ticker, data)
             return data
     except: pass
+    count_event('fetch.error')
     return None
 
-def add_technical_indicators(data_df):
+# 併發批次下載 (有界執行緒池，下載完成即回傳，不必等全部結束)
+def fetch_raw_data_bulk(tickers, period="2y", max_workers=DEFAULT_FETCH_WORKERS):
+    pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
     try:
+        futures = {pool.submit(fetch_raw_data, t, period): t for t in tickers}
+        for fut in as_completed(futures):
+            try: df = fut.result()
+            except: df = None
+            yield futures[fut], df
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@profiled('indicators')
+def add_technical_indicators(data_df, full_recompute=False):
+    try:
+        # 快取已帶滾動狀態 → 直接換算，不必整段 rolling
+        if not full_recompute and has_indicator_state(data_df): return indicators_from_state(data_df)
         data_df['MA5'] = data_df['Close'].rolling(window=5).mean()
         data_df['MA20'] = data_df['Close'].rolling(window=20).mean()
         data_df['MA60'] = data_df['Close'].rolling(window=60).mean()
@@ -240,67 +751,372 @@ def fetch_stock_data(ticker, period="5y"):
         return add_technical_indicators(df)
     return None
 
-# 基本面 (yfinance info)
-def get_stock_fundamentals_safe(ticker):
+# 基本面 (yfinance info) - 本地快取 + 背景批次預抓
+@st.cache_resource
+def get_fundamentals_store():
+    data = {}
+    if os.path.exists(FUNDAMENTALS_FILE):
+        try:
+            with open(FUNDAMENTALS_FILE, encoding='utf-8') as f: data = json.load(f)
+        except: data = {}
+    return {'data': data, 'lock': threading.Lock(), 'save_lock': threading.Lock(), 'progress': None}
+
+# 背景預抓與畫面可能同時存檔：整段序列化 + 寫檔鎖住，暫存檔不互相覆寫，較新的內容也不會被舊的蓋掉
+def _save_fundamentals(store):
+    with store['save_lock']:
+        with store['lock']:
+            payload = json.dumps(store['data'], ensure_ascii=False)
+        tmp_path = f"{FUNDAMENTALS_FILE}.tmp"
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f: f.write(payload)
+        os.replace(tmp_path, FUNDAMENTALS_FILE)
+
+def _normalize_fund_ticker(ticker):
+    ticker = str(ticker).strip().upper()
+    return ticker if '.' in ticker else f"{ticker}.TW"
+
+# 記憶體中的值 (含是否全部在有效期內)
+def _read_fundamentals(store, ticker):
+    now = time.time()
+    with store['lock']: entry = store['data'].get(ticker)
+    if not entry: return None, False
+    values = tuple(entry.get(k, [None, 0])[0] for k in ['eps', 'pe', 'roe'])
+    fresh = all(now - entry.get(k, [None, 0])[1] < ttl for k, ttl in FUNDAMENTAL_TTL.items())
+    return values, fresh
+
+# 有回應就每個欄位都記下時間 (None 也記，免得沒有該欄位的股票每次都重抓)；限流 / 空回應不動舊值，下次再抓
+def _fetch_fundamentals_remote(store, ticker):
+    info = yf.Ticker(ticker).info or {}
+    now = time.time()
+    with store['lock']:
+        entry = dict(store['data'].get(ticker) or {})
+        if info:
+            entry.update({'eps': [info.get('trailingEps'), now], 'pe': [info.get('trailingPE'), now], 'roe': [info.get('returnOnEquity'), now]})
+            store['data'][ticker] = entry
+    return tuple(entry.get(k, [None, 0])[0] for k in ['eps', 'pe', 'roe'])
+
+@profiled('fundamentals', ticker_arg=0)
+def get_stock_fundamentals_safe(ticker, allow_network=True):
     try:
-        stock = yf.Ticker(ticker)
+        store = get_fundamentals_store()
+        ticker = _normalize_fund_ticker(ticker)
+        cached, fresh = _read_fundamentals(store, ticker)
+        if fresh or not allow_network:
+            return cached if cached else (None, None, None)
         try:
-            info = stock.info
-            eps = info.get('trailingEps', None)
-            pe = info.get('trailingPE', None)
-            roe = info.get('returnOnEquity', None)
-            return eps, pe, roe
-        except: return None, None, None
+            values = _fetch_fundamentals_remote(store, ticker)
+            _save_fundamentals(store)
+            return values
+        except: return cached if cached else (None, None, None)
     except: return None, None, None
 
+# 批次預抓 (有界執行緒池，只抓過期或沒有的)
+def prefetch_fundamentals(tickers, max_workers=FUNDAMENTAL_WORKERS, store=None):
+    store = store or get_fundamentals_store()
+    todo = [t for t in map(_normalize_fund_ticker, tickers) if not _read_fundamentals(store, t)[1]]
+    store['progress'] = [0, len(todo)]
+    if todo:
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+            futures = [pool.submit(_fetch_fundamentals_remote, store, t) for t in todo]
+            for done, fut in enumerate(as_completed(futures), start=1):
+                try: fut.result()
+                except: pass
+                store['progress'] = [done, len(todo)]
+                if done % 50 == 0: _save_fundamentals(store)
+        _save_fundamentals(store)
+    return len(todo)
+
+# 背景執行全市場預抓，不阻塞畫面
+def start_fundamentals_prefetch(tickers, max_workers=FUNDAMENTAL_WORKERS):
+    store = get_fundamentals_store()
+    if store['progress'] is not None and store['progress'][0] < store['progress'][1]: return False
+    store['progress'] = [0, len(tickers)]
+    threading.Thread(target=prefetch_fundamentals, args=(list(tickers), max_workers, store), daemon=True).start()
+    return True
+
+# --- 共用 HTTP 連線 (連線池 / 限速 / 重試 / 回應快取) ---
+@st.cache_resource
+def get_http_client():
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    retry = Retry(total=3, backoff_factor=0.8, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    intervals = {urlparse(TWSE_BASE_URL).netloc: TWSE_MIN_INTERVAL, urlparse(MOPS_BASE_URL).netloc: TWSE_MIN_INTERVAL}
+    return {'session': session, 'lock': threading.Lock(), 'intervals': intervals, 'next_slot': {}, 'memory': {}}
+
+# 依主機排隊取得發送時段 (多執行緒共用)
+def _throttle(client, host):
+    interval = client['intervals'].get(host, 0.0)
+    if interval <= 0: return
+    with client['lock']:
+        now = time.monotonic()
+        slot = max(now, client['next_slot'].get(host, 0.0))
+        client['next_slot'][host] = slot + interval
+    if slot > now: time.sleep(slot - now)
+
+def http_get(url, params=None, timeout=10, headers=None):
+    client = get_http_client()
+    parsed = urlparse(url)
+    _throttle(client, parsed.netloc)
+    # 端點延遲 (不含排隊等待)
+    with profile_stage(f"http {parsed.path}"):
+        res = client['session'].get(url, params=params, headers=headers, timeout=timeout, verify=False)
+    count_event(f"http.status.{res.status_code}")
+    return res
+
+# 交易日已收盤 (早於今天) 的資料不會再變，可永久快取
+def is_closed_trade_date(date_str):
+    try: return datetime.strptime(str(date_str), '%Y%m%d').date() < get_taiwan_time().date()
+    except: return False
+
+def _http_cache_path(endpoint, date_str, params):
+    digest = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+    return os.path.join(HTTP_CACHE_DIR, endpoint, f"{date_str}_{digest}.json")
+
+def _remember(client, key, data):
+    with client['lock']: client['memory'][key] = (time.time(), data)
+
+def _recall(client, key):
+    with client['lock']: hit = client['memory'].get(key)
+    return hit[1] if hit and time.time() - hit[0] < HTTP_MEMORY_TTL else None
+
+# TWSE JSON：記憶體 (短效) → 磁碟 (已收盤日) → 網路；未帶日期的「最新」回應也以其日期存檔
+# 回補資料庫時 cacheable=False：資料已另存精簡格式，不必再留原始 JSON
+def fetch_twse_json(path, params, timeout=10, cacheable=True):
+    client = get_http_client()
+    endpoint = path.rstrip('/').split('/')[-1]
+    mem_key = (endpoint, json.dumps(params, sort_keys=True))
+    data = _recall(client, mem_key)
+    if data is not None:
+        count_event('http.memory_hit')
+        return data
+    date_str = params.get('date')
+    cache_path = _http_cache_path(endpoint, date_str, params) if date_str else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding='utf-8') as f: data = json.load(f)
+            _remember(client, mem_key, data)
+            count_event('http.disk_hit')
+            return data
+        except: pass
+    res = http_get(f"{TWSE_BASE_URL}{path}", params=params, timeout=timeout)
+    data = res.json()
+    if data.get('stat') == 'OK':
+        _remember(client, mem_key, data)
+        dated = params if date_str else {**params, 'date': data.get('date')}
+        if not date_str and dated['date']: _remember(client, (endpoint, json.dumps(dated, sort_keys=True)), data)
+        if cacheable and dated.get('date') and is_closed_trade_date(dated['date']):
+            cache_path = _http_cache_path(endpoint, dated['date'], dated)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+    return data
+
+# MOPS HTML (月營收)：已結算月份才寫入磁碟快取
+def fetch_mops_html(path, cacheable=False, timeout=10, encoding='utf-8'):
+    cache_path = os.path.join(HTTP_CACHE_DIR, "mops", path.strip('/').replace('/', '_'))
+    if cacheable and os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as f: return f.read()
+    res = http_get(f"{MOPS_BASE_URL}{path}", timeout=timeout)
+    res.encoding = encoding
+    text = res.text
+    if cacheable and res.status_code == 200 and '公司代號' in text:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f: f.write(text)
+    return text
+
+# T86 三大法人 (籌碼快照與法人排行共用同一份)
+def fetch_t86(date_str=None, cacheable=True):
+    params = {'selectType': 'ALL', 'response': 'json'}
+    if date_str: params['date'] = date_str
+    return fetch_twse_json("/rwd/zh/fund/T86", params, cacheable=cacheable)
+
+def fetch_bfiamu(date_str=None, cacheable=True):
+    params = {'response': 'json'}
+    if date_str: params['date'] = date_str
+    return fetch_twse_json("/rwd/zh/afterTrading/BFIAMU", params, cacheable=cacheable)
+
 # --- 營收 (MOPS - 僅上市) ---
+# 月營收表 → 代號為索引的 revenue / yoy / mom (整欄向量轉換)
+def parse_mops_revenue(html):
+    try: tables = pd.read_html(StringIO(html))
+    except: return None
+    frames = []
+    for df in tables:
+        if df.shape[1] <= 5 or '公司代號' not in str(df.columns): continue
+        pick = {}
+        for i, col in enumerate(str(c).replace(' ', '') for c in df.columns):
+            if '代號' in col: pick['code'] = i
+            elif '去年' in col and '%' in col: pick['yoy'] = i
+            elif '上月' in col and '%' in col: pick['mom'] = i
+            elif '當月營收' in col and '去年' not in col: pick['revenue'] = i
+        if 'code' in pick and 'yoy' in pick:
+            frames.append(pd.DataFrame({k: df.iloc[:, i].to_numpy() for k, i in pick.items()}))
+    if not frames: return None
+    df = pd.concat(frames, ignore_index=True)
+    df['code'] = df['code'].astype(str).str.strip()
+    for col in REVENUE_FIELDS:
+        df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', ''), errors='coerce') if col in df.columns else np.nan
+    df['mom'] = df['mom'].fillna(0.0)
+    df = df[df['yoy'].notna() & ~df['code'].isin(['nan', '合計'])]
+    return df.drop_duplicates('code', keep='last').set_index('code')[list(REVENUE_FIELDS)] if not df.empty else None
+
+# 兩個月前 (含) 的營收已申報完畢，之後不會再變
+def _revenue_month_settled(month, now):
+    return (now.year * 12 + now.month) - (month.year * 12 + month.month) >= 2
+
+def fetch_revenue_month(month):
+    html = fetch_mops_html(f"/nas/t21/sii/t21sc03_{month.year - 1911}_{month.month}_0.html", cacheable=_revenue_month_settled(month, get_taiwan_time()))
+    return parse_mops_revenue(html)
+
+def _revenue_archive_path(field):
+    return os.path.join(REVENUE_ARCHIVE_DIR, f"{field}.parquet")
+
+def load_revenue_archive(field):
+    try: return pd.read_parquet(_revenue_archive_path(field))
+    except: return None
+
+# 新月份併入各欄位矩陣 (列 = 月份、欄 = 代號)；yoy 最後寫，作為載入快取的版本
+def archive_revenue_months(months):
+    # 重抓的未結算月份內容沒變就不重寫 (檔案時間不變，載入快取也不必重建)
+    old = {field: load_revenue_archive(field) for field in REVENUE_FIELDS}
+    months = {m: df for m, df in months.items() if _revenue_month_changed(m, df, old)}
+    if not months: return
+    os.makedirs(REVENUE_ARCHIVE_DIR, exist_ok=True)
+    for field in ('revenue', 'mom', 'yoy'):
+        df_new = pd.DataFrame({m: df[field] for m, df in months.items()}).T
+        df_old = load_revenue_archive(field)
+        df_all = pd.concat([df_old, df_new]) if df_old is not None else df_new
+        df_all = df_all[~df_all.index.duplicated(keep='last')].sort_index().astype('float64' if field == 'revenue' else 'float32')
+        df_all.index = pd.DatetimeIndex(df_all.index, name='Month')
+        df_all.columns = df_all.columns.astype(str)
+        df_all.columns.name = None
+        tmp_path = f"{_revenue_archive_path(field)}.tmp"
+        df_all.to_parquet(tmp_path)
+        os.replace(tmp_path, _revenue_archive_path(field))
+
+def _revenue_month_changed(month, df, old):
+    for field in REVENUE_FIELDS:
+        if old[field] is None or month not in old[field].index: return True
+        prev = old[field].loc[month].dropna().sort_index()
+        cur = df[field].dropna().astype(prev.dtype).sort_index()
+        if not (prev.index.equals(cur.index) and np.array_equal(prev.to_numpy(), cur.to_numpy())): return True
+    return False
+
+# 回補最近 N 個月 (已結算且已收錄的跳過；未結算月份每次重抓)
+def backfill_revenue_archive(n_months=REVENUE_HISTORY_MONTHS, max_workers=4, progress_cb=None):
+    now = get_taiwan_time()
+    latest = pd.Timestamp(now.year, now.month, 1) - pd.DateOffset(months=1)
+    yoy = load_revenue_archive('yoy')
+    have = set(yoy.index) if yoy is not None else set()
+    tasks = [m for m in pd.date_range(end=latest, periods=n_months, freq='MS') if m not in have or not _revenue_month_settled(m, now)]
+    months = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {pool.submit(fetch_revenue_month, m): m for m in tasks}
+        for done_count, fut in enumerate(as_completed(futures), start=1):
+            try:
+                df = fut.result()
+                if df is not None: months[futures[fut]] = df
+            except: pass
+            if progress_cb: progress_cb(done_count, len(tasks))
+    archive_revenue_months(months)
+    return len(months)
+
+# 年增連續月數：逐月向量更新 (缺月中斷)
+def revenue_yoy_streak(yoy):
+    positive = np.nan_to_num(yoy.to_numpy(dtype='float64'), nan=0.0) > 0
+    streak = np.zeros(positive.shape, dtype='int16')
+    run = np.zeros(positive.shape[1], dtype='int16')
+    for i in range(len(positive)):
+        run = np.where(positive[i], run + 1, 0).astype('int16')
+        streak[i] = run
+    return pd.DataFrame(streak, index=yoy.index, columns=yoy.columns)
+
+def _revenue_matrices(frames):
+    months = pd.date_range(frames['yoy'].index.min(), frames['yoy'].index.max(), freq='MS')
+    m = {field: frames[field].reindex(months) for field in REVENUE_FIELDS}
+    m['streak'] = revenue_yoy_streak(m['yoy'])
+    m['yoy_avg3'] = m['yoy'].rolling(3, min_periods=3).mean()
+    return m
+
+@st.cache_resource(max_entries=1)
+def _load_revenue_matrices(mtime):
+    frames = {field: load_revenue_archive(field) for field in REVENUE_FIELDS}
+    if any(f is None or f.empty for f in frames.values()): return None
+    return _revenue_matrices(frames)
+
+def get_revenue_matrices():
+    path = _revenue_archive_path('yoy')
+    if not os.path.exists(path): return None
+    return _load_revenue_matrices(os.path.getmtime(path))
+
+# 指定月份的每檔特徵 (dict 查詢即得)
+def revenue_features(matrices, month):
+    cols = {'yoy': 'yoy', 'mom': 'mom', 'streak': 'streak', 'yoy_avg3': 'yoy_avg3'}
+    df = pd.DataFrame({k: matrices[f].loc[month] for k, f in cols.items()})
+    df = df[df['yoy'].notna()]
+    df['streak'] = df['streak'].astype(int)
+    df['yoy'], df['mom'] = df['yoy'].astype(float).round(2), df['mom'].fillna(0).astype(float).round(2)
+    df['yoy_avg3'] = df['yoy_avg3'].astype(float).round(2)
+    return df.to_dict('index')
+
+# 單檔營收特徵對齊到 K 棒日期：月營收於次月 10 日前申報，次月 11 日起才可用 (未收錄 = NaN)
+def get_revenue_history(code, index):
+    matrices = get_revenue_matrices()
+    if matrices is None or code not in matrices['yoy'].columns: return None
+    hist = pd.DataFrame({'yoy': matrices['yoy'][code].astype('float64'), 'streak': matrices['streak'][code].astype('float64')})
+    hist.loc[hist['yoy'].isna(), 'streak'] = np.nan
+    hist.index = hist.index + pd.DateOffset(months=1, days=10)
+    return hist.reindex(pd.DatetimeIndex(index).normalize(), method='ffill')
+
 @st.cache_data(ttl=3600)
 def get_revenue_data_snapshot():
     date_obj = get_taiwan_time()
-    if date_obj.day < 12: 
-        target_month = date_obj.replace(day=1) - timedelta(days=1)
-        target_month = target_month.replace(day=1) - timedelta(days=1)
-    else:
-        target_month = date_obj.replace(day=1) - timedelta(days=1)
-        
-    for _ in range(2): 
-        roc_year = target_month.year - 1911
-        month = target_month.month
-        revenue_map = {}
-        # ★★★ 修正：只抓取上市 (sii) 的營收 ★★★
-        url = f"https://mops.twse.com.tw/nas/t21/sii/t21sc03_{roc_year}_{month}_0.html"
-        has_data = False
-        
-        try:
-            res = requests.get(url, headers=HEADERS, timeout=5, verify=False)
-            res.encoding = 'utf-8'
-            dfs = pd.read_html(res.text)
-            for df in dfs:
-                if df.shape[1] > 5 and '公司代號' in str(df.columns):
-                    df.columns = [str(c).replace(' ','') for c in df.columns] 
-                    col_code = None
-                    col_yoy = None
-                    col_mom = None
-                    for i, col in enumerate(df.columns):
-                        if '代號' in col: col_code = col
-                        if '去年' in col and '%' in col: col_yoy = col
-                        if '上月' in col and '%' in col: col_mom = col
-                    if col_code and col_yoy:
-                        for _, row in df.iterrows():
-                            try:
-                                code = str(row[col_code])
-                                if code == 'nan' or code == '合計': continue
-                                yoy = float(str(row[col_yoy]).replace(',',''))
-                                mom = float(str(row[col_mom]).replace(',','')) if col_mom else 0.0
-                                revenue_map[code] = {'yoy': yoy, 'mom': mom}
-                                has_data = True
-                            except: continue
-        except: pass
-        
-        if has_data: return revenue_map, f"{roc_year}/{month}"
-        target_month = target_month.replace(day=1) - timedelta(days=1)
+    # 12 日前上月營收尚未申報完，用前兩個月
+    target_month = pd.Timestamp(date_obj.year, date_obj.month, 1) - pd.DateOffset(months=2 if date_obj.day < 12 else 1)
+    try: backfill_revenue_archive()
+    except: pass
+    matrices = get_revenue_matrices()
+    if matrices is not None:
+        available = matrices['yoy'].index[(matrices['yoy'].index <= target_month) & matrices['yoy'].notna().any(axis=1).to_numpy()]
+        if len(available):
+            month = available[-1]
+            return revenue_features(matrices, month), f"{month.year - 1911}/{month.month}"
+    # 資料庫無法寫入時，直接抓單月；連續年增月數無從得知 (streak = None，濾網略過)
+    for month in [target_month, target_month - pd.DateOffset(months=1)]:
+        try: df = fetch_revenue_month(month)
+        except: df = None
+        if df is not None:
+            frames = {field: df[[field]].T.set_axis([month]) for field in REVENUE_FIELDS}
+            features = revenue_features(_revenue_matrices(frames), month)
+            for v in features.values(): v['streak'] = None
+            return features, f"{month.year - 1911}/{month.month} (單月)"
     return {}, "無資料"
 
+def fetch_margin(date_str, cacheable=True):
+    return fetch_twse_json("/rwd/zh/margin/MI_MARGN", {'date': date_str, 'selectType': 'STOCK', 'response': 'json'}, cacheable=cacheable)
+
+# 融資增減 (代號 → 張)
+def parse_margin(data):
+    for table in data.get('tables', []):
+        if '股票代號' in table['fields'] and '融資今日餘額' in table['fields']:
+            df = pd.DataFrame(table['data'], columns=table['fields'])
+            for col in ['融資前日餘額', '融資今日餘額']:
+                 df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
+            df['net_change'] = (df['融資今日餘額'] - df['融資前日餘額']) / 1000
+            return pd.Series(df['net_change'].to_numpy(), index=df['股票代號'].astype(str).str.strip())
+    return None
+
+# 三大法人買賣超 (代號 → 股數)
+def parse_t86(data):
+    df = pd.DataFrame(data['data'], columns=data['fields'])
+    target_col = '三大法人買賣超股數'
+    for c in df.columns:
+        if '三大法人' in c and '買賣超' in c: target_col = c; break
+    net_buy = pd.to_numeric(df[target_col].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
+    return pd.Series(net_buy.to_numpy(), index=df['證券代號'].astype(str).str.strip())
+
 # --- 融資 (僅上市 TWSE) ---
 @st.cache_data(ttl=3600)
 def get_margin_data_snapshot():
@@ -312,17 +1128,10 @@ def get_margin_data_snapshot():
         date_str = date_obj.strftime('%Y%m%d')
         
         try:
-            url = f"https://www.twse.com.tw/rwd/zh/margin/MI_MARGN?date={date_str}&selectType=STOCK&response=json"
-            res = requests.get(url, headers=HEADERS, timeout=5, verify=False)
-            data = res.json()
+            data = fetch_margin(date_str)
             if data['stat'] == 'OK':
-                for table in data.get('tables', []):
-                    if '股票代號' in table['fields'] and '融資今日餘額' in table['fields']:
-                        df = pd.DataFrame(table['data'], columns=table['fields'])
-                        for col in ['融資前日餘額', '融資今日餘額']:
-                             df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-                        df['net_change'] = (df['融資今日餘額'] - df['融資前日餘額']) / 1000
-                        return df.set_index('股票代號')['net_change'].to_dict()
+                net_change = parse_margin(data)
+                if net_change is not None: return net_change.to_dict()
         except: pass
         date_obj -= timedelta(days=1)
     return {}
@@ -338,129 +1147,614 @@ def get_chip_data_snapshot():
         date_str_twse = date_obj.strftime('%Y%m%d')
         
         try:
-            url = f"https://www.twse.com.tw/rwd/zh/fund/T86?date={date_str_twse}&selectType=ALL&response=json"
-            res = requests.get(url, headers=HEADERS, timeout=5, verify=False)
-            data = res.json()
+            data = fetch_t86(date_str_twse)
             if data['stat'] == 'OK':
-                df = pd.DataFrame(data['data'], columns=data['fields'])
-                df['三大法人買賣超股數'] = pd.to_numeric(df['三大法人買賣超股數'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-                return df.set_index('證券代號')['三大法人買賣超股數'].to_dict(), date_str_twse
+                return parse_t86(data).to_dict(), date_str_twse
         except: pass
         date_obj -= timedelta(days=1)
     return {}, "無資料"
 
+# --- 籌碼 / 融資歷史資料庫 (回測用，可續傳的平行回補) ---
+CHIP_DATASETS = {'t86': (fetch_t86, parse_t86), 'margin': (fetch_margin, parse_margin)}
+
+def _chip_archive_path(kind):
+    return os.path.join(CHIP_ARCHIVE_DIR, f"{kind}.parquet")
+
+def _chip_progress_path():
+    return os.path.join(CHIP_ARCHIVE_DIR, "progress.json")
+
+def load_chip_archive(kind):
+    path = _chip_archive_path(kind)
+    if not os.path.exists(path): return None
+    try: return pd.read_parquet(path)
+    except: return None
+
+def _load_chip_progress():
+    try:
+        with open(_chip_progress_path(), encoding='utf-8') as f: return json.load(f)
+    except: return {kind: [] for kind in CHIP_DATASETS}
+
+# 新資料併入矩陣 (日期 × 代號, float32)，休市日另記以免重抓
+def _flush_chip_archive(kind, rows, empty_dates):
+    os.makedirs(CHIP_ARCHIVE_DIR, exist_ok=True)
+    if rows:
+        df_new = pd.DataFrame(rows).T
+        df_new.index = pd.to_datetime(df_new.index, format='%Y%m%d')
+        df_old = load_chip_archive(kind)
+        df_all = pd.concat([df_old, df_new]) if df_old is not None else df_new
+        df_all = df_all[~df_all.index.duplicated(keep='last')].sort_index().astype('float32')
+        df_all.index.name = 'Date'
+        df_all.columns = df_all.columns.astype(str)
+        df_all.columns.name = None
+        tmp_path = f"{_chip_archive_path(kind)}.tmp"
+        df_all.to_parquet(tmp_path)
+        os.replace(tmp_path, _chip_archive_path(kind))
+        _load_chip_matrix.clear()
+    if empty_dates:
+        progress = _load_chip_progress()
+        progress[kind] = sorted(set(progress.get(kind, [])) | set(empty_dates))
+        with open(_chip_progress_path(), 'w', encoding='utf-8') as f: json.dump(progress, f)
+
+# 回傳該日序列；確認休市回傳空序列；限流 / 尚未公布回傳 None (下次重試)
+def _fetch_chip_day(kind, date_str):
+    fetch, parse = CHIP_DATASETS[kind]
+    data = fetch(date_str, cacheable=False)
+    if data.get('stat') == 'OK': return parse(data)
+    if TWSE_NO_DATA in str(data.get('stat', '')) and is_market_holiday(date_str): return pd.Series(dtype='float64')
+    return None
+
+# 回補區間內已收盤的交易日 (已有 / 已知休市的日期會跳過，中斷後可續傳)
+def backfill_chip_archive(start_date, end_date, kinds=tuple(CHIP_DATASETS), max_workers=4, progress_cb=None):
+    progress = _load_chip_progress()
+    dates = [d.strftime('%Y%m%d') for d in pd.bdate_range(start_date, end_date)]
+    tasks = []
+    for kind in kinds:
+        archived = load_chip_archive(kind)
+        done = set(archived.index.strftime('%Y%m%d')) if archived is not None else set()
+        done |= set(progress.get(kind, []))
+        tasks += [(kind, d) for d in dates if d not in done and is_closed_trade_date(d)]
+    rows = {kind: {} for kind in kinds}
+    empty = {kind: [] for kind in kinds}
+    def flush():
+        for kind in kinds:
+            _flush_chip_archive(kind, rows[kind], empty[kind])
+            rows[kind], empty[kind] = {}, []
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {pool.submit(_fetch_chip_day, kind, d): (kind, d) for kind, d in tasks}
+        for done_count, fut in enumerate(as_completed(futures), start=1):
+            kind, d = futures[fut]
+            try:
+                series = fut.result()
+                if series is None: pass
+                elif series.empty: empty[kind].append(d)
+                else: rows[kind][d] = series[~series.index.duplicated(keep='last')]
+            except: pass
+            if done_count % CHIP_FLUSH_EVERY == 0: flush()
+            if progress_cb: progress_cb(done_count, len(tasks))
+    flush()
+    return len(tasks)
+
+@st.cache_resource(max_entries=len(CHIP_DATASETS))
+def _load_chip_matrix(kind, mtime):
+    return load_chip_archive(kind)
+
+# 依檔案修改時間快取的矩陣 (檔案沒變就不重讀)
+def get_chip_matrix(kind):
+    path = _chip_archive_path(kind)
+    if not os.path.exists(path): return None
+    return _load_chip_matrix(kind, os.path.getmtime(path))
+
+# 單檔的歷史序列，對齊到 K 棒日期：已收錄日缺值 = 0，未收錄日 = NaN
+def get_chip_history(code, index, kind='t86'):
+    matrix = get_chip_matrix(kind)
+    if matrix is None or matrix.empty: return None
+    col = matrix[code].fillna(0) if code in matrix.columns else pd.Series(0.0, index=matrix.index)
+    return col.astype('float64').reindex(pd.DatetimeIndex(index).normalize())
+
 def calculate_chip_concentration_pct(stock_id, chip_map, current_volume):
     net_buy_shares = chip_map.get(stock_id, 0)
     if not chip_map: return 0.0 
     if net_buy_shares <= 0 or current_volume <= 0: return 0.0
     return (net_buy_shares / current_volume) * 100.0
 
+# --- 全市場收盤行情 (MI_INDEX：熱力圖與掃描初篩共用) ---
+def fetch_mi_index(date_str, cacheable=True):
+    return fetch_twse_json("/rwd/zh/afterTrading/MI_INDEX", {'date': date_str, 'type': 'ALLBUT0999', 'response': 'json'}, timeout=15, cacheable=cacheable)
+
+def _to_number(col):
+    return pd.to_numeric(col.astype(str).str.replace(',', '').replace('--', '0'), errors='coerce').fillna(0)
+
+# 每日收盤行情表 → 數值化 DataFrame (漲跌號以向量運算判斷)
+def parse_mi_index(data):
+    for table in data.get('tables', []):
+        if '證券代號' in table['fields'] and '收盤價' in table['fields']:
+            df = pd.DataFrame(table['data'], columns=table['fields'])
+            df['證券代號'] = df['證券代號'].astype(str).str.strip()
+            for col in ['成交股數', '成交金額', '開盤價', '最高價', '最低價', '收盤價', '漲跌價差']:
+                if col in df.columns: df[col] = _to_number(df[col])
+            sign_txt = df['漲跌(+/-)'].astype(str)
+            df['sign'] = np.where(sign_txt.str.contains('+', regex=False), 1, np.where(sign_txt.str.contains('-', regex=False), -1, 0))
+            df['漲跌金額'] = df['漲跌價差'] * df['sign']
+            df['昨日收盤'] = df['收盤價'] - df['漲跌金額']
+            df['漲跌幅%'] = 0.0
+            mask = df['昨日收盤'] > 0
+            df.loc[mask, '漲跌幅%'] = (df.loc[mask, '漲跌金額'] / df.loc[mask, '昨日收盤']) * 100
+            df['漲跌幅%'] = df['漲跌幅%'].round(2)
+            return df
+    return None
+
+# 最近一個有資料的交易日 (14:00 收盤資料產出前用前一日)
 @st.cache_data(ttl=600)
-def get_tw_market_heatmap_data():
+def get_market_snapshot():
     date_obj = get_taiwan_time()
     if date_obj.hour < 14: date_obj -= timedelta(days=1)
     for _ in range(5):
         if date_obj.weekday() >= 5: 
             date_obj -= timedelta(days=1); continue
         date_str = date_obj.strftime('%Y%m%d')
-        url = f"https://www.twse.com.tw/rwd/zh/afterTrading/MI_INDEX?date={date_str}&type=ALLBUT0999&response=json"
         try:
-            res = requests.get(url, headers=HEADERS, timeout=15, verify=False)
-            data = res.json()
+            data = fetch_mi_index(date_str)
             if data['stat'] == 'OK':
-                target_table = None
-                for table in data.get('tables', []):
-                    if '證券代號' in table['fields'] and '收盤價' in table['fields']:
-                        target_table = table; break
-                if target_table:
-                    df = pd.DataFrame(target_table['data'], columns=target_table['fields'])
-                    df['成交金額'] = pd.to_numeric(df['成交金額'].astype(str).str.replace(',', '').replace('--', '0'), errors='coerce').fillna(0)
-                    df['收盤價'] = pd.to_numeric(df['收盤價'].astype(str).str.replace(',', '').replace('--', '0'), errors='coerce').fillna(0)
-                    df['漲跌價差'] = pd.to_numeric(df['漲跌價差'].astype(str).str.replace(',', '').replace('--', '0'), errors='coerce').fillna(0)
-                    def parse_sign(txt): return 1 if '+' in txt else (-1 if '-' in txt else 0)
-                    df['sign'] = df['漲跌(+/-)'].astype(str).apply(parse_sign)
-                    df['漲跌金額'] = df['漲跌價差'] * df['sign']
-                    df['昨日收盤'] = df['收盤價'] - df['漲跌金額']
-                    df['漲跌幅%'] = 0.0
-                    mask = df['昨日收盤'] > 0
-                    df.loc[mask, '漲跌幅%'] = (df.loc[mask, '漲跌金額'] / df.loc[mask, '昨日收盤']) * 100
-                    df['漲跌幅%'] = df['漲跌幅%'].round(2)
-                    df_top = df.sort_values('成交金額', ascending=False).head(400).copy() 
-                    def get_sector_enhanced(code):
-                        if code in SUB_SECTOR_MAP: return SUB_SECTOR_MAP[code]
-                        try: return twstock.codes[code].group
-                        except: return "其他"
-                    df_top['產業'] = df_top['證券代號'].apply(get_sector_enhanced)
-                    df_top['標籤'] = df_top['證券名稱'] + "<br>" + df_top['漲跌幅%'].astype(str) + "%"
-                    return df_top, date_str
+                df = parse_mi_index(data)
+                if df is not None: return df, date_str
         except: pass
         date_obj -= timedelta(days=1)
     return None, "無資料"
 
-@st.cache_data(ttl=1800)
+# 熱力圖個股方塊：成交金額前 N 大
+def build_heatmap_frame(day, top_n=HEATMAP_TOP_N):
+    df_top = day.sort_values('成交金額', ascending=False).head(top_n).copy()
+    df_top['標籤'] = df_top['證券名稱'] + "<br>" + df_top['漲跌幅%'].round(2).astype(str) + "%"
+    return df_top
+
+# --- 收盤行情資料庫：每天只解析一次，存精簡欄位與族群彙總，切換日期不必連網 ---
+def _market_archive_path(name):
+    return os.path.join(MARKET_ARCHIVE_DIR, f"{name}.parquet")
+
+def _load_market_holidays():
+    try:
+        with open(os.path.join(MARKET_ARCHIVE_DIR, "holidays.json"), encoding='utf-8') as f: return set(json.load(f))
+    except: return set()
+
+def compact_market_day(df, date_str):
+    day = attach_security_info(df[['證券代號', '證券名稱', '成交股數', '成交金額', '收盤價', '漲跌幅%']], '證券代號', {'sector': '產業'})
+    day['產業'] = day['產業'].replace('', "其他")
+    day.insert(0, 'Date', pd.Timestamp(datetime.strptime(date_str, '%Y%m%d')))
+    return day.astype({'成交股數': 'int64', '成交金額': 'float64', '收盤價': 'float32', '漲跌幅%': 'float32'}).reset_index(drop=True)
+
+# 族群彙總：成交金額、家數、漲跌家數、成交金額加權漲跌幅、資金佔比與前一日變化
+def aggregate_market_sectors(quotes):
+    pct = quotes['漲跌幅%'].astype('float64')
+    agg = quotes.assign(_w=quotes['成交金額'] * pct, _up=pct > 0, _down=pct < 0).groupby(['Date', '產業']).agg(
+        成交金額=('成交金額', 'sum'), 家數=('證券代號', 'size'), 上漲家數=('_up', 'sum'), 下跌家數=('_down', 'sum'), _w=('_w', 'sum')).reset_index()
+    agg['加權漲跌幅%'] = np.where(agg['成交金額'] > 0, agg['_w'] / agg['成交金額'].where(agg['成交金額'] > 0, 1), 0.0).round(2)
+    agg['資金佔比%'] = (agg['成交金額'] / agg.groupby('Date')['成交金額'].transform('sum') * 100).round(2)
+    agg = agg.sort_values(['產業', 'Date'])
+    agg['資金變動%'] = agg.groupby('產業')['資金佔比%'].diff().fillna(0).round(2)
+    return agg.drop(columns='_w').sort_values(['Date', '成交金額'], ascending=[True, False]).reset_index(drop=True)
+
+# 新的交易日併入資料庫 (days: 日期字串 → parse_mi_index 結果)；已收錄的日期不重寫
+def archive_market_days(days):
+    archive = get_market_archive()
+    if archive: days = {d: df for d, df in days.items() if d not in archive['by_date']}
+    os.makedirs(MARKET_ARCHIVE_DIR, exist_ok=True)
+    if days:
+        new = pd.concat([compact_market_day(df, d) for d, df in days.items()], ignore_index=True)
+        path = _market_archive_path("quotes")
+        old = pd.read_parquet(path) if os.path.exists(path) else None
+        quotes = pd.concat([old, new], ignore_index=True) if old is not None else new
+        quotes = quotes.drop_duplicates(['Date', '證券代號'], keep='last').sort_values(['Date', '證券代號']).reset_index(drop=True)
+        for name, frame in [("sectors", aggregate_market_sectors(quotes)), ("quotes", quotes)]:
+            tmp_path = f"{_market_archive_path(name)}.tmp"
+            frame.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, _market_archive_path(name))
+
+_HOLIDAYS_LOCK = threading.Lock()
+
+def _record_market_holidays(holidays):
+    if not holidays: return
+    os.makedirs(MARKET_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(MARKET_ARCHIVE_DIR, "holidays.json")
+    with _HOLIDAYS_LOCK:
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f: json.dump(sorted(_load_market_holidays() | set(holidays)), f)
+        os.replace(f"{path}.tmp", path)
+
+# 休市日確認：已收盤的日期 MI_INDEX 明確回「查無資料」才算 (限流、尚未公布、連線失敗都不算)，確認後記入 holidays.json
+def is_market_holiday(date_str, data=None):
+    if date_str in _load_market_holidays(): return True
+    if not is_closed_trade_date(date_str): return False
+    if data is None:
+        try: data = fetch_mi_index(date_str)
+        except: return False
+    if data.get('stat') == 'OK' or TWSE_NO_DATA not in str(data.get('stat', '')): return False
+    _record_market_holidays([date_str])
+    return True
+
+# 前一交易日：跳過週末與資料庫已知的休市日
+def get_previous_trading_day(date_obj):
+    holidays = _load_market_holidays()
+    prev = get_last_trading_day(date_obj)
+    while prev.strftime('%Y%m%d') in holidays: prev = get_last_trading_day(prev)
+    return prev
+
+def _fetch_market_day(date_str):
+    data = fetch_mi_index(date_str, cacheable=False)
+    if data.get('stat') == 'OK': return parse_mi_index(data)
+    is_market_holiday(date_str, data)  # 確認休市才記錄
+    return None
+
+# 回補最近 N 個交易日 (已有 / 已知休市的跳過)
+def backfill_market_archive(n_days, max_workers=4, progress_cb=None):
+    archive = get_market_archive()
+    done = set(archive['dates']) if archive else set()
+    done |= _load_market_holidays()
+    target = latest_close_date()
+    dates = [d.strftime('%Y%m%d') for d in pd.bdate_range(end=target, periods=n_days)]
+    tasks = [d for d in dates if d not in done]
+    days = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {pool.submit(_fetch_market_day, d): d for d in tasks}
+        for done_count, fut in enumerate(as_completed(futures), start=1):
+            try:
+                df = fut.result()
+                if df is not None: days[futures[fut]] = df
+            except: pass
+            if progress_cb: progress_cb(done_count, len(tasks))
+    archive_market_days(days)
+    return len(days)
+
+@st.cache_resource(max_entries=1)
+def _load_market_archive(mtime):
+    try:
+        quotes = pd.read_parquet(_market_archive_path("quotes"))
+        sectors = pd.read_parquet(_market_archive_path("sectors"))
+    except: return None
+    if quotes.empty: return None
+    # 依日期預先切好，切換日期只是 dict 查詢
+    by_date = {d.strftime('%Y%m%d'): g.reset_index(drop=True) for d, g in quotes.groupby('Date')}
+    sectors_by_date = {d.strftime('%Y%m%d'): g.reset_index(drop=True) for d, g in sectors.groupby('Date')}
+    sectors['日期'] = sectors['Date'].dt.strftime('%Y%m%d')
+    return {'dates': sorted(by_date), 'by_date': by_date, 'sectors': sectors, 'sectors_by_date': sectors_by_date}
+
+def get_market_archive():
+    path = _market_archive_path("quotes")
+    if not os.path.exists(path): return None
+    return _load_market_archive(os.path.getmtime(path))
+
+# 快照是否對應歷史資料的最後一根 K 棒 (盤中最後一根是今天的未收盤 K 棒，快照還是昨天)
+def snapshot_matches_last_bar(date_str):
+    now = get_taiwan_time()
+    last_bar = now if now.weekday() < 5 and now.hour >= 9 else get_last_trading_day(now)
+    return date_str == last_bar.strftime('%Y%m%d')
+
+# ------------------------------------------
+# 以收盤行情更新價格庫：每個缺少的交易日抓一次 MI_INDEX，全部股票一次寫入
+# ------------------------------------------
+def latest_close_date():
+    now = get_taiwan_time()
+    if now.weekday() < 5 and now.hour >= 14: return now.date()
+    return get_previous_trading_day(now).date()
+
+# 收盤行情 → 每檔一根 K 棒 (有成交的才算)
+def snapshot_price_bars(df):
+    traded = df[(df['成交股數'] > 0) & (df['收盤價'] > 0)]
+    bars = pd.DataFrame({'Open': traded['開盤價'].to_numpy(), 'High': traded['最高價'].to_numpy(), 'Low': traded['最低價'].to_numpy(),
+                         'Close': traded['收盤價'].to_numpy(), 'Volume': traded['成交股數'].to_numpy()},
+                        index=(traded['證券代號'] + '.TW').to_numpy())
+    return bars[~bars.index.duplicated()]
+
+# 多檔同時追加一根 K 棒的滾動狀態 (extend_indicator_state 的向量化版本)
+def _extend_state_panel(state, tails, close, vol):
+    delta = close - tails['Close'][:, -1]
+    new_vals = {'Close': close, 'Volume': vol, '_gain': np.maximum(delta, 0.0), '_loss': np.maximum(-delta, 0.0)}
+    n = state['_n']
+    for col, (field, window) in INDICATOR_STATE_WINDOWS.items():
+        leaving = np.where(n >= window, np.nan_to_num(tails[field][:, -window]), 0.0)
+        state[col] = state[col] + new_vals[field] - leaving
+    for field, val in new_vals.items(): tails[field] = np.column_stack([tails[field][:, 1:], val])
+    state['_n'] = n + 1
+
+def update_price_store_from_snapshots(max_days=SNAPSHOT_UPDATE_MAX_DAYS, progress_cb=None):
+    target = latest_close_date()
+    try:
+        with open(SNAPSHOT_UPDATE_MARKER, encoding='utf-8') as f:
+            if json.load(f).get('date') == str(target): return 0
+    except: pass
+    long_df = load_market_panel()
+    if long_df is None: return 0
+
+    # 各股最後 200 根靠右排成矩陣 (不足補 NaN)，狀態取最後一根
+    tail = long_df.groupby('ticker', sort=False).tail(200)
+    row, names = pd.factorize(tail['ticker'])
+    col = 199 - tail.groupby('ticker', sort=False).cumcount(ascending=False).to_numpy()
+    closes = np.full((len(names), 200), np.nan); closes[row, col] = tail['Close'].to_numpy(dtype='float64')
+    vols = np.full((len(names), 200), np.nan); vols[row, col] = tail['Volume'].to_numpy(dtype='float64')
+    last = tail.groupby('ticker', sort=False).tail(1)
+    last_date = last['Date'].dt.date.to_numpy()
+    eligible = last[INDICATOR_STATE_COLUMNS].notna().all(axis=1).to_numpy() & (last_date >= target - timedelta(days=max_days)) & (last_date < target)
+    if not eligible.any():
+        _mark_snapshot_update(target); return 0
+    names, last_date = np.asarray(names)[eligible], last_date[eligible]
+    closes, vols = closes[eligible], vols[eligible][:, -60:]
+    diff = closes[:, -14:] - closes[:, -15:-1]
+    tails = {'Close': closes, 'Volume': vols, '_gain': np.nan_to_num(np.maximum(diff, 0.0)), '_loss': np.nan_to_num(np.maximum(-diff, 0.0))}
+    state = {c: last[c].to_numpy(dtype='float64')[eligible] for c in INDICATOR_STATE_COLUMNS}
+
+    days = [d.date() for d in pd.bdate_range(min(last_date) + timedelta(days=1), target)]
+    holidays = _load_market_holidays()
+    appended = []
+    # 中間缺一天就不能往後補 (會跳過 K 棒)：只有確認的休市日可跳過，其餘失敗一律停下，下次再補
+    for i, day in enumerate(days):
+        if progress_cb: progress_cb(i, len(days), day)
+        date_str = day.strftime('%Y%m%d')
+        if date_str in holidays: continue
+        try: data = fetch_mi_index(date_str)
+        except: break
+        if data.get('stat') != 'OK':
+            if day != target and is_market_holiday(date_str, data): continue
+            break  # 尚未公布 / 限流
+        snap = parse_mi_index(data)
+        if snap is None: break
+        bars = snapshot_price_bars(snap)
+        mask = np.isin(names, bars.index) & (last_date < day)
+        if not mask.any(): continue
+        sub = bars.reindex(names[mask])
+        # 與快取一致：價格以 float32 存、量為整數
+        bar_vals = {c: sub[c].to_numpy(dtype=PRICE_COLUMNS[c]).astype('float64') for c in PRICE_COLUMNS}
+        sub_state = {c: v[mask] for c, v in state.items()}
+        sub_tails = {f: t[mask] for f, t in tails.items()}
+        _extend_state_panel(sub_state, sub_tails, bar_vals['Close'], bar_vals['Volume'])
+        for c in state: state[c][mask] = sub_state[c]
+        for f in tails: tails[f][mask] = sub_tails[f]
+        last_date[mask] = day
+        appended.append(pd.DataFrame({'ticker': names[mask], 'Date': pd.Timestamp(day), **bar_vals, **sub_state}))
+    else:
+        # 目標日的收盤行情已寫入才標記完成
+        _mark_snapshot_update(target)
+    if progress_cb: progress_cb(len(days), len(days), target)
+    if not appended: return 0
+
+    # 一次寫入：依 ticker 分區，每檔新增一個分片
+    frame = pd.concat(appended, ignore_index=True)
+    for c, dtype in PRICE_COLUMNS.items(): frame[c] = frame[c].astype(dtype)
+    pq.write_to_dataset(pa.Table.from_pandas(frame, preserve_index=False), PRICE_STORE_DIR, partition_cols=['ticker'],
+                        basename_template=f"part-{time.time_ns():020d}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore')
+    for ticker in frame['ticker'].unique():
+        if len(os.listdir(_price_partition(ticker))) > PRICE_COMPACT_PARTS: compact_price_parts(ticker)
+    return len(frame)
+
+def _mark_snapshot_update(target):
+    os.makedirs(os.path.dirname(SNAPSHOT_UPDATE_MARKER), exist_ok=True)
+    with open(SNAPSHOT_UPDATE_MARKER, 'w', encoding='utf-8') as f: json.dump({'date': str(target)}, f)
+
+# 下載歷史前的初篩：只用全市場資料就能確定不會命中的股票先剔除 (快照沒有的股票一律保留)
+def prefilter_scan_universe(tickers, settings, snapshot=None, chip_map=None, rev_map=None, margin_map=None):
+    codes = pd.Series([t.split('.')[0] for t in tickers])
+    keep = np.ones(len(codes), dtype=bool)
+    if settings.get('exclude_margin_surge') and margin_map:
+        keep &= ~(codes.map(margin_map).fillna(0).to_numpy() > 500)
+    if rev_map:
+        yoy = codes.map({c: v['yoy'] for c, v in rev_map.items()}).fillna(0).to_numpy()
+        keep &= ~(yoy < settings.get('min_revenue_yoy', -100))
+        if settings.get('min_revenue_streak', 0) > 0:
+            # streak 為 None (只有單月營收) 不過濾
+            streak = codes.map({c: np.inf if v.get('streak') is None else v['streak'] for c, v in rev_map.items()}).fillna(0).to_numpy()
+            keep &= streak >= settings['min_revenue_streak']
+    if snapshot is not None:
+        snap = snapshot.drop_duplicates('證券代號').set_index('證券代號').reindex(codes)
+        known = snap['成交股數'].notna().to_numpy()
+        vol = snap['成交股數'].to_numpy()
+        with np.errstate(invalid='ignore'):
+            ok = vol >= settings['vol_min'] * 1000
+            if settings.get('check_red_candle'):
+                ok &= _is_bullish_candlestick_2d(snap['開盤價'].to_numpy(), snap['收盤價'].to_numpy(), snap['最高價'].to_numpy(), snap['最低價'].to_numpy())
+            # 只跑籌碼衝鋒時，集中度 (法人買超 / 成交量) 也能先算
+            strategies = settings.get('strategies') or [settings['strategy']]
+            if chip_map and set(strategies) == {'籌碼衝鋒 (集中度高)'}:
+                net = codes.map(chip_map).fillna(0).to_numpy()
+                conc = np.where((net > 0) & (vol > 0), net / np.where(vol > 0, vol, 1) * 100.0, 0.0)
+                ok &= conc >= settings.get('chip_threshold', 10.0)
+        keep &= ~known | ok
+    return [t for t, k in zip(tickers, keep) if k]
+
+# --- 新聞：各來源併發抓取 (ETag / Last-Modified 條件請求)，併入本地新聞庫 ---
+def _load_news_store():
+    try:
+        with open(NEWS_STORE_FILE, encoding='utf-8') as f: return json.load(f)
+    except: return {'feeds': {}, 'items': []}
+
+def _save_news_store(store):
+    tmp_path = f"{NEWS_STORE_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(store, f, ensure_ascii=False)
+    os.replace(tmp_path, NEWS_STORE_FILE)
+
+# 單一來源；304 代表沒有新東西
+def _fetch_feed(source, url, validators):
+    headers = {}
+    if validators.get('etag'): headers['If-None-Match'] = validators['etag']
+    if validators.get('modified'): headers['If-Modified-Since'] = validators['modified']
+    res = http_get(url, timeout=NEWS_FEED_TIMEOUT, headers=headers)
+    if res.status_code == 304: return [], validators
+    res.raise_for_status()
+    feed = feedparser.parse(res.content)
+    items = []
+    for entry in feed.entries:
+        published = entry.get('published_parsed')
+        # feedparser 的時間是 UTC；沒有日期的由合併時補首次看到的時間
+        ts = calendar.timegm(published) if published else None
+        items.append({"來源": source, "標題": entry.title, "連結": entry.get('link', ''), "時間": entry.get('published', ''), "ts": ts})
+    return items, {'etag': res.headers.get('ETag'), 'modified': res.headers.get('Last-Modified')}
+
+@st.cache_data(ttl=300)
 def get_all_market_news():
-    rss_sources = {
-        "Yahoo個股": "https://tw.stock.yahoo.com/rss?category=tw-individual",
-        "Yahoo產業": "https://tw.stock.yahoo.com/rss?category=tw-industry",
-        "MoneyDJ個股": "https://www.moneydj.com/KMDJ/RssCenter.aspx?svc=NW&a=X0100000",
-        "MoneyDJ產業": "https://www.moneydj.com/KMDJ/RssCenter.aspx?svc=NW&a=X0200000"
-    }
-    all_news = []
+    store = _load_news_store()
+    first_seen = {item['標題']: item.get('ts', 0) for item in store['items']}
+    now = time.time()
+    with ThreadPoolExecutor(max_workers=len(RSS_SOURCES)) as pool:
+        futures = {pool.submit(_fetch_feed, source, url, store['feeds'].get(source, {})): source for source, url in RSS_SOURCES.items()}
+        for fut in as_completed(futures):
+            try:
+                items, validators = fut.result()
+                for item in items:
+                    if item['ts'] is None: item['ts'] = first_seen.get(item['標題'], now)
+                store['feeds'][futures[fut]] = validators
+                store['items'].extend(items)
+            except: pass
+    # 同標題只留最新一則，新到舊排序
     seen_titles = set()
+    merged = []
+    for item in sorted(store['items'], key=lambda x: x.get('ts', 0), reverse=True):
+        if item['標題'] in seen_titles: continue
+        seen_titles.add(item['標題'])
+        merged.append(item)
+    store['items'] = merged[:NEWS_STORE_LIMIT]
+    try: _save_news_store(store)
+    except: pass
+
+    all_news = store['items'][:NEWS_DISPLAY_LIMIT]
     keywords = []
-    for source, url in rss_sources.items():
-        try:
-            feed = feedparser.parse(url)
-            for entry in feed.entries[:8]: 
-                if entry.title not in seen_titles:
-                    all_news.append({"來源": source, "標題": entry.title, "連結": entry.link, "時間": entry.get('published', '')})
-                    seen_titles.add(entry.title)
-                    if "營收" in entry.title: keywords.append("營收")
-                    if "法說" in entry.title: keywords.append("法說")
-                    if "新高" in entry.title: keywords.append("創新高")
-        except: pass
+    for n in all_news:
+        if "營收" in n['標題']: keywords.append("營收")
+        if "法說" in n['標題']: keywords.append("法說")
+        if "新高" in n['標題']: keywords.append("創新高")
     return all_news, keywords
 
+# --- 類股資金流向 (BFIAMU 日資料庫：列 = 日期、欄 = 類股) ---
+def parse_bfiamu(data):
+    df = pd.DataFrame(data['data'], columns=data['fields'])
+    change = df['漲跌指數'].astype(str).str.replace(r'<[^>]+>', '', regex=True)
+    return pd.DataFrame({'成交金額': _to_number(df['成交金額']).to_numpy(),
+                         '漲跌指數': pd.to_numeric(change.str.replace(',', ''), errors='coerce').to_numpy()},
+                        index=df['分類指數名稱'].astype(str).str.strip().to_numpy()).groupby(level=0).last()
+
+def _sector_flow_path(field):
+    return _market_archive_path(f"sector_{field}")
+
+def _load_sector_flow_field(field):
+    try: return pd.read_parquet(_sector_flow_path(field))
+    except: return None
+
+def _sector_flow_frames(days):
+    amount = pd.DataFrame({pd.Timestamp(datetime.strptime(d, '%Y%m%d')): df['成交金額'] for d, df in days.items()}).T
+    change = pd.DataFrame({pd.Timestamp(datetime.strptime(d, '%Y%m%d')): df['漲跌指數'] for d, df in days.items()}).T
+    return {'amount': amount.sort_index(), 'change': change.sort_index()}
+
+# days: 日期字串 → parse_bfiamu 結果；已收錄的日期不重寫；amount 最後寫，作為載入快取的版本
+def archive_sector_flow_days(days):
+    flow = get_sector_flow()
+    if flow is not None:
+        archived = set(flow['amount'].index.strftime('%Y%m%d'))
+        days = {d: df for d, df in days.items() if d not in archived}
+    if days:
+        os.makedirs(MARKET_ARCHIVE_DIR, exist_ok=True)
+        for field, df_new in sorted(_sector_flow_frames(days).items(), key=lambda kv: kv[0] == 'amount'):
+            df_old = _load_sector_flow_field(field)
+            df_all = pd.concat([df_old, df_new]) if df_old is not None else df_new
+            df_all = df_all[~df_all.index.duplicated(keep='last')].sort_index().astype('float64')
+            df_all.index = pd.DatetimeIndex(df_all.index, name='Date')
+            df_all.columns = df_all.columns.astype(str)
+            df_all.columns.name = None
+            tmp_path = f"{_sector_flow_path(field)}.tmp"
+            df_all.to_parquet(tmp_path)
+            os.replace(tmp_path, _sector_flow_path(field))
+
+# 查無資料時交給 is_market_holiday 以 MI_INDEX 確認休市；限流等失敗不記，下次重試
+def _fetch_sector_flow_day(date_str):
+    data = fetch_bfiamu(date_str, cacheable=False)
+    if data.get('stat') == 'OK': return parse_bfiamu(data)
+    if TWSE_NO_DATA in str(data.get('stat', '')): is_market_holiday(date_str)
+    return None
+
+# 回補到 end_date 為止最近 N 個交易日 (已有 / 已知休市的跳過)
+def backfill_sector_flow_archive(n_days=max(SECTOR_FLOW_WINDOWS) + 1, end_date=None, max_workers=4, progress_cb=None):
+    amount = _load_sector_flow_field('amount')
+    done = {d.strftime('%Y%m%d') for d in amount.index} if amount is not None else set()
+    done |= _load_market_holidays()
+    end = datetime.strptime(end_date, '%Y%m%d').date() if end_date else latest_close_date()
+    # 多抓幾個平日，遇到休市仍湊得滿 N 個交易日
+    dates = [d.strftime('%Y%m%d') for d in pd.bdate_range(end=end, periods=n_days + 5)]
+    tasks = [d for d in dates if d not in done]
+    days = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {pool.submit(_fetch_sector_flow_day, d): d for d in tasks}
+        for done_count, fut in enumerate(as_completed(futures), start=1):
+            try:
+                df = fut.result()
+                if df is not None: days[futures[fut]] = df
+            except: pass
+            if progress_cb: progress_cb(done_count, len(tasks))
+    archive_sector_flow_days(days)
+    return len(days)
+
+@st.cache_resource(max_entries=1)
+def _load_sector_flow(mtime):
+    frames = {field: _load_sector_flow_field(field) for field in ('amount', 'change')}
+    if any(f is None or f.empty for f in frames.values()): return None
+    return frames
+
+def get_sector_flow():
+    path = _sector_flow_path('amount')
+    if not os.path.exists(path): return None
+    return _load_sector_flow(os.path.getmtime(path))
+
+# 成交佔比矩陣 (%)；無成交的類股不列入
+def sector_share_matrix(flow):
+    amount = flow['amount'].fillna(0)
+    total = amount.sum(axis=1)
+    return amount.div(total.where(total > 0), axis=0) * 100
+
+# 全部日期一次算：1 / N 日佔比變化與動能排名 (各區間排名平均後再排名)，回傳指定日期的截面
+def sector_flow_table(flow, date):
+    share = sector_share_matrix(flow)
+    changes = {f"{n}日變動%": share - share.shift(n) for n in SECTOR_FLOW_WINDOWS}
+    ranks = sum(c.rank(axis=1, ascending=False) for c in changes.values()) / len(changes)
+    row = pd.Timestamp(date)
+    table = pd.DataFrame({
+        '成交金額': flow['amount'].loc[row], '漲跌指數': flow['change'].loc[row],
+        '今日佔比%': share.loc[row], '資金變動%': (share - share.shift(1)).loc[row].fillna(0),
+        **{name: c.loc[row] for name, c in changes.items()},
+        '動能排名': ranks.loc[row].rank(method='min'),
+    })
+    table = table[table['成交金額'].notna()].rename_axis('分類指數名稱').reset_index()
+    table['動能排名'] = table['動能排名'].astype('Int64')
+    return table.round(1)
+
 @st.cache_data(ttl=600)
-def get_twse_sector_flow_dynamic():
-    url_base = "https://www.twse.com.tw/rwd/zh/afterTrading/BFIAMU?response=json"
+def get_twse_sector_flow_dynamic(window=1):
     try:
-        res = requests.get(url_base, headers=HEADERS, timeout=10, verify=False)
-        data = res.json()
+        data = fetch_bfiamu()
         if data.get('stat') != 'OK': return None, "無資料", None, None
-        df_curr = pd.DataFrame(data['data'], columns=data['fields'])
-        df_curr['成交金額'] = pd.to_numeric(df_curr['成交金額'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-        total_curr = df_curr['成交金額'].sum()
-        df_curr['今日佔比%'] = (df_curr['成交金額'] / total_curr) * 100 if total_curr > 0 else 0
-        if df_curr['漲跌指數'].astype(str).str.contains('<').any():
-             df_curr['漲跌指數'] = df_curr['漲跌指數'].astype(str).str.extract(r'>([-\d\.]+)<')[0]
-        today = datetime.strptime(data['date'], '%Y%m%d')
-        prev_str = get_last_trading_day(today).strftime('%Y%m%d')
+        today = parse_bfiamu(data)
+        flow = None
         try:
-            res_p = requests.get(f"{url_base}&date={prev_str}", headers=HEADERS, timeout=5, verify=False)
-            data_p = res_p.json()
-            if data_p.get('stat') == 'OK':
-                df_p = pd.DataFrame(data_p['data'], columns=data_p['fields'])
-                df_p['成交金額'] = pd.to_numeric(df_p['成交金額'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-                total_p = df_p['成交金額'].sum()
-                df_p['昨日佔比%'] = (df_p['成交金額'] / total_p) * 100 if total_p > 0 else 0
-                df_merge = pd.merge(df_curr, df_p[['分類指數名稱', '昨日佔比%']], on='分類指數名稱', how='left')
-                df_merge['資金變動%'] = df_merge['今日佔比%'] - df_merge['昨日佔比%'].fillna(0)
-            else: df_merge = df_curr; df_merge['資金變動%'] = 0
-        except: df_merge = df_curr; df_merge['資金變動%'] = 0
-        df_merge = df_merge.round(1)
-        flow_in = df_merge.sort_values('資金變動%', ascending=False).head(5)
-        flow_out = df_merge.sort_values('資金變動%', ascending=True).head(5)
+            archive_sector_flow_days({data['date']: today})
+            backfill_sector_flow_archive(end_date=data['date'])
+            flow = get_sector_flow()
+        except: pass
+        # 資料庫不可用時退回單日 (只有佔比，沒有變化)
+        if flow is None or pd.Timestamp(datetime.strptime(data['date'], '%Y%m%d')) not in flow['amount'].index:
+            flow = _sector_flow_frames({data['date']: today})
+        df_merge = sector_flow_table(flow, datetime.strptime(data['date'], '%Y%m%d'))
+        sort_col = '資金變動%' if window == 1 else f"{window}日變動%"
+        flow_in = df_merge.sort_values(sort_col, ascending=False).head(5)
+        flow_out = df_merge.sort_values(sort_col, ascending=True).head(5)
         main_s = df_merge.sort_values('成交金額', ascending=False).head(10)
         return main_s, flow_in, flow_out, data['date']
     except Exception as e: return None, str(e), None, None
 
+# 類股成交佔比走勢 (最近 N 個交易日，只讀資料庫)
+def get_sector_share_history(sectors, days=max(SECTOR_FLOW_WINDOWS)):
+    flow = get_sector_flow()
+    if flow is None: return None
+    share = sector_share_matrix(flow).tail(days)
+    share = share[[s for s in sectors if s in share.columns]]
+    share.index = share.index.strftime('%m/%d')
+    return share.round(2) if not share.empty else None
+
 @st.cache_data(ttl=600)
 def get_institutional_ranking_smart():
-    url = "https://www.twse.com.tw/rwd/zh/fund/T86?response=json&selectType=ALL"
     try:
-        res = requests.get(url, headers=HEADERS, timeout=10, verify=False)
-        data = res.json()
+        data = fetch_t86()
         if data.get('stat') != 'OK': return None, "無資料"
         df = pd.DataFrame(data['data'], columns=data['fields'])
         target_col = '三大法人買賣超股數'
@@ -471,10 +1765,9 @@ def get_institutional_ranking_smart():
         df_today.columns = ['代號', '名稱', '今日買超']
         top_list = df_today.sort_values('今日買超', ascending=False).head(30).copy()
         today = datetime.strptime(data['date'], '%Y%m%d')
-        prev_str = get_last_trading_day(today).strftime('%Y%m%d')
+        prev_str = get_previous_trading_day(today).strftime('%Y%m%d')
         try:
-            res_p = requests.get(f"https://www.twse.com.tw/rwd/zh/fund/T86?date={prev_str}&response=json&selectType=ALL", headers=HEADERS, timeout=5, verify=False)
-            d_p = res_p.json()
+            d_p = fetch_t86(prev_str)
             if d_p.get('stat') == 'OK':
                 df_p = pd.DataFrame(d_p['data'], columns=d_p['fields'])
                 df_p[target_col] = pd.to_numeric(df_p[target_col].astype(str).str.replace(',', ''), errors='coerce').fillna(0).astype(int)
@@ -507,6 +1800,7 @@ def is_bullish_candlestick(open_p, close_p, high_p, low_p):
     if total_len > 0 and (lower_shadow / total_len > 0.5): return True
     return False
 
+@profiled('strategy_check', ticker_arg=2)
 def check_stock_strategy_web(df, settings, ticker="", chip_map=None):
     if df is None or len(df) < 60: return False
     curr = df.iloc[-1]
@@ -566,6 +1860,154 @@ def check_stock_strategy_web(df, settings, ticker="", chip_map=None):
 
     return False
 
+# --- 向量化全市場篩選 (面板引擎：K棒 × 股票 的 2-D 陣列) ---
+PANEL_LOOKBACK = 260  # MA200 + 前 60 日回看，足以判斷最後一根 K 棒
+PANEL_FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# 各股最後 N 根 K 棒靠右對齊 (列 = 倒數第幾根)，滾動視窗與逐檔計算完全一致
+def build_price_panel(frames, lookback=PANEL_LOOKBACK):
+    if isinstance(frames, dict):
+        if not frames: return None
+        long_df = pd.concat({t: f[PANEL_FIELDS] for t, f in frames.items()}, names=['ticker', 'Date']).reset_index()
+    else: long_df = frames
+    if long_df is None or long_df.empty: return None
+    tickers, col = np.unique(long_df['ticker'].astype(str).to_numpy(), return_inverse=True)
+    pos = long_df.groupby(col, sort=False).cumcount(ascending=False).to_numpy()
+    lengths = np.bincount(col, minlength=len(tickers))
+    keep = pos < lookback
+    row = lookback - 1 - pos[keep]
+    panel = {'tickers': tickers, 'length': lengths, 'lookback': lookback}
+    for field in PANEL_FIELDS:
+        arr = np.full((lookback, len(tickers)), np.nan)
+        arr[row, col[keep]] = long_df[field].to_numpy(dtype='float64')[keep]
+        panel[field] = arr
+    last_date = np.empty(len(tickers), dtype='datetime64[ns]')
+    last = pos == 0
+    last_date[col[last]] = pd.to_datetime(long_df['Date']).to_numpy()[last]
+    panel['last_date'] = last_date
+    panel['padding'] = np.arange(lookback)[:, None] < (lookback - np.minimum(lengths, lookback))[None, :]
+    return panel
+
+# 同 pandas rolling(window).mean()：視窗內有 NaN 即為 NaN
+def _rolling_mean_2d(x, window):
+    valid = ~np.isnan(x)
+    csum = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(np.where(valid, x, 0.0), axis=0)])
+    ccnt = np.vstack([np.zeros((1, x.shape[1]), dtype=int), np.cumsum(valid, axis=0)])
+    out = np.full(x.shape, np.nan)
+    if x.shape[0] < window: return out
+    sums = csum[window:] - csum[:-window]
+    cnts = ccnt[window:] - ccnt[:-window]
+    out[window - 1:] = np.where(cnts == window, sums / window, np.nan)
+    return out
+
+def compute_panel_indicators(panel):
+    close, vol = panel['Close'], panel['Volume']
+    panel['MA5'] = _rolling_mean_2d(close, 5)
+    panel['MA20'] = _rolling_mean_2d(close, 20)
+    panel['MA60'] = _rolling_mean_2d(close, 60)
+    panel['MA200'] = _rolling_mean_2d(close, 200)
+    panel['Volume_MA5'] = _rolling_mean_2d(vol, 5)
+    panel['Volume_MA60'] = _rolling_mean_2d(vol, 60)
+    # RSI 與 calculate_rsi 相同 (diff 的 NaN 視為 0)；補位列不計入視窗
+    delta = np.vstack([np.full((1, close.shape[1]), np.nan), np.diff(close, axis=0)])
+    gain = np.where(delta > 0, delta, 0.0)
+    loss = np.where(delta < 0, -delta, 0.0)
+    gain[panel['padding']] = np.nan
+    loss[panel['padding']] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = _rolling_mean_2d(gain, 14) / _rolling_mean_2d(loss, 14)
+        panel['RSI'] = 100 - (100 / (1 + rs))
+    return panel
+
+# 只重算最後幾列指標：取足夠長的切片跑同一套計算 (MA200 要 200 列、RSI 要前一列)，結果與整段重算相同
+PANEL_INDICATORS = ['MA5', 'MA20', 'MA60', 'MA200', 'Volume_MA5', 'Volume_MA60', 'RSI']
+
+def refresh_panel_tail(panel, rows=1):
+    span = rows + 200
+    sub = {'Close': panel['Close'][-span:], 'Volume': panel['Volume'][-span:], 'padding': panel['padding'][-span:]}
+    compute_panel_indicators(sub)
+    for name in PANEL_INDICATORS: panel[name][-rows:] = sub[name][-rows:]
+    return panel
+
+def _is_bullish_candlestick_2d(o, c, h, l):
+    total_len = h - l
+    body_len = np.abs(c - o)
+    lower_shadow = np.minimum(o, c) - l
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ((c > o)
+                | ((total_len > 0) & (body_len / total_len < 0.1))
+                | ((o > 0) & (body_len / o < 0.003))
+                | ((total_len > 0) & (lower_shadow / total_len > 0.5)))
+
+# 全市場一次判斷 (邏輯同 check_stock_strategy_web)，回傳命中清單
+def screen_panel(panel, settings, chip_map=None):
+    cols = ['ticker', '籌碼狀態', 'Close', 'MA200', 'Volume', 'RSI', '資料日期']
+    if panel is None or len(panel['tickers']) == 0: return pd.DataFrame(columns=cols)
+    strategy = settings['strategy']
+    o, h, l, c, v = (panel[f][-1] for f in ['Open', 'High', 'Low', 'Close', 'Volume'])
+    ma20, ma200, rsi, vma5 = panel['MA20'][-1], panel['MA200'][-1], panel['RSI'][-1], panel['Volume_MA5'][-1]
+    ok = panel['length'] >= 60
+
+    if strategy != '蜻蜓點水 (縮量回測)':
+        ok &= ~np.isnan(ma200)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bias = ((c - ma200) / ma200) * 100
+        if strategy != '浴火重生 (假跌破)': ok &= ~(np.abs(bias) > settings['bias_range'])
+
+    if settings['check_trend_high']:
+        past_60 = panel['Close'][-65:-5]
+        past_high = np.where(np.isnan(past_60), -np.inf, past_60).max(axis=0)
+        past_high = np.where(np.isinf(past_high), np.nan, past_high)
+        ok &= ~(~np.isnan(ma200) & (past_high <= ma200 * 1.05))
+
+    if settings['check_rsi_rising']:
+        ok &= ~(np.isnan(rsi) | (rsi <= panel['RSI'][-2]))
+
+    if settings['vol_surge']:
+        ok &= ~(v <= panel['Volume'][-2])
+
+    if settings['check_red_candle']:
+        ok &= _is_bullish_candlestick_2d(o, c, h, l)
+
+    stock_ids = np.array([t.split('.')[0] for t in panel['tickers']])
+    net_buy_shares = np.array([chip_map.get(sid, 0) for sid in stock_ids], dtype='float64') if chip_map else np.zeros(len(stock_ids))
+    net_buy_lots = np.trunc(net_buy_shares / 1000).astype(int)
+
+    if strategy == '籌碼衝鋒 (集中度高)':
+        ok &= ~(c <= ma20)
+        if chip_map:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                concentration = np.where((net_buy_shares > 0) & (v > 0), net_buy_shares / v * 100.0, 0.0)
+            ok &= concentration >= settings.get('chip_threshold', 10.0)
+            status = [f"籌碼集中 {concentration[j]:.1f}% (買超{net_buy_lots[j]}張)" for j in range(len(stock_ids))]
+        else: status = ["⚠️ 無籌碼數據"] * len(stock_ids)
+    elif strategy == '蜻蜓點水 (縮量回測)':
+        ok &= ~(c < ma200)
+        ok &= ~(l > ma200 * 1.03)
+        ok &= ~(np.isnan(vma5) | (v > vma5))
+        status = [f"量縮有撐 (買超{n}張)" for n in net_buy_lots]
+    elif strategy == '浴火重生 (假跌破)':
+        ok &= ~(c <= ma200)
+        ok &= (panel['Low'][-11:-1] < panel['MA200'][-11:-1]).any(axis=0)
+        status = [f"假跌破回穩 (買超{n}張)" for n in net_buy_lots]
+    else: ok[:] = False; status = [""] * len(stock_ids)
+
+    hit = np.flatnonzero(ok)
+    return pd.DataFrame({
+        'ticker': panel['tickers'][hit], '籌碼狀態': [status[j] for j in hit],
+        'Close': c[hit], 'MA200': ma200[hit], 'Volume': v[hit], 'RSI': rsi[hit],
+        '資料日期': pd.to_datetime(panel['last_date'][hit]).strftime('%Y-%m-%d')
+    }, columns=cols)
+
+# 多策略一次篩選 (同一份面板與指標，只換判斷條件)
+def screen_panel_strategies(panel, settings, strategies, chip_map=None):
+    hits = []
+    for strategy in strategies:
+        df_hit = screen_panel(panel, {**settings, 'strategy': strategy}, chip_map)
+        df_hit['策略'] = strategy
+        hits.append(df_hit)
+    return pd.concat(hits, ignore_index=True)
+
 # ==========================================
 # 4. 回測核心
 # ==========================================
@@ -593,40 +2035,214 @@ def calculate_forward_performance(df, signal_loc):
         results["持有天數"] = 0
     return results
 
-def check_signal_on_date(df, target_date_str, settings, strict_mode=True):
-    target_date = pd.to_datetime(target_date_str)
-    df_sorted = df.sort_index()
-    try:
-        target_loc = df_sorted.index.get_loc(target_date, method='nearest')
-        if target_loc < 60: return False, None, None
-        curr = df_sorted.iloc[target_loc]
-        prev = df_sorted.iloc[target_loc - 1]
-        strategy = settings['strategy']
-        
-        if (curr['Volume'] / 1000) < settings['vol_min']: return False, None, None
-        bias = 0
-        if strategy != '蜻蜓點水 (縮量回測)':
-            if pd.isna(curr['MA200']): return False, None, None
-            bias = ((curr['Close'] - curr['MA200']) / curr['MA200']) * 100
-            if strategy != '浴火重生 (假跌破)' and abs(bias) > settings['bias_range']: return False, None, None
-        
-        is_signal = False
-        if strategy == '籌碼衝鋒 (集中度高)':
-             if (curr['Close'] > curr['MA20']) and (curr['Volume'] > prev['Volume'] * 1.5) and (curr['Close'] > curr['Open']): is_signal = True
-        elif strategy == '蜻蜓點水 (縮量回測)':
-            if (curr['Close'] > curr['MA200']) and (curr['Low'] <= curr['MA200'] * 1.03) and (curr['Volume'] < curr['Volume_MA5']): is_signal = True
-        elif strategy == '浴火重生 (假跌破)':
-            if curr['Close'] > curr['MA200']:
-                past_7 = df_sorted.iloc[target_loc - 8 : target_loc] 
-                is_break = (past_7['Low'] < past_7['MA200']).any()
-                if is_break: is_signal = True
-        if is_signal: return True, round(bias, 2), target_loc
-        else: return False, None, None
-    except: return False, None, None
+# --- 向量化回測：整段歷史一次算出訊號與後續表現 ---
+# 訊號序列 (每一天是否觸發)，回傳 (bool 陣列, 乖離陣列)
+def compute_signal_series(df, settings, chip_net_buy=None):
+    n = len(df)
+    c, o, l, v = (df[col].to_numpy(dtype='float64') for col in ['Close', 'Open', 'Low', 'Volume'])
+    ma20, ma200, vma5 = (df[col].to_numpy(dtype='float64') for col in ['MA20', 'MA200', 'Volume_MA5'])
+    strategy = settings['strategy']
+    sig = np.arange(n) >= 60
+    sig &= ~((v / 1000) < settings['vol_min'])
+    bias = np.zeros(n)
+    if strategy != '蜻蜓點水 (縮量回測)':
+        sig &= ~np.isnan(ma200)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bias = np.where(np.isnan(ma200), 0.0, ((c - ma200) / ma200) * 100)
+        if strategy != '浴火重生 (假跌破)': sig &= ~(np.abs(bias) > settings['bias_range'])
+
+    if strategy == '籌碼衝鋒 (集中度高)':
+        prev_v = np.concatenate([[np.nan], v[:-1]])
+        proxy = (c > ma20) & (v > prev_v * 1.5) & (c > o)
+        if chip_net_buy is not None:
+            # 有歷史籌碼的日期用與即時掃描相同的集中度規則，其餘退回量能代理
+            net_buy = np.asarray(chip_net_buy, dtype='float64')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                concentration = np.where((net_buy > 0) & (v > 0), net_buy / v * 100.0, 0.0)
+            chip_rule = (c > ma20) & (concentration >= settings.get('chip_threshold', 10.0))
+            sig &= np.where(np.isnan(net_buy), proxy, chip_rule)
+        else: sig &= proxy
+    elif strategy == '蜻蜓點水 (縮量回測)':
+        sig &= (c > ma200) & (l <= ma200 * 1.03) & (v < vma5)
+    elif strategy == '浴火重生 (假跌破)':
+        # 前 8 根 K 棒內曾跌破年線
+        brk = np.concatenate([[0], np.cumsum(l < ma200)])
+        idx = np.arange(n)
+        sig &= (c > ma200) & ((brk[idx] - brk[np.maximum(idx - 8, 0)]) > 0)
+    else: sig[:] = False
+    return sig, bias
+
+# 每一天之後的波段最高價 (反向累積最大值)，同 calculate_forward_performance
+def compute_forward_performance(df):
+    n = len(df)
+    close = df['Close'].to_numpy(dtype='float64')
+    high = np.nan_to_num(df['High'].to_numpy(dtype='float64'), nan=-np.inf)
+    rev = high[::-1]
+    run_max = np.maximum.accumulate(rev)
+    prev_max = np.concatenate([[-np.inf], run_max[:-1]])
+    # 同值取最早出現的日期 (同 idxmax)
+    arg_rev = np.maximum.accumulate(np.where(rev >= prev_max, np.arange(n), 0))
+    suffix_max, suffix_arg = run_max[::-1], (n - 1 - arg_rev)[::-1]
+    fwd_max = np.append(suffix_max[1:], np.nan)
+    fwd_arg = np.append(suffix_arg[1:], -1)
+    has_future = np.isfinite(fwd_max)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gain = np.where(has_future & (close > 0), (fwd_max - close) / close * 100, 0.0)
+    dates = df.index.to_numpy()
+    peak_dates = np.where(has_future, dates[np.maximum(fwd_arg, 0)], dates)
+    hold_days = np.where(has_future, (peak_dates - dates) // np.timedelta64(1, 'D'), 0)
+    return np.round(gain, 2), peak_dates, has_future, hold_days.astype(int)
+
+# 單股回測 (可重複用於大量股票)，回傳每個訊號的進場與後續表現
+def run_vector_backtest(df, settings, search_start=0, chip_net_buy=None, revenue=None):
+    cols = ['訊號日期', '進場價', '乖離(%)', '波段最高漲幅(%)', '最高價日期', '持有天數']
+    if df is None or df.empty: return pd.DataFrame(columns=cols)
+    sig, bias = compute_signal_series(df, settings, chip_net_buy)
+    sig &= np.arange(len(df)) >= search_start
+    # 營收濾網：當時已公布的月營收 (未收錄的日期不過濾)
+    if revenue is not None:
+        yoy, streak = revenue['yoy'].to_numpy(), revenue['streak'].to_numpy()
+        with np.errstate(invalid='ignore'):
+            sig &= np.isnan(yoy) | ((yoy >= settings.get('min_revenue_yoy', -100)) & (streak >= settings.get('min_revenue_streak', 0)))
+    gain, peak_dates, has_future, hold_days = compute_forward_performance(df)
+    loc = np.flatnonzero(sig)
+    return pd.DataFrame({
+        '訊號日期': df.index[loc].strftime('%Y-%m-%d'),
+        '進場價': np.round(df['Close'].to_numpy(dtype='float64')[loc], 2),
+        '乖離(%)': np.round(bias[loc], 2),
+        '波段最高漲幅(%)': gain[loc],
+        '最高價日期': np.where(has_future[loc], pd.DatetimeIndex(peak_dates[loc]).strftime('%Y-%m-%d'), "N/A"),
+        '持有天數': hold_days[loc],
+    }, columns=cols)
+
+# --- 全市場歷史訊號研究 (多行程平行) ---
+STUDY_SHARD_SIZE = 50
+
+def _backtest_search_start(df, strategy):
+    if strategy == "蜻蜓點水 (縮量回測)": return max(260, 60)
+    first_valid = df['MA200'].first_valid_index()
+    return max(260, df.index.get_loc(first_valid)) if first_valid is not None else len(df)
+
+# 子行程：只讀本地快取，不連網
+def _study_worker(tickers, settings, strategies):
+    frames = []
+    for ticker in tickers:
+        try:
+            df = read_price_bars(ticker)
+            if df is None or len(df) <= 100: continue
+            df = add_technical_indicators(df)
+            chip_net_buy = get_chip_history(ticker.split('.')[0], df.index)
+            revenue = get_revenue_history(ticker.split('.')[0], df.index)
+            for strategy in strategies:
+                bt = run_vector_backtest(df, {**settings, 'strategy': strategy}, _backtest_search_start(df, strategy), chip_net_buy, revenue)
+                if bt.empty: continue
+                bt.insert(0, '代號', ticker.split('.')[0])
+                bt.insert(1, '策略', strategy)
+                frames.append(bt)
+        except: continue
+    return frames
+
+# 子行程以 spawn 啟動 (網頁伺服器是多執行緒，fork 可能卡在別的執行緒持有的鎖)；
+# 工作函式要能以模組名稱匯入 (streamlit run 時本檔是 __main__)，匯入失敗就退回執行緒池
+def _study_worker_importable():
+    try: return importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])._study_worker
+    except: return None
+
+# 分片平行跑全市場回測
+def run_signal_study(tickers, settings, strategies, max_workers=None, progress_cb=None):
+    shards = [tickers[i:i + STUDY_SHARD_SIZE] for i in range(0, len(tickers), STUDY_SHARD_SIZE)]
+    worker = _study_worker_importable()
+    if worker is not None:
+        pool = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+    else: worker, pool = _study_worker, ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+    frames = []
+    with pool:
+        futures = [pool.submit(worker, shard, settings, strategies) for shard in shards]
+        for done, fut in enumerate(as_completed(futures), start=1):
+            try: frames.extend(fut.result())
+            except: pass
+            if progress_cb: progress_cb(done, len(shards))
+    if not frames: return None
+    df_sig = pd.concat(frames, ignore_index=True)
+    df_sig['年度'] = df_sig['訊號日期'].str[:4]
+    df_sig = attach_security_info(df_sig, '代號', {'sector': '產業'})
+    return df_sig
+
+# 彙總：每策略一列 (訊號數、漲幅分佈、達標率、逐年次數)，另附產業達標率
+def summarize_signal_study(df_sig, target_gain=10.0):
+    df_sig = df_sig.assign(達標=df_sig['波段最高漲幅(%)'] >= target_gain)
+    g = df_sig.groupby('策略')
+    summary = pd.DataFrame({
+        '訊號數': g.size(),
+        '股票數': g['代號'].nunique(),
+        '平均最高漲幅(%)': g['波段最高漲幅(%)'].mean(),
+        'P25(%)': g['波段最高漲幅(%)'].quantile(0.25),
+        '中位數(%)': g['波段最高漲幅(%)'].median(),
+        'P75(%)': g['波段最高漲幅(%)'].quantile(0.75),
+        'P90(%)': g['波段最高漲幅(%)'].quantile(0.90),
+        '平均持有天數': g['持有天數'].mean(),
+        '達標率(%)': g['達標'].mean() * 100,
+    })
+    yearly = df_sig.pivot_table(index='策略', columns='年度', values='代號', aggfunc='size', fill_value=0)
+    yearly.columns = [f"{c}年訊號" for c in yearly.columns]
+    summary = summary.join(yearly).round(2).reset_index()
+    sector = df_sig.groupby(['策略', '產業']).agg(
+        訊號數=('代號', 'size'), 平均最高漲幅=('波段最高漲幅(%)', 'mean'), 達標率=('達標', 'mean')
+    ).reset_index()
+    sector['達標率'] = (sector['達標率'] * 100).round(1)
+    sector['平均最高漲幅'] = sector['平均最高漲幅'].round(2)
+    return summary, sector.sort_values(['策略', '達標率'], ascending=[True, False])
+
+# --- 策略實驗室：歷史紀錄持有至今 (每檔只讀一次快取，一次合併算損益) ---
+HOLDING_PERIODS = [5, 10, 20, 60]
+
+def simulate_history_positions(df_hist, max_workers=DEFAULT_FETCH_WORKERS, progress_cb=None):
+    entries = df_hist.drop_duplicates(subset=['代號', '篩選日期', '策略']).copy()
+    entries['代號'] = entries['代號'].astype(str)
+    close_col = pd.to_numeric(entries['收盤'], errors='coerce') if '收盤' in entries.columns else np.nan
+    entries['進場價'] = pd.to_numeric(entries['進場價'], errors='coerce').fillna(close_col) if '進場價' in entries.columns else close_col
+    entries['進場日'] = pd.to_datetime(entries['篩選日期'], errors='coerce')
+    entries = entries[(entries['進場價'] > 0) & entries['進場日'].notna()].reset_index(drop=True)
+    entries['pos_id'] = np.arange(len(entries))
+
+    # 同一檔不論出現幾天，只讀一次 (本地快取 + 增量更新)
+    tickers = (entries['代號'] + '.TW').unique().tolist()
+    closes = []
+    for done, (ticker, df) in enumerate(fetch_raw_data_bulk(tickers, period="2y", max_workers=max_workers), start=1):
+        if df is not None and not df.empty:
+            closes.append(pd.DataFrame({'代號': ticker.split('.')[0], 'Date': df.index, 'Close': df['Close'].to_numpy()}))
+        if progress_cb: progress_cb(done, len(tickers))
+    if not closes: return None, None
+    prices = pd.concat(closes, ignore_index=True)
+
+    # 進場紀錄 × 價格 一次合併：每筆持倉每天的損益路徑
+    path = entries[['pos_id', '代號', '策略', '進場日', '進場價']].merge(prices, on='代號')
+    path = path[path['Date'] >= path['進場日']].sort_values(['pos_id', 'Date'])
+    path['報酬率(%)'] = (path['Close'] - path['進場價']) / path['進場價'] * 100
+    path['持有日'] = path.groupby('pos_id').cumcount()
+    last = path.groupby('pos_id').tail(1).set_index('pos_id')
+    res = entries.set_index('pos_id').join(last[['Close', '報酬率(%)']], how='inner')
+    results = pd.DataFrame({
+        "策略": res['策略'], "代號": res['代號'], "名稱": res['名稱'],
+        "進場日期": res['篩選日期'], "進場價": res['進場價'].round(2),
+        "現價": res['Close'].round(2), "報酬率(%)": res['報酬率(%)'].round(2)
+    }).reset_index(drop=True)
+    return results, path
+
+# 等權持有所有訊號的權益曲線、最大回撤、固定持有天數報酬
+def summarize_strategy_path(path_s):
+    # 每筆持倉的日報酬 (進場當天相對進場價)，每天對當時持有中的部位取平均後連乘
+    path_s = path_s.sort_values(['pos_id', 'Date'])
+    day_ret = path_s.groupby('pos_id')['Close'].pct_change().fillna(path_s['Close'] / path_s['進場價'] - 1)
+    daily = day_ret.groupby(path_s['Date']).mean()
+    equity = (1 + daily).cumprod()
+    max_dd = ((equity / equity.cummax()) - 1).min() * 100 if not equity.empty else 0.0
+    holding = {f"持有{n}日": path_s.loc[path_s['持有日'] == n, '報酬率(%)'].mean() for n in HOLDING_PERIODS}
+    return equity.rename('權益'), max_dd, holding
 
 def plot_candlestick(df, signal_date_str, ticker):
     signal_date = pd.to_datetime(signal_date_str)
-    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.05, row_heights=[0.7, 0.3])
+    fig = plotly_subplots.make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.05, row_heights=[0.7, 0.3])
     fig.add_trace(go.Candlestick(
         x=df.index, open=df['Open'], high=df['High'], low=df['Low'], close=df['Close'],
         name='K線', increasing_line_color='#ef5350', decreasing_line_color='#26a69a'
@@ -648,476 +2264,952 @@ def plot_candlestick(df, signal_date_str, ticker):
     fig.update_layout(title=f"<b>{ticker}</b> 黑武士戰情圖", height=700, xaxis_rangeslider_visible=False)
     st.plotly_chart(fig, use_container_width=True)
 
+# ==========================================
+# 5. 掃描流程 (網頁 / 命令列 / 排程共用)
+# ==========================================
+
+# 下載 → 向量化篩選 → 命中股避雷；progress_cb(stage, done, total, ticker, stats)、on_hit(results)、log(msg) 皆可省略
+def run_market_scan(settings, progress_cb=None, on_hit=None, log=None):
+    strategies = settings.get('strategies') or [settings['strategy']]
+    settings = {**settings, 'strategy': settings.get('strategy', strategies[0])}
+    debug_stock = settings.get('debug_stock', "")
+    min_vol = settings['vol_min']
+    stats = {'universe': 0, 'candidates': 0, 'download_ok': 0, 'vol_ok': 0, 'hits': 0}
+    results = []
+    def report(stage, done, total, ticker=""):
+        if progress_cb: progress_cb(stage, done, total, ticker, stats)
+    def debug(ticker, msg):
+        if log and debug_stock and debug_stock in ticker: log(msg)
+
+    if on_hit:
+        render = on_hit
+        def on_hit(rows):
+            with profile_stage('scan.render'): render(rows)
+
+    report('prepare', 0, 1)
+    with profile_stage('scan.prepare'):
+        stock_list = get_tw_stock_list()
+        chip_map, _ = get_chip_data_snapshot()
+        rev_map, _ = get_revenue_data_snapshot()
+        if log and settings.get('min_revenue_streak', 0) > 0 and any(v.get('streak') is None for v in rev_map.values()):
+            log("⚠️ 營收資料庫無法使用 (只有單月營收)，本次略過「營收連續年增」濾網")
+        margin_map = get_margin_data_snapshot() if settings.get('exclude_margin_surge') else {}
+        snapshot, snapshot_date = get_market_snapshot()
+    # 快取先以收盤行情補到最新交易日，下載階段就不必逐檔呼叫 yfinance
+    with profile_stage('scan.snapshot_update'):
+        try: stats['snapshot_bars'] = update_price_store_from_snapshots()
+        except: stats['snapshot_bars'] = 0
+
+    # 0. 全市場快照初篩 (量能、紅K、融資、營收)，只下載還可能命中的股票
+    report('prefilter', 0, len(stock_list))
+    with profile_stage('scan.prefilter'):
+        if snapshot is not None and not snapshot_matches_last_bar(snapshot_date): snapshot = None
+        candidates = prefilter_scan_universe(stock_list, settings, snapshot, chip_map, rev_map, margin_map)
+    stats['universe'], stats['candidates'] = len(stock_list), len(candidates)
+    report('prefilter', len(stock_list), len(stock_list))
+    if debug_stock and log:
+        for t in stock_list:
+            if debug_stock in t and t not in candidates: log(f"❌ [診斷] {t} 未通過收盤行情初篩 ({snapshot_date})")
+    stock_list = candidates
+    total_stocks = len(stock_list)
+
+    # 1. 併發下載 + 量能初篩 (先到先收)
+    frames = {}
+    download_started = time.perf_counter()
+    for i, (ticker, df) in enumerate(fetch_raw_data_bulk(stock_list, period="2y", max_workers=settings.get('fetch_workers', DEFAULT_FETCH_WORKERS))):
+        report('download', i + 1, total_stocks, ticker)
+        if df is None: continue
+        stats['download_ok'] += 1
+        if df['Volume'].iloc[-1] < (min_vol * 1000): continue
+        stats['vol_ok'] += 1
+        frames[ticker] = df
+        if debug_stock and debug_stock in ticker:
+            debug(ticker, f"🔍 [診斷] {ticker} 策略檢查結果: {check_stock_strategy_web(add_technical_indicators(df.copy()), settings, ticker, chip_map)}")
+
+    record_timing('scan.download', time.perf_counter() - download_started)
+
+    # 2. 全市場向量化篩選 (一次算完指標與濾網)
+    report('screen', 0, 1)
+    with profile_stage('scan.screen'):
+        panel = build_price_panel(frames)
+        if panel is not None: compute_panel_indicators(panel)
+        hits = screen_panel_strategies(panel, settings, strategies, chip_map)
+    stats['hits'] = len(hits)
+    # 命中股基本面一次併發補齊，逐檔檢查時只讀記憶體
+    if not hits.empty:
+        report('fundamentals', 0, hits['ticker'].nunique())
+        with profile_stage('scan.fundamentals'): prefetch_fundamentals(hits['ticker'].unique())
+
+    # 3. 命中股逐檔避雷
+    filter_started = time.perf_counter()
+    for i, hit in enumerate(hits.itertuples(index=False)):
+        ticker = hit.ticker
+        code = ticker.split('.')[0]
+        report('filter', i + 1, len(hits), ticker)
+        if settings.get('exclude_margin_surge'):
+            m_change = margin_map.get(code, 0)
+            if m_change > 500:
+                debug(ticker, f"❌ 融資爆增 ({m_change}張) -> 剔除"); continue
+
+        # 營收檢查 (預設 -100 不過濾)
+        rev_data = rev_map.get(code, {'yoy': 0, 'mom': 0, 'streak': 0})
+        if rev_data['yoy'] < settings.get('min_revenue_yoy', -100):
+            debug(ticker, f"❌ 營收成長不足 ({rev_data['yoy']}%) -> 剔除"); continue
+        if rev_data.get('streak') is not None and rev_data['streak'] < settings.get('min_revenue_streak', 0):
+            debug(ticker, f"❌ 營收連續年增不足 ({rev_data['streak']}個月) -> 剔除"); continue
+
+        eps, pe, _ = get_stock_fundamentals_safe(ticker, allow_network=False)
+        if settings.get('exclude_negative_pe'):
+            if (eps is not None and eps < 0) or (pe is None):
+                debug(ticker, f"❌ 虧損股 (EPS {eps}) -> 剔除"); continue
+
+        if hit.策略 == "蜻蜓點水 (縮量回測)": bias = 0.0
+        elif pd.isna(hit.MA200): bias = 0.0
+        else: bias = ((hit.Close - hit.MA200) / hit.MA200) * 100
+        net_buy = int(chip_map.get(code, 0) / 1000) if chip_map else 0
+
+        results.append({
+            "代號": code, "名稱": get_stock_name(code), "產業": get_stock_sector(code),
+            "收盤": round(hit.Close, 2),
+            "乖離(%)": round(bias, 2), "量(張)": int(hit.Volume/1000),
+            "RSI": round(hit.RSI, 2),
+            "法人買超(張)": net_buy,
+            "營收年增(%)": rev_data['yoy'],
+            "營收月增(%)": rev_data['mom'],
+            "營收連增(月)": rev_data.get('streak'),
+            "EPS": eps if eps else "N/A",
+            "本益比": pe if pe else "N/A",
+            "資料日期": hit.資料日期, "策略": hit.策略, "籌碼狀態": hit.籌碼狀態
+        })
+        if on_hit: on_hit(results)
+    record_timing('scan.filter', time.perf_counter() - filter_started)
+    return results, stats
+
+# --- 盤中即時模式：日 K 面板最後加一列「今日進行中」K 棒，報價進來只改這一列 ---
+def _quote_number(x):
+    try:
+        v = float(str(x).replace(',', ''))
+        return v if v > 0 else np.nan
+    except: return np.nan
+
+# 報價來源介面：codes → DataFrame (index=代號；Open/High/Low/Close/Volume(股)/Time)
+def twstock_quotes(codes, batch_size=INTRADAY_BATCH_SIZE):
+    rows = {}
+    for i in range(0, len(codes), batch_size):
+        batch = list(codes[i:i + batch_size])
+        try:
+            with profile_stage('intraday.quote_batch'): data = twstock.realtime.get(batch)
+        except: continue
+        if not isinstance(data, dict) or not data.get('success'): continue
+        for code in batch:
+            q = data.get(code)
+            if not isinstance(q, dict) or not q.get('success'): continue
+            rt = q['realtime']
+            # 成交量單位為張；最近一筆沒有成交價時為 "-"，由上一次報價補
+            rows[code] = {'Open': _quote_number(rt.get('open')), 'High': _quote_number(rt.get('high')), 'Low': _quote_number(rt.get('low')),
+                          'Close': _quote_number(rt.get('latest_trade_price')), 'Volume': _quote_number(rt.get('accumulate_trade_volume')) * 1000,
+                          'Time': q['info'].get('time', "")}
+    return pd.DataFrame.from_dict(rows, orient='index', columns=['Open', 'High', 'Low', 'Close', 'Volume', 'Time'])
+
+# 替身報價 (測試 / 收盤後演練)：以前一日收盤加隨機走勢
+def make_replay_quote_source(prev_close, prev_volume, seed=None):
+    rng = np.random.default_rng(seed)
+    state = {'close': None, 'volume': np.zeros(len(prev_close)), 'high': None, 'low': None}
+    prev_close = pd.Series(prev_close, dtype='float64')
+    prev_volume = pd.Series(prev_volume, dtype='float64').reindex(prev_close.index).fillna(0)
+    open_p = prev_close.to_numpy() * (1 + rng.normal(0, 0.005, len(prev_close)))
+
+    def source(codes):
+        last = state['close'] if state['close'] is not None else open_p
+        close = last * (1 + rng.normal(0, 0.006, len(last)))
+        state['close'] = close
+        state['high'] = np.maximum(close, open_p) if state['high'] is None else np.maximum(state['high'], close)
+        state['low'] = np.minimum(close, open_p) if state['low'] is None else np.minimum(state['low'], close)
+        state['volume'] = state['volume'] + prev_volume.to_numpy() * rng.uniform(0.02, 0.08, len(close))
+        df = pd.DataFrame({'Open': open_p, 'High': state['high'], 'Low': state['low'], 'Close': close,
+                           'Volume': state['volume'].round(), 'Time': get_taiwan_time().strftime('%Y-%m-%d %H:%M:%S')}, index=prev_close.index)
+        return df.reindex([c for c in codes if c in df.index])
+    return source
+
+def get_quote_source(session, name=QUOTE_SOURCE):
+    if name == 'replay':
+        panel = session['panel']
+        return make_replay_quote_source(dict(zip(session['codes'], panel['Close'][-2])), dict(zip(session['codes'], panel['Volume'][-2])))
+    return twstock_quotes
+
+# 盤中面板：價格庫一次讀出完整日 K (今天以前) + 一列今日 K 棒 (報價前為 NaN)
+def build_intraday_session(tickers):
+    today = pd.Timestamp(get_taiwan_time().date())
+    try: update_price_store_from_snapshots()
+    except: pass
+    long_df = load_market_panel(tickers)
+    if long_df is None: return None
+    panel = build_price_panel(long_df[pd.to_datetime(long_df['Date']) < today], lookback=PANEL_LOOKBACK - 1)
+    if panel is None: return None
+    n = len(panel['tickers'])
+    for field in PANEL_FIELDS: panel[field] = np.vstack([panel[field], np.full((1, n), np.nan)])
+    panel['padding'] = np.vstack([panel['padding'], np.zeros((1, n), dtype=bool)])
+    panel['lookback'] += 1
+    panel['length'] = panel['length'] + 1
+    panel['last_date'] = np.full(n, today.to_datetime64())
+    compute_panel_indicators(panel)
+    return {'panel': panel, 'date': today, 'codes': [t.split('.')[0] for t in panel['tickers']],
+            'quoted': np.zeros(n, dtype=bool), 'quote_time': "", 'refreshed': None, 'quote_source': None}
+
+# 更新報價 → 只改今日那一列 → 只重算最後一列指標 → 重新篩選
+def refresh_intraday_session(session, settings, strategies, chip_map=None):
+    panel = session['panel']
+    if session['quote_source'] is None: session['quote_source'] = get_quote_source(session)
+    with profile_stage('intraday.quotes'): quotes = session['quote_source'](session['codes'])
+    cols = pd.Index(session['codes']).get_indexer(quotes.index)
+    quotes, cols = quotes[cols >= 0], cols[cols >= 0]
+    if len(cols):
+        for field in PANEL_FIELDS:
+            vals = quotes[field].to_numpy(dtype='float64')
+            panel[field][-1, cols] = np.where(np.isnan(vals), panel[field][-1, cols], vals)
+        session['quoted'][cols] |= ~np.isnan(panel['Close'][-1, cols])
+        session['quote_time'] = str(quotes['Time'].max())
+    with profile_stage('intraday.indicators'): refresh_panel_tail(panel, rows=1)
+    with profile_stage('intraday.screen'): hits = screen_panel_strategies(panel, settings, strategies, chip_map)
+    quoted = dict(zip(panel['tickers'], session['quoted']))
+    hits = hits[hits['ticker'].map(quoted).astype(bool) & (hits['Volume'] >= settings['vol_min'] * 1000)]
+    session['refreshed'] = get_taiwan_time()
+    prev_close = pd.Series(panel['Close'][-2], index=panel['tickers'])
+    return pd.DataFrame({
+        "代號": hits['ticker'].str.split('.').str[0], "名稱": hits['ticker'].str.split('.').str[0].map(get_security_master()['name_of']),
+        "策略": hits['策略'], "現價": hits['Close'].round(2),
+        "漲跌(%)": ((hits['Close'] / hits['ticker'].map(prev_close) - 1) * 100).round(2),
+        "量(張)": (hits['Volume'] / 1000).astype(int), "RSI": hits['RSI'].round(2), "籌碼狀態": hits['籌碼狀態']
+    }).reset_index(drop=True)
+
+def build_scan_report(results):
+    msg = f"\n🔥 黑武士戰報 ({get_taiwan_time().strftime('%m/%d')})\n"
+    strat_counts = Counter(r['策略'] for r in results)
+    msg += f"策略：{' / '.join(f'{k} {v}檔' for k, v in strat_counts.items())}\n發現：{len(results)} 檔\n"
+    for r in results[:3]:
+        msg += f"• {r['名稱']}({r['代號']}): {r['收盤']}元 / YoY {r['營收年增(%)']}%\n"
+    return msg
+
+def load_scan_config(path=SCAN_CONFIG_FILE):
+    config = dict(DEFAULT_SCAN_CONFIG)
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f: config.update(json.load(f))
+    config['strategies'] = [s for s in config['strategies'] if s in VALID_STRATEGIES] or list(VALID_STRATEGIES)
+    return config
+
+# 無介面掃描：結果寫入歷史 (取代當日同策略紀錄)，網頁端直接讀取
+def run_headless_scan(config, log=print):
+    started = time.time()
+    def progress(stage, done, total, ticker, stats):
+        if done == total or (stage == 'download' and done % 100 == 0):
+            log(f"[{stage}] {done}/{total} 下載OK: {stats['download_ok']} | 量能OK: {stats['vol_ok']} | 命中: {stats['hits']}")
+    results, stats = run_market_scan(config, progress_cb=progress, log=log)
+    save_to_history(results, replace_strategies=config['strategies'])
+    if results and config.get('line_token'): send_line_notify(config['line_token'], build_scan_report(results))
+    log(f"✅ 掃描完成：{len(results)} 檔，耗時 {time.time() - started:.0f} 秒")
+    return results
+
+def _load_scheduler_state():
+    try:
+        with open(SCHEDULER_STATE_FILE, encoding='utf-8') as f: return json.load(f)
+    except: return {}
+
+def _save_scheduler_state(state):
+    with open(SCHEDULER_STATE_FILE, 'w', encoding='utf-8') as f: json.dump(state, f, ensure_ascii=False)
+
+# 盤後排程：平日每個時段 (如 15:00 / 21:00) 當天只跑一次，錯過的時段開機後補跑
+def _parse_schedule_slots(slots, log=print):
+    parsed = []
+    for slot in slots:
+        try: parsed.append(datetime.strptime(str(slot).strip(), '%H:%M').time())
+        except ValueError: log(f"⚠️ 略過無效時段: {slot}")
+    return sorted(set(parsed))
+
+# 當日收盤行情：True 有資料 / False 查無資料 / None 無法判斷 (連線失敗、限流)
+def _has_trading_data(date_str):
+    try: data = fetch_mi_index(date_str, cacheable=False)
+    except: return None
+    if data.get('stat') == 'OK': return True
+    return False if TWSE_NO_DATA in str(data.get('stat', '')) else None
+
+def run_scheduler(config, log=print):
+    slots = _parse_schedule_slots(config['schedule'], log)
+    log(f"⏰ 排程啟動：平日 {', '.join(s.strftime('%H:%M') for s in slots)} 後執行 (休市日跳過)")
+    retry_at = None
+    while True:
+        now = get_taiwan_time()
+        state = _load_scheduler_state()
+        today = now.strftime('%Y-%m-%d')
+        due = [s.strftime('%H:%M') for s in slots if now.time() >= s]
+        if now.weekday() < 5 and due and state.get(today) not in (due[-1], 'holiday') and (retry_at is None or now >= retry_at):
+            trading = _has_trading_data(now.strftime('%Y%m%d'))
+            if trading is False and now.hour >= SCHEDULER_HOLIDAY_HOUR:
+                state[today] = 'holiday'
+                _save_scheduler_state(state)
+                log(f"💤 {today} 查無收盤行情，視為休市")
+            elif not trading:
+                retry_at = now + timedelta(minutes=SCHEDULER_DATA_RETRY_MINUTES)
+            else:
+                retry_at = None
+                log(f"▶️ {today} {due[-1]} 時段掃描")
+                try:
+                    get_chip_data_snapshot.clear(); get_margin_data_snapshot.clear()
+                    run_headless_scan(config, log=log)
+                    state[today] = due[-1]
+                    state['last_run'] = now.strftime('%Y-%m-%d %H:%M')
+                    _save_scheduler_state(state)
+                except Exception as e: log(f"❌ 掃描失敗: {e}")
+        time.sleep(SCHEDULER_POLL_SECONDS)
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(description="黑武士 無介面掃描 / 盤後排程")
+    parser.add_argument('command', choices=['scan', 'schedule'], help="scan: 立即掃描一次；schedule: 常駐盤後排程")
+    parser.add_argument('--config', default=SCAN_CONFIG_FILE, help="掃描設定檔 (JSON)")
+    parser.add_argument('--profile', help="掃描後將效能剖析寫入此 JSON 檔")
+    args = parser.parse_args(argv)
+    config = load_scan_config(args.config)
+    if args.command == 'scan':
+        run_headless_scan(config)
+        if args.profile:
+            with open(args.profile, 'w', encoding='utf-8') as f: json.dump(profiler_summary(), f, ensure_ascii=False, indent=2)
+    else: run_scheduler(config)
+    return 0
+
+def _running_in_streamlit():
+    try:
+        from streamlit import runtime
+        return runtime.exists()
+    except: return False
+
 # ==========================================
 # 6. 主程式
 # ==========================================
 
-try:
-    st.title("🔥 黑武士・全能戰情室")
+LIVE_COLUMN_CONFIG = {
+    "RSI": st.column_config.ProgressColumn("RSI", format="%d", min_value=0, max_value=100),
+    "營收年增(%)": st.column_config.NumberColumn("營收年增", format="%.1f%%"),
+    "營收連增(月)": st.column_config.NumberColumn("營收連增", format="%d 月"),
+}
+
+# 掃描即時畫面：進度與命中只在間隔到期時刷新 (刷新次數有上限，與命中數無關)；新命中只轉換新增的列再接上
+def make_live_scan_view(bar, status_text, table_slot, interval=LIVE_REFRESH_SECONDS, every=LIVE_REFRESH_EVERY):
+    view = {'last': 0.0, 'since': 0, 'stage': None, 'shown': 0, 'df': None, 'results': []}
+
+    def due(stage, done, total):
+        view['since'] += 1
+        now = time.monotonic()
+        if stage != view['stage'] or done >= total or now - view['last'] >= interval or view['since'] >= every:
+            view['stage'], view['last'], view['since'] = stage, now, 0
+            return True
+        return False
+
+    def flush_rows():
+        new_rows = view['results'][view['shown']:]
+        if not new_rows: return
+        batch = pd.DataFrame(new_rows)
+        # EPS / 本益比 可能是數字或 "N/A"，統一成字串，分批接上時欄位型別才一致
+        for col in ('EPS', '本益比'):
+            if col in batch.columns: batch[col] = batch[col].astype(str)
+        view['df'] = batch if view['df'] is None else pd.concat([view['df'], batch], ignore_index=True)
+        view['shown'] += len(new_rows)
+        table_slot.dataframe(view['df'].sort_values(by="RSI", ascending=False), column_config=LIVE_COLUMN_CONFIG, hide_index=True)
+
+    def progress(stage, done, total, ticker, stats):
+        if not due(stage, done, total): return
+        if stage == 'prepare': status_text.text("集氣中 (下載全市場籌碼、融資、營收、收盤行情)...")
+        elif stage == 'prefilter': status_text.text(f"🧹 收盤行情初篩... 全市場 {total} 檔 → 候選 {stats['candidates'] or '-'} 檔")
+        elif stage == 'download':
+            bar.progress(min(1.0, done / total))
+            status_text.text(f"🔥 掃描中... {ticker} | 候選: {stats['candidates']} | 下載OK: {stats['download_ok']} | 量能OK: {stats['vol_ok']}")
+        elif stage == 'screen': status_text.text(f"⚡ 向量化篩選中... 量能OK: {stats['vol_ok']} 檔")
+        elif stage == 'fundamentals': status_text.text(f"📥 補齊基本面... {total} 檔")
+        elif stage == 'filter':
+            status_text.text(f"🛡️ 避雷檢查中... 篩選命中: {total} | 檢查: {done}")
+            flush_rows()
+
+    def on_hit(results):
+        view['results'] = results
+
+    # 結束時補上尚未刷新的列
+    def finish(results):
+        view['results'] = results
+        flush_rows()
+        bar.progress(1.0)
+        status_text.text("✅ 掃描完成")
+
+    return progress, on_hit, finish
+
+def main():
+    rerun_started = time.perf_counter()
+    rerun_budget_slot = st.sidebar.empty()
+    # 剖析面板放在最後才畫，才能包含本次重跑 (含掃描) 的數據
+    profiler_slot = st.sidebar.empty()
+    try:
+        st.title("🔥 黑武士・全能戰情室")
     
-    m_temp = get_market_temperature()
-    if m_temp:
-        col_t1, col_t2 = st.columns(2)
-        col_t1.metric("📊 加權指數 (TWII)", m_temp['twii'], m_temp['twii_change'])
-        col_t2.metric("😰 恐慌指數 (VIX)", m_temp['vix'], m_temp['vix_change'], delta_color="inverse")
-    st.markdown("---")
-
-    st.sidebar.header("🔧 系統診斷 / 通知")
-    line_token = st.sidebar.text_input("🔔 Line Notify Token (選填)", type="password")
-
-    if st.sidebar.button("🗑️ 清除快取 (強制重抓)"):
-        import shutil
-        if os.path.exists(CACHE_DIR):
-            shutil.rmtree(CACHE_DIR)
-            os.makedirs(CACHE_DIR)
-        st.sidebar.success("快取已清空！")
-
-    if st.sidebar.button("🛠️ 測試連線"):
-        with st.sidebar.status("測試中..."):
-            try:
-                test_df = yf.Ticker("2330.TW").history(period="5d")
-                if not test_df.empty: st.write("✅ yfinance OK")
-                else: st.error("❌ yfinance Error")
+        m_temp = get_market_temperature()
+        if m_temp:
+            col_t1, col_t2 = st.columns(2)
+            col_t1.metric("📊 加權指數 (TWII)", m_temp['twii'], m_temp['twii_change'])
+            col_t2.metric("😰 恐慌指數 (VIX)", m_temp['vix'], m_temp['vix_change'], delta_color="inverse")
+        else: st.caption("⏳ 大盤資料更新中...")
+        st.markdown("---")
+
+        st.sidebar.header("🔧 系統診斷 / 通知")
+        line_token = st.sidebar.text_input("🔔 Line Notify Token (選填)", type="password")
+
+        if long_operation(st.sidebar.button("🗑️ 清除快取 (強制重抓)")):
+            import shutil
+            if os.path.exists(CACHE_DIR):
+                shutil.rmtree(CACHE_DIR)
+                os.makedirs(CACHE_DIR)
+            st.sidebar.success("快取已清空！")
+
+        if long_operation(st.sidebar.button("📦 匯入舊版 CSV 快取")):
+            with st.sidebar.status("匯入中..."):
+                n_migrated = migrate_csv_cache()
+            st.sidebar.success(f"已匯入 {n_migrated} 檔至 Parquet 價格庫")
+
+        if long_operation(st.sidebar.button("📅 以收盤行情更新快取")):
+            with st.sidebar.status("更新中...") as update_status:
+                n_bars = update_price_store_from_snapshots(progress_cb=lambda i, n, d: update_status.update(label=f"更新中... {d} ({i}/{n})"))
+            st.sidebar.success(f"已追加 {n_bars} 根 K 棒 (一次抓全市場收盤行情)" if n_bars else "快取已是最新")
+
+        if long_operation(st.sidebar.button("🧮 驗證指標快取 (完整重算比對)")):
+            with st.sidebar.status("驗證中..."):
+                checked, mismatched = 0, []
+                if os.path.isdir(PRICE_STORE_DIR):
+                    for part in sorted(os.listdir(PRICE_STORE_DIR)):
+                        ticker = part.split('=', 1)[-1]
+                        df_check = read_price_bars(ticker)
+                        if df_check is None or not has_indicator_state(df_check): continue
+                        ok, diffs = verify_indicator_state(df_check)
+                        checked += 1
+                        if not ok: mismatched.append(f"{ticker} {diffs}")
+                for m in mismatched[:20]: st.write(f"❌ {m}")
+            if mismatched: st.sidebar.warning(f"{len(mismatched)}/{checked} 檔不一致 (下次讀取時可清除快取重建)")
+            else: st.sidebar.success(f"✅ {checked} 檔指標與完整重算一致")
+
+        fund_progress = get_fundamentals_store()['progress']
+        if long_operation(st.sidebar.button("📥 背景預抓全市場基本面")):
+            if start_fundamentals_prefetch(get_tw_stock_list()): st.sidebar.success("已在背景開始預抓")
+            else: st.sidebar.info("預抓進行中")
+        if fund_progress is not None:
+            st.sidebar.caption(f"基本面預抓：{fund_progress[0]}/{fund_progress[1]}")
+
+        if long_operation(st.sidebar.button("🛠️ 測試連線")):
+            with st.sidebar.status("測試中..."):
+                try:
+                    test_df = yf.Ticker("2330.TW").history(period="5d")
+                    if not test_df.empty: st.write("✅ yfinance OK")
+                    else: st.error("❌ yfinance Error")
                 
-                rev_map, rev_date = get_revenue_data_snapshot()
-                if rev_map: st.write(f"✅ 營收數據 OK ({rev_date})")
-                else: st.warning("⚠️ 營收無資料")
+                    rev_map, rev_date = get_revenue_data_snapshot()
+                    if rev_map: st.write(f"✅ 營收數據 OK ({rev_date})")
+                    else: st.warning("⚠️ 營收無資料")
                 
-                chip_map, d = get_chip_data_snapshot()
-                if chip_map: st.write(f"✅ 籌碼 OK ({d})")
-                else: st.warning("⚠️ 籌碼無資料")
+                    chip_map, d = get_chip_data_snapshot()
+                    if chip_map: st.write(f"✅ 籌碼 OK ({d})")
+                    else: st.warning("⚠️ 籌碼無資料")
                 
-                margin_map = get_margin_data_snapshot()
-                if margin_map: st.write(f"✅ 融資 OK")
-                else: st.warning("⚠️ 融資無資料")
-            except Exception as e: st.error(f"Error: {e}")
-
-    st.sidebar.header("⚔️ 招式選擇")
-    strategy_mode = st.sidebar.selectbox("選擇策略：", VALID_STRATEGIES, index=0)
-    
-    note = ""
-    if strategy_mode == "籌碼衝鋒 (集中度高)": note = "★攻擊型：法人買超佔今日成交量 > 10%"
-    elif strategy_mode == "蜻蜓點水 (縮量回測)": note = "★防守型：量縮不破！回測年線3%內"
-    elif strategy_mode == "浴火重生 (假跌破)": note = "★反轉型：跌破年線後，強勢站回"
-    st.sidebar.info(f"💡 **邏輯**：{note}")
-
-    st.sidebar.markdown("---")
-    st.sidebar.header("🎯 進階濾網")
-    check_trend_high = st.sidebar.checkbox("✅ 前波曾創高 (60日高 > 年線5%)", value=False)
-    check_rsi_rising = st.sidebar.checkbox("✅ 動能轉強 (RSI > 昨日)", value=False)
-    vol_surge_check = st.sidebar.checkbox("✅ 量能增加 (Vol > 昨日)", value=False)
-    check_red_candle = st.sidebar.checkbox("✅ 必須收紅/有撐 (十字/下影)", value=False)
+                    margin_map = get_margin_data_snapshot()
+                    if margin_map: st.write(f"✅ 融資 OK")
+                    else: st.warning("⚠️ 融資無資料")
+                except Exception as e: st.error(f"Error: {e}")
+
+        st.sidebar.header("⚔️ 招式選擇")
+        strategy_mode = st.sidebar.selectbox("選擇策略：", VALID_STRATEGIES, index=0)
+        scan_all_strategies = st.sidebar.checkbox("⚡ 三策略一次掃描", value=False, help="下載與指標只算一次，同時找出三種策略的標的 (多重共振)")
+        scan_strategies = VALID_STRATEGIES if scan_all_strategies else [strategy_mode]
     
-    st.sidebar.markdown("---")
-    st.sidebar.header("🛡️ 避雷針")
-    exclude_negative_pe = st.sidebar.checkbox("✅ 剔除虧損股 (EPS<0 或 PE為負)", value=True)
-    exclude_margin_surge = st.sidebar.checkbox("✅ 剔除融資暴增 (散戶>500張)", value=False)
-    min_revenue_yoy = st.sidebar.number_input("📉 營收年增率 (YoY) > %", value=-100, step=10, help="預設 -100 表示不過濾")
+        note = ""
+        if strategy_mode == "籌碼衝鋒 (集中度高)": note = "★攻擊型：法人買超佔今日成交量 > 10%"
+        elif strategy_mode == "蜻蜓點水 (縮量回測)": note = "★防守型：量縮不破！回測年線3%內"
+        elif strategy_mode == "浴火重生 (假跌破)": note = "★反轉型：跌破年線後，強勢站回"
+        st.sidebar.info(f"💡 **邏輯**：{note}")
+
+        st.sidebar.markdown("---")
+        st.sidebar.header("🎯 進階濾網")
+        check_trend_high = st.sidebar.checkbox("✅ 前波曾創高 (60日高 > 年線5%)", value=False)
+        check_rsi_rising = st.sidebar.checkbox("✅ 動能轉強 (RSI > 昨日)", value=False)
+        vol_surge_check = st.sidebar.checkbox("✅ 量能增加 (Vol > 昨日)", value=False)
+        check_red_candle = st.sidebar.checkbox("✅ 必須收紅/有撐 (十字/下影)", value=False)
     
-    st.sidebar.markdown("---")
-    st.sidebar.header("⚙️ 基礎設定")
-    min_vol = st.sidebar.number_input("最低成交量 (張)", value=1000, step=100)
-    max_bias = st.sidebar.slider("乖離率範圍 (±%)", 0.1, 10.0, 5.0)
+        st.sidebar.markdown("---")
+        st.sidebar.header("🛡️ 避雷針")
+        exclude_negative_pe = st.sidebar.checkbox("✅ 剔除虧損股 (EPS<0 或 PE為負)", value=True)
+        exclude_margin_surge = st.sidebar.checkbox("✅ 剔除融資暴增 (散戶>500張)", value=False)
+        min_revenue_yoy = st.sidebar.number_input("📉 營收年增率 (YoY) > %", value=-100, step=10, help="預設 -100 表示不過濾")
+        min_revenue_streak = st.sidebar.number_input("📈 營收連續年增 ≥ 個月", min_value=0, max_value=REVENUE_HISTORY_MONTHS, value=0, step=1, help="0 表示不過濾")
     
-    chip_threshold = 10.0
-    if strategy_mode == "籌碼衝鋒 (集中度高)":
         st.sidebar.markdown("---")
-        chip_threshold = st.sidebar.slider("法人佔成交量 (%)", 5.0, 50.0, 10.0, 5.0)
-
-    settings = {
-        'strategy': strategy_mode, 'vol_surge': vol_surge_check, 
-        'check_rsi_rising': check_rsi_rising, 'check_trend_high': check_trend_high,
-        'check_red_candle': check_red_candle, 'chip_threshold': chip_threshold,
-        'vol_min': min_vol, 'bias_range': max_bias, 'chip_flow_surge': False 
-    }
+        st.sidebar.header("⚙️ 基礎設定")
+        min_vol = st.sidebar.number_input("最低成交量 (張)", value=1000, step=100)
+        max_bias = st.sidebar.slider("乖離率範圍 (±%)", 0.1, 10.0, 5.0)
+        fetch_workers = st.sidebar.number_input("下載併發數", min_value=1, max_value=64, value=DEFAULT_FETCH_WORKERS, step=1, help="同時下載的股票數，過高可能被 yfinance 限流")
     
-    debug_stock = st.sidebar.text_input("🕵️‍♂️ 診斷特定股票 (例: 2330)", "")
-
-    if st.sidebar.button("🗑️ 清空所有歷史"):
-        clear_history()
-        st.sidebar.success("已清空")
-        st.rerun() 
-
-    tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs(["🚀 今日掃描", "📜 歷史紀錄", "📊 基本面健診", "⏳ 單股回測", "📰 個股情報", "🚀 潛力雷達", "🌡️ 資金熱力圖", "🧪 策略實驗室"])
-
-    with tab1:
-        st.subheader(f"執行招式：{strategy_mode}")
-        if st.button("🔥 啟動掃描 (今日)", type="primary"):
-            stock_list = get_tw_stock_list()
-            results = []
-            chip_map = {}
-            margin_map = {}
-            rev_map = {}
-            
-            with st.spinner("集氣中 (下載全市場籌碼、融資、營收)..."):
-                chip_map, _ = get_chip_data_snapshot()
-                rev_map, _ = get_revenue_data_snapshot()
-                if exclude_margin_surge: margin_map = get_margin_data_snapshot()
-
-            bar = st.progress(0.0)
-            status_text = st.empty() 
-            live_result_placeholder = st.empty()
-            
-            scanned_count = 0
-            download_ok = 0
-            vol_ok = 0
-            total_stocks = len(stock_list)
-            
-            for i, ticker in enumerate(stock_list):
-                prog = min(1.0, (i + 1) / total_stocks)
-                bar.progress(prog)
-                status_text.text(f"🔥 掃描中... {ticker} | 下載OK: {download_ok} | 量能OK: {vol_ok} | 命中: {len(results)}")
-                
-                df = fetch_raw_data(ticker, period="2y") 
-                if df is None: continue
-                download_ok += 1
-                
-                if df['Volume'].iloc[-1] < (min_vol * 1000): continue
-                vol_ok += 1
-
-                df = add_technical_indicators(df)
-                if df is None: continue
-
-                match_result = check_stock_strategy_web(df, settings, ticker, chip_map)
-                
-                if debug_stock and debug_stock in ticker:
-                     st.write(f"🔍 [診斷] {ticker} 策略檢查結果: {match_result}")
-
-                if match_result:
-                    code = ticker.split('.')[0]
-                    # 5. 避雷針檢查
-                    if exclude_margin_surge:
-                        m_change = margin_map.get(code, 0)
-                        if m_change > 500:
-                             if debug_stock and debug_stock in ticker: st.write(f"❌ 融資爆增 ({m_change}張) -> 剔除")
-                             continue
-                    
-                    # 6. 營收檢查 (預設 -100 不過濾)
-                    rev_data = rev_map.get(code, {'yoy': 0, 'mom': 0})
-                    if rev_data['yoy'] < min_revenue_yoy:
-                        if debug_stock and debug_stock in ticker: st.write(f"❌ 營收成長不足 ({rev_data['yoy']}%) -> 剔除")
-                        continue
+        chip_threshold = 10.0
+        if "籌碼衝鋒 (集中度高)" in scan_strategies:
+            st.sidebar.markdown("---")
+            chip_threshold = st.sidebar.slider("法人佔成交量 (%)", 5.0, 50.0, 10.0, 5.0)
+
+        settings = {
+            'strategy': strategy_mode, 'vol_surge': vol_surge_check, 
+            'check_rsi_rising': check_rsi_rising, 'check_trend_high': check_trend_high,
+            'check_red_candle': check_red_candle, 'chip_threshold': chip_threshold,
+            'vol_min': min_vol, 'bias_range': max_bias, 'chip_flow_surge': False,
+            'strategies': scan_strategies, 'fetch_workers': fetch_workers,
+            'exclude_negative_pe': exclude_negative_pe, 'exclude_margin_surge': exclude_margin_surge,
+            'min_revenue_yoy': min_revenue_yoy, 'min_revenue_streak': min_revenue_streak
+        }
+    
+        debug_stock = st.sidebar.text_input("🕵️‍♂️ 診斷特定股票 (例: 2330)", "")
+        settings['debug_stock'] = debug_stock
+
+        if long_operation(st.sidebar.button("🗑️ 清空所有歷史")):
+            clear_history()
+            st.sidebar.success("已清空")
+            st.rerun() 
+
+        tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs(["🚀 今日掃描", "📜 歷史紀錄", "📊 基本面健診", "⏳ 單股回測", "📰 個股情報", "🚀 潛力雷達", "🌡️ 資金熱力圖", "🧪 策略實驗室"])
+
+        with tab1:
+            st.subheader(f"執行招式：{' + '.join(scan_strategies) if scan_all_strategies else strategy_mode}")
+            # 排程已跑過的結果直接顯示，不必在網頁上重掃
+            today_str = get_taiwan_time().strftime('%Y-%m-%d')
+            df_precomputed = load_history(date=today_str, strategies=scan_strategies)
+            if df_precomputed is not None and not df_precomputed.empty:
+                last_run = _load_scheduler_state().get('last_run')
+                with st.expander(f"📦 今日已完成的掃描結果 ({len(df_precomputed)} 檔{'，排程 ' + last_run if last_run else ''})", expanded=True):
+                    st.dataframe(df_precomputed.sort_values(by="RSI", ascending=False), hide_index=True,
+                                 column_config={"RSI": st.column_config.ProgressColumn("RSI", format="%d", min_value=0, max_value=100)})
+
+            if long_operation(st.button("🔥 啟動掃描 (今日)", type="primary")):
+                bar = st.progress(0.0)
+                status_text = st.empty() 
+                live_result_placeholder = st.empty()
 
-                    eps, pe, _ = get_stock_fundamentals_safe(ticker)
-                    
-                    if exclude_negative_pe:
-                        if (eps is not None and eps < 0) or (pe is None):
-                             if debug_stock and debug_stock in ticker: st.write(f"❌ 虧損股 (EPS {eps}) -> 剔除")
-                             continue
-                    
-                    is_match, chip_msg = match_result
-                    curr = df.iloc[-1]
-                    if strategy_mode == "蜻蜓點水 (縮量回測)": bias = 0.0
-                    elif pd.isna(curr['MA200']): bias = 0.0
-                    else: bias = ((curr['Close'] - curr['MA200']) / curr['MA200']) * 100
-                    
-                    name = get_stock_name(code)
-                    sector = get_stock_sector(code)
-                    net_buy = int(chip_map.get(code, 0) / 1000) if chip_map else 0
-                    
-                    results.append({
-                        "代號": code, "名稱": name, "產業": sector,
-                        "收盤": round(curr['Close'], 2), 
-                        "乖離(%)": round(bias, 2), "量(張)": int(curr['Volume']/1000),
-                        "RSI": round(curr['RSI'], 2),
-                        "法人買超(張)": net_buy,
-                        "營收年增(%)": rev_data['yoy'],
-                        "營收月增(%)": rev_data['mom'],
-                        "EPS": eps if eps else "N/A",
-                        "本益比": pe if pe else "N/A",
-                        "資料日期": df.index[-1].strftime('%Y-%m-%d'), "策略": strategy_mode, "籌碼狀態": chip_msg
-                    })
-                    
-                    live_df = pd.DataFrame(results).sort_values(by="RSI", ascending=False)
-                    live_result_placeholder.dataframe(
-                        live_df,
-                        column_config={
-                            "RSI": st.column_config.ProgressColumn("RSI", format="%d", min_value=0, max_value=100),
-                            "營收年增(%)": st.column_config.NumberColumn("營收年增", format="%.1f%%"),
-                        },
-                        hide_index=True
-                    )
-            
-            bar.progress(1.0)
-            status_text.text("✅ 掃描完成")
-            if results:
-                st.success(f"掃描完成！發現 {len(results)} 個目標！")
-                save_to_history(results)
+                scan_progress, scan_hit, finish_live_view = make_live_scan_view(bar, status_text, live_result_placeholder)
+                results, _ = run_market_scan(settings, progress_cb=scan_progress, on_hit=scan_hit, log=st.write)
+                finish_live_view(results)
+                if results:
+                    st.success(f"掃描完成！發現 {len(results)} 個目標！")
+                    save_to_history(results)
                 
-                if line_token:
-                    msg = f"\n🔥 黑武士戰報 ({get_taiwan_time().strftime('%m/%d')})\n"
-                    msg += f"策略：{strategy_mode}\n發現：{len(results)} 檔\n"
-                    for r in results[:3]:
-                        msg += f"• {r['名稱']}({r['代號']}): {r['收盤']}元 / YoY {r['營收年增(%)']}%\n"
-                    send_line_notify(line_token, msg)
-                    st.toast("Line 通知已發送")
-            else: 
-                st.warning("今日無目標。建議使用側邊欄【診斷工具】檢查連線。")
-
-    with tab2:
-        st.header("📜 歷史紀錄 (策略分類版)")
-        df_hist = load_history()
+                    if line_token:
+                        send_line_notify(line_token, build_scan_report(results))
+                        st.toast("Line 通知已發送")
+                else: 
+                    st.warning("今日無目標。建議使用側邊欄【診斷工具】檢查連線。")
+
+            st.markdown("---")
+            if st.toggle("⏱️ 盤中即時模式", help="以即時報價更新今日 K 棒，每隔幾分鐘重新篩選 (只讀本地快取，不重新下載歷史)"):
+                refresh_minutes = st.number_input("更新間隔 (分鐘)", min_value=1, max_value=30, value=INTRADAY_REFRESH_MINUTES, step=1)
+                st.fragment(run_every=timedelta(minutes=refresh_minutes))(render_intraday_view)(settings, scan_strategies)
+
+        with tab2:
+            st.header("📜 歷史紀錄 (策略分類版)")
+            n_dates = count_history_dates()
         
-        if df_hist is not None and not df_hist.empty:
-            unique_dates = sorted(df_hist['篩選日期'].unique(), reverse=True)
-            for i, date_str in enumerate(unique_dates):
-                is_expanded = (i == 0)
-                with st.expander(f"📅 {date_str} 掃描紀錄", expanded=is_expanded):
-                    df_day = df_hist[df_hist['篩選日期'] == date_str].copy()
-                    df_grouped = df_day.groupby(['代號', '名稱']).agg({
-                        '策略': lambda x: list(x),
-                        '收盤': 'last', 'RSI': 'last', '產業': 'last', 
-                        '法人買超(張)': 'last', '營收年增(%)': 'last'
-                    }).reset_index()
-                    df_grouped['策略數'] = df_grouped['策略'].apply(len)
+            if n_dates > 0:
+                n_pages = (n_dates + HISTORY_PAGE_DATES - 1) // HISTORY_PAGE_DATES
+                page = st.number_input(f"頁次 (共 {n_pages} 頁 / {n_dates} 天)", min_value=1, max_value=n_pages, value=1, step=1)
+                page_dates = get_history_dates(limit=HISTORY_PAGE_DATES, offset=(page - 1) * HISTORY_PAGE_DATES)
+                for i, date_str in enumerate(page_dates):
+                    is_expanded = (i == 0 and page == 1)
+                    with st.expander(f"📅 {date_str} 掃描紀錄", expanded=is_expanded):
+                        df_day = load_history(date=date_str)
+                        df_grouped = df_day.groupby(['代號', '名稱']).agg({
+                            '策略': lambda x: list(x),
+                            '收盤': 'last', 'RSI': 'last', '產業': 'last', 
+                            '法人買超(張)': 'last', '營收年增(%)': 'last'
+                        }).reset_index()
+                        df_grouped['策略數'] = df_grouped['策略'].apply(len)
                     
-                    multi_hits = df_grouped[df_grouped['策略數'] > 1].copy()
-                    if not multi_hits.empty:
-                        multi_hits['符合策略'] = multi_hits['策略'].apply(lambda x: ", ".join(x))
-                        st.markdown("#### 🔥 多重共振 (同時符合2種以上)")
-                        st.dataframe(multi_hits.drop(columns=['策略', '策略數']), hide_index=True,
-                                     column_config={"RSI": st.column_config.ProgressColumn("RSI", min_value=0, max_value=100, format="%d")})
+                        multi_hits = df_grouped[df_grouped['策略數'] > 1].copy()
+                        if not multi_hits.empty:
+                            multi_hits['符合策略'] = multi_hits['策略'].apply(lambda x: ", ".join(x))
+                            st.markdown("#### 🔥 多重共振 (同時符合2種以上)")
+                            st.dataframe(multi_hits.drop(columns=['策略', '策略數']), hide_index=True,
+                                         column_config={"RSI": st.column_config.ProgressColumn("RSI", min_value=0, max_value=100, format="%d")})
                     
-                    st.markdown("#### ⚔️ 單一策略分類")
-                    cols = st.columns(3)
-                    for idx, strat in enumerate(VALID_STRATEGIES):
-                        with cols[idx]:
-                            st.write(f"**{strat}**")
-                            df_s = df_day[df_day['策略'] == strat].copy()
-                            if not df_s.empty:
-                                st.dataframe(
-                                    df_s[['代號', '名稱', '產業', '收盤', 'RSI', '營收年增(%)']], 
-                                    hide_index=True,
-                                    column_config={"RSI": st.column_config.ProgressColumn("RSI", min_value=0, max_value=100, format="%d")}
-                                )
-                            else: st.caption("無資料")
-        else: st.info("尚無紀錄")
-
-    with tab3:
-        st.header("📊 個股基本面健診")
-        c_fund, _ = st.columns([1,2])
-        fund_ticker = c_fund.text_input("輸入代號 (例如 2330)", "")
-        if c_fund.button("查詢基本面"):
-             if fund_ticker:
-                 eps, pe, roe = get_stock_fundamentals_safe(fund_ticker)
-                 if eps is not None:
-                     col_a, col_b, col_c = st.columns(3)
-                     col_a.metric("每股盈餘 (EPS)", f"{eps} 元")
-                     col_b.metric("本益比 (PE)", f"{pe} 倍")
-                     col_c.metric("股東權益報酬率 (ROE)", f"{round(roe*100, 2)}%" if roe else "N/A")
-                     st.success(f"{fund_ticker} 數據獲取成功")
-                 else: st.error("查無數據")
-
-    with tab4:
-        st.header("⏳ 黑武士 - 時光回溯")
-        c1, c2 = st.columns([1, 2])
-        target_stock = c1.text_input("輸入代號 (回測用)", "2330")
-        if c1.button("開始回測"):
-            clean_sid = target_stock.replace(".TW", "").replace(".TWO", "").strip()
-            ticker = f"{clean_sid}.TW"
-            with st.spinner(f"正在回溯 {ticker} 過去 5 年走勢..."):
-                df = fetch_stock_data(ticker, period="5y")
-            if df is not None and len(df) > 100:
-                signals = []
-                results = []
-                search_start = max(260, 60) if strategy_mode == "蜻蜓點水 (縮量回測)" else max(260, df.index.get_loc(df['MA200'].first_valid_index()))
-                for i in range(search_start, len(df)):
-                    d_str = df.index[i].strftime('%Y-%m-%d')
-                    is_sig, bias, loc = check_signal_on_date(df, d_str, settings, strict_mode=True)
-                    if is_sig:
-                        signals.append(d_str)
-                        ret = calculate_forward_performance(df, loc)
-                        price = df.iloc[loc]['Close']
-                        results.append({
-                            "訊號日期": d_str, "進場價": round(price, 2),
-                            "波段最高漲幅": f"{ret['波段最高漲幅(%)']}%",
-                            "最高價日期": ret['最高價日期'], "持有天數": ret['持有天數']
-                        })
-                if results:
-                    st.success(f"回測完成！共出現 {len(results)} 次買點。")
-                    res_df = pd.DataFrame(results)
-                    res_df['漲幅數值'] = res_df['波段最高漲幅'].str.replace('%','').astype(float)
-                    res_df = res_df.sort_values('漲幅數值', ascending=False).drop(columns=['漲幅數值'])
-                    st.dataframe(res_df)
-                    selected_date = st.selectbox("選擇日期查看當時 K 線", signals)
-                    plot_candlestick(df, selected_date, clean_sid)
-                else: st.warning("無符合訊號。")
-            else: st.error("資料不足或無法下載。")
-
-    with tab5:
-        st.header("📰 個股與產業情報")
-        col1, col2 = st.columns(2)
-        with col1:
-            st.subheader("🔥 個股/產業動態")
-            if st.button("更新情報"):
-                news_list, keywords = get_all_market_news()
-                if news_list:
-                    if keywords:
-                        kw_count = Counter(keywords).most_common(5)
-                        kw_text = " ".join([f"#{k[0]}" for k in kw_count])
-                        st.info(f"熱點: {kw_text}")
-                    for n in news_list:
-                        st.markdown(f"""
-                        <div style="padding: 10px; border-bottom: 1px solid #ddd;">
-                            <span style="color:gray; font-size:12px;">[{n['來源']}]</span><br>
-                            <a href="{n['連結']}" target="_blank" style="font-size: 16px; font-weight:bold;">{n['標題']}</a>
-                        </div>
-                        """, unsafe_allow_html=True)
-                else: st.warning("暫無相關新聞")
-        with col2:
-            st.subheader("💰 資金流向 (動態變化)")
-            if st.button("更新資金流向"):
-                main_s, flow_in, flow_out, d_date = get_twse_sector_flow_dynamic()
-                if main_s is not None:
-                    st.success(f"資料日期: {d_date} (比較昨日變化)")
-                    st.write("📈 **資金湧入 (變動率 +%)**")
-                    st.dataframe(flow_in, hide_index=True)
-                    st.write("📉 **資金撤退 (變動率 -%)**")
-                    st.dataframe(flow_out, hide_index=True)
-                    st.write("📊 **主流板塊 (成交金額最大)**")
-                    st.dataframe(main_s, hide_index=True)
-                else: st.error(f"無法取得資料: {d_date}")
-        st.markdown("---")
-        st.subheader("🏆 法人掃貨榜 (智慧標籤)")
-        if st.button("查看法人買超"):
-            rank_df, date_str = get_institutional_ranking_smart()
-            if rank_df is not None:
-                st.success(f"資料日期: {date_str}")
-                st.dataframe(rank_df, hide_index=True)
-            else: st.error(f"無法取得資料: {date_str}")
-
-    with tab6:
-        st.header("🚀 潛力飆股雷達")
-        if st.button("啟動雷達偵測"):
-            with st.spinner("交叉比對中..."):
-                _, flow_in, _, _ = get_twse_sector_flow_dynamic()
-                rank_df, _ = get_institutional_ranking_smart()
-                news_list, _ = get_all_market_news()
-                if flow_in is not None and rank_df is not None:
-                    st.success("✅ 分析完成")
-                    hot_sectors = flow_in['分類指數名稱'].tolist()
-                    st.write(f"🔥 強勢板塊：{', '.join(hot_sectors)}")
-                    matches = []
-                    for index, row in rank_df.iterrows():
-                        stock_name = row['名稱']
-                        stock_status = row['狀態']
-                        related_news = []
+                        st.markdown("#### ⚔️ 單一策略分類")
+                        cols = st.columns(3)
+                        for idx, strat in enumerate(VALID_STRATEGIES):
+                            with cols[idx]:
+                                st.write(f"**{strat}**")
+                                df_s = df_day[df_day['策略'] == strat].copy()
+                                if not df_s.empty:
+                                    st.dataframe(
+                                        df_s[['代號', '名稱', '產業', '收盤', 'RSI', '營收年增(%)']], 
+                                        hide_index=True,
+                                        column_config={"RSI": st.column_config.ProgressColumn("RSI", min_value=0, max_value=100, format="%d")}
+                                    )
+                                else: st.caption("無資料")
+            else: st.info("尚無紀錄")
+
+        with tab3:
+            st.header("📊 個股基本面健診")
+            c_fund, _ = st.columns([1,2])
+            fund_ticker = c_fund.text_input("輸入代號 (例如 2330)", "")
+            if long_operation(c_fund.button("查詢基本面")):
+                 if fund_ticker:
+                     eps, pe, roe = get_stock_fundamentals_safe(fund_ticker)
+                     if eps is not None:
+                         col_a, col_b, col_c = st.columns(3)
+                         col_a.metric("每股盈餘 (EPS)", f"{eps} 元")
+                         col_b.metric("本益比 (PE)", f"{pe} 倍")
+                         col_c.metric("股東權益報酬率 (ROE)", f"{round(roe*100, 2)}%" if roe else "N/A")
+                         st.success(f"{fund_ticker} 數據獲取成功")
+                     else: st.error("查無數據")
+
+        with tab4:
+            st.header("⏳ 黑武士 - 時光回溯")
+            c1, c2 = st.columns([1, 2])
+            target_stock = c1.text_input("輸入代號 (回測用)", "2330")
+            if long_operation(c1.button("開始回測")):
+                clean_sid = target_stock.replace(".TW", "").replace(".TWO", "").strip()
+                ticker = f"{clean_sid}.TW"
+                with st.spinner(f"正在回溯 {ticker} 過去 5 年走勢..."):
+                    df = fetch_stock_data(ticker, period="5y")
+                if df is not None and len(df) > 100:
+                    search_start = _backtest_search_start(df, strategy_mode)
+                    chip_net_buy = get_chip_history(clean_sid, df.index)
+                    if strategy_mode == "籌碼衝鋒 (集中度高)":
+                        if chip_net_buy is not None and chip_net_buy.notna().any():
+                            st.caption(f"🗄️ 籌碼資料庫涵蓋 {int(chip_net_buy.notna().sum())} 個交易日 (其餘日期以量能代理)")
+                        else: st.caption("⚠️ 無歷史籌碼，以量能代理 (可於下方回補籌碼資料庫)")
+                    revenue = get_revenue_history(clean_sid, df.index)
+                    if revenue is not None and (settings.get('min_revenue_yoy', -100) > -100 or settings.get('min_revenue_streak', 0) > 0):
+                        st.caption(f"🗄️ 營收濾網以當時已公布月營收回測 (涵蓋 {int(revenue['yoy'].notna().sum())} 個交易日)")
+                    bt = run_vector_backtest(df, settings, search_start, chip_net_buy, revenue)
+                    signals = bt['訊號日期'].tolist()
+                    results = [{
+                        "訊號日期": r['訊號日期'], "進場價": r['進場價'],
+                        "波段最高漲幅": f"{r['波段最高漲幅(%)']}%",
+                        "最高價日期": r['最高價日期'], "持有天數": r['持有天數']
+                    } for r in bt.to_dict('records')]
+                    if results:
+                        st.success(f"回測完成！共出現 {len(results)} 次買點。")
+                        res_df = pd.DataFrame(results)
+                        res_df['漲幅數值'] = res_df['波段最高漲幅'].str.replace('%','').astype(float)
+                        res_df = res_df.sort_values('漲幅數值', ascending=False).drop(columns=['漲幅數值'])
+                        st.dataframe(res_df)
+                        selected_date = st.selectbox("選擇日期查看當時 K 線", signals)
+                        plot_candlestick(df, selected_date, clean_sid)
+                    else: st.warning("無符合訊號。")
+                else: st.error("資料不足或無法下載。")
+
+            with st.expander("🗄️ 籌碼 / 融資歷史資料庫 (T86 + MI_MARGN)"):
+                t86_archive = get_chip_matrix('t86')
+                if t86_archive is not None and not t86_archive.empty:
+                    st.caption(f"已收錄 {len(t86_archive)} 個交易日：{t86_archive.index.min():%Y-%m-%d} ~ {t86_archive.index.max():%Y-%m-%d}")
+                else: st.caption("尚未建立")
+                c_b1, c_b2 = st.columns(2)
+                bf_start = c_b1.date_input("回補起日", value=get_taiwan_time().date() - timedelta(days=365))
+                bf_end = c_b2.date_input("回補迄日", value=get_taiwan_time().date())
+                if long_operation(st.button("開始回補 (可中斷續傳)")):
+                    bf_bar = st.progress(0.0)
+                    n_tasks = backfill_chip_archive(bf_start, bf_end, progress_cb=lambda done, total: bf_bar.progress(done / total))
+                    bf_bar.progress(1.0)
+                    st.success(f"回補完成：處理 {n_tasks} 個日期 × 資料集")
+
+            with st.expander("🗄️ 月營收資料庫 (MOPS)"):
+                revenue_matrices = get_revenue_matrices()
+                if revenue_matrices is not None:
+                    rev_months = revenue_matrices['yoy'].index
+                    st.caption(f"已收錄 {len(rev_months)} 個月：{rev_months.min():%Y-%m} ~ {rev_months.max():%Y-%m}")
+                else: st.caption("尚未建立")
+                rev_n_months = st.number_input("回補月數", min_value=3, max_value=60, value=REVENUE_HISTORY_MONTHS, step=1)
+                if long_operation(st.button("開始回補月營收")):
+                    rev_bar = st.progress(0.0)
+                    n_months = backfill_revenue_archive(rev_n_months, progress_cb=lambda done, total: rev_bar.progress(done / total))
+                    rev_bar.progress(1.0)
+                    get_revenue_data_snapshot.clear()
+                    st.success(f"回補完成：更新 {n_months} 個月")
+
+            st.markdown("---")
+            st.subheader("🌐 全市場歷史訊號研究")
+            st.caption("以本地快取資料對全上市股票回測 (多核心平行)，快取越長可研究的年份越多。")
+            c_s1, c_s2 = st.columns([2, 1])
+            study_strategies = c_s1.multiselect("研究策略", VALID_STRATEGIES, default=VALID_STRATEGIES)
+            target_gain = c_s2.number_input("達標漲幅 (%)", value=10.0, step=5.0)
+            if long_operation(st.button("開始全市場研究")) and study_strategies:
+                study_bar = st.progress(0.0)
+                study_text = st.empty()
+                def _study_progress(done, total):
+                    study_bar.progress(done / total)
+                    study_text.text(f"⚙️ 研究中... 分片 {done}/{total} (使用 {os.cpu_count()} 核心)")
+                df_sig = run_signal_study(get_tw_stock_list(), settings, study_strategies, progress_cb=_study_progress)
+                study_bar.progress(1.0)
+                if df_sig is not None:
+                    summary, sector = summarize_signal_study(df_sig, target_gain)
+                    study_text.text(f"✅ 研究完成：{df_sig['代號'].nunique()} 檔、{len(df_sig)} 個訊號")
+                    st.write("📋 **策略總表**")
+                    st.dataframe(summary, hide_index=True)
+                    fig = px.histogram(df_sig, x='波段最高漲幅(%)', color='策略', nbins=60, barmode='overlay', title="波段最高漲幅分佈")
+                    st.plotly_chart(fig, use_container_width=True)
+                    st.write("🏭 **產業達標率**")
+                    st.dataframe(sector, hide_index=True)
+                else: study_text.text("⚠️ 無訊號 (請先執行掃描建立本地快取)")
+
+        with tab5:
+            st.header("📰 個股與產業情報")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.subheader("🔥 個股/產業動態")
+                if long_operation(st.button("更新情報")):
+                    news_list, keywords = get_all_market_news()
+                    if news_list:
+                        if keywords:
+                            kw_count = Counter(keywords).most_common(5)
+                            kw_text = " ".join([f"#{k[0]}" for k in kw_count])
+                            st.info(f"熱點: {kw_text}")
                         for n in news_list:
-                            if stock_name in n['標題']: related_news.append(n['標題'])
-                        if "爆買" in stock_status or ("連買" in stock_status and len(related_news) > 0):
-                            matches.append({
-                                "代號": row['代號'], "名稱": stock_name,
-                                "狀態": stock_status,
-                                "新聞佐證": related_news[0] if related_news else "無",
-                                "強度": "⭐⭐⭐" if "爆買" in stock_status else "⭐⭐"
-                            })
-                    if matches: st.dataframe(pd.DataFrame(matches))
-                    else: st.warning("無明顯共振訊號")
-                else: st.error("數據不足")
-
-    with tab7:
-        st.header("🌡️ 全台股市資金熱力圖 (Max版)")
-        st.info("方塊大小 = 成交金額 | 顏色 = 漲跌幅 | 高度已調整為 1200px")
-        if st.button("生成熱力圖"):
-            with st.spinner("正在抓取全市場數據..."):
-                df_heat, date_str = get_tw_market_heatmap_data()
-            if df_heat is not None:
-                st.success(f"資料日期: {date_str} (前400大成交股)")
-                fig = px.treemap(
-                    df_heat,
-                    path=['產業', '標籤'],
-                    values='成交金額',
-                    color='漲跌幅%',
-                    color_continuous_scale=['#00da3c', '#ffffff', '#ff0000'],
-                    color_continuous_midpoint=0,
-                    range_color=[-10, 10],
-                    title=f"台股資金熱力圖 (細分族群版) - {date_str}"
-                )
-                fig.update_layout(width=1200, height=900, margin=dict(t=50, l=10, r=10, b=10))
-                fig.update_traces(textinfo="label+value", textfont_size=20)
-                st.plotly_chart(fig, use_container_width=True)
-            else: st.error("無法取得熱力圖數據")
-
-    with tab8:
-        st.header("🧪 策略實驗室 (模擬持有至今)")
-        st.info("系統將讀取歷史紀錄，模擬「若當初買進持有到今天」的績效。")
+                            st.markdown(f"""
+                            <div style="padding: 10px; border-bottom: 1px solid #ddd;">
+                                <span style="color:gray; font-size:12px;">[{n['來源']}]</span><br>
+                                <a href="{n['連結']}" target="_blank" style="font-size: 16px; font-weight:bold;">{n['標題']}</a>
+                            </div>
+                            """, unsafe_allow_html=True)
+                    else: st.warning("暫無相關新聞")
+            with col2:
+                st.subheader("💰 資金流向 (動態變化)")
+                flow_window = st.radio("比較區間", (1,) + SECTOR_FLOW_WINDOWS, format_func=lambda n: "昨日" if n == 1 else f"{n}日", horizontal=True, key="flow_window")
+                if long_operation(st.button("更新資金流向")):
+                    main_s, flow_in, flow_out, d_date = get_twse_sector_flow_dynamic(flow_window)
+                    if main_s is not None:
+                        st.success(f"資料日期: {d_date} (比較{'昨日' if flow_window == 1 else f'{flow_window}日'}變化)")
+                        st.write("📈 **資金湧入 (變動率 +%)**")
+                        st.dataframe(flow_in, hide_index=True)
+                        st.write("📉 **資金撤退 (變動率 -%)**")
+                        st.dataframe(flow_out, hide_index=True)
+                        st.write("📊 **主流板塊 (成交金額最大)**")
+                        st.dataframe(main_s, hide_index=True)
+                        flow_trend = get_sector_share_history(flow_in['分類指數名稱'].tolist() + flow_out['分類指數名稱'].tolist())
+                        if flow_trend is not None and len(flow_trend) > 1:
+                            st.write("📈 **成交佔比走勢 (%)**")
+                            st.line_chart(flow_trend)
+                    else: st.error(f"無法取得資料: {d_date}")
+            st.markdown("---")
+            st.subheader("🏆 法人掃貨榜 (智慧標籤)")
+            if long_operation(st.button("查看法人買超")):
+                rank_df, date_str = get_institutional_ranking_smart()
+                if rank_df is not None:
+                    st.success(f"資料日期: {date_str}")
+                    st.dataframe(rank_df, hide_index=True)
+                else: st.error(f"無法取得資料: {date_str}")
+
+        with tab6:
+            st.header("🚀 潛力飆股雷達")
+            radar_window = st.radio("強勢板塊依據", (1,) + SECTOR_FLOW_WINDOWS, index=1, format_func=lambda n: "昨日變化" if n == 1 else f"{n}日資金動能", horizontal=True)
+            if long_operation(st.button("啟動雷達偵測")):
+                with st.spinner("交叉比對中..."):
+                    _, flow_in, _, _ = get_twse_sector_flow_dynamic(radar_window)
+                    rank_df, _ = get_institutional_ranking_smart()
+                    news_list, _ = get_all_market_news()
+                    if flow_in is not None and rank_df is not None:
+                        st.success("✅ 分析完成")
+                        hot_sectors = flow_in['分類指數名稱'].tolist()
+                        st.write(f"🔥 強勢板塊：{', '.join(hot_sectors)}")
+                        radar_trend = get_sector_share_history(hot_sectors)
+                        if radar_trend is not None and len(radar_trend) > 1: st.line_chart(radar_trend)
+                        matches = []
+                        for index, row in rank_df.iterrows():
+                            stock_name = row['名稱']
+                            stock_status = row['狀態']
+                            related_news = []
+                            for n in news_list:
+                                if stock_name in n['標題']: related_news.append(n['標題'])
+                            if "爆買" in stock_status or ("連買" in stock_status and len(related_news) > 0):
+                                matches.append({
+                                    "代號": row['代號'], "名稱": stock_name,
+                                    "狀態": stock_status,
+                                    "新聞佐證": related_news[0] if related_news else "無",
+                                    "強度": "⭐⭐⭐" if "爆買" in stock_status else "⭐⭐"
+                                })
+                        if matches: st.dataframe(pd.DataFrame(matches))
+                        else: st.warning("無明顯共振訊號")
+                    else: st.error("數據不足")
+
+        with tab7:
+            st.header("🌡️ 全台股市資金熱力圖 (Max版)")
+            st.info("方塊大小 = 成交金額 | 顏色 = 漲跌幅 | 資料來自本地收盤行情資料庫，切換日期不需連網")
+            c_h1, c_h2 = st.columns([3, 1])
+            heat_days = c_h1.slider("回看交易日", min_value=5, max_value=60, value=20)
+            if long_operation(c_h2.button("📥 更新行情資料庫")):
+                heat_bar = st.progress(0.0)
+                n_new = backfill_market_archive(heat_days, progress_cb=lambda done, total: heat_bar.progress(min(1.0, done / total)))
+                heat_bar.progress(1.0)
+                st.success(f"新增 {n_new} 個交易日")
+            market_archive = get_market_archive()
+            if market_archive is None: st.warning("⚠️ 尚無行情資料，請先按「更新行情資料庫」")
+            else:
+                heat_dates = market_archive['dates'][-heat_days:]
+                heat_date = st.select_slider("資料日期", options=heat_dates, value=heat_dates[-1]) if len(heat_dates) > 1 else heat_dates[-1]
+                heat_view = st.radio("顯示", [f"個股 (前{HEATMAP_TOP_N}大成交)", "族群彙總"], horizontal=True)
+                # 圖表較重，開啟後才建立 (其他分頁操作時不必每次重畫)
+                if st.toggle("🌡️ 顯示熱力圖", key='heat_show'):
+                    if heat_view == "族群彙總":
+                        df_heat = market_archive['sectors_by_date'][heat_date]
+                        fig = px.treemap(df_heat, path=['產業'], values='成交金額', color='加權漲跌幅%', hover_data=['家數', '上漲家數', '下跌家數', '資金變動%'],
+                                         color_continuous_scale=['#00da3c', '#ffffff', '#ff0000'], color_continuous_midpoint=0, range_color=[-5, 5],
+                                         title=f"台股族群資金熱力圖 - {heat_date}")
+                    else:
+                        df_heat = build_heatmap_frame(market_archive['by_date'][heat_date])
+                        fig = px.treemap(
+                            df_heat,
+                            path=['產業', '標籤'],
+                            values='成交金額',
+                            color='漲跌幅%',
+                            color_continuous_scale=['#00da3c', '#ffffff', '#ff0000'],
+                            color_continuous_midpoint=0,
+                            range_color=[-10, 10],
+                            title=f"台股資金熱力圖 (細分族群版) - {heat_date}"
+                        )
+                    fig.update_layout(width=1200, height=900, margin=dict(t=50, l=10, r=10, b=10))
+                    fig.update_traces(textinfo="label+value", textfont_size=20)
+                    st.plotly_chart(fig, use_container_width=True)
+
+                # 多日回放：族群資金佔比動畫 + 族群 × 日期 漲跌幅
+                if len(heat_dates) > 1 and st.toggle("⏯️ 族群資金時光回放", key='heat_replay'):
+                    df_flow = market_archive['sectors'][market_archive['sectors']['日期'].isin(heat_dates)]
+                    top_sectors = df_flow.groupby('產業')['成交金額'].sum().nlargest(20).index
+                    df_flow = df_flow[df_flow['產業'].isin(top_sectors)]
+                    fig_flow = px.bar(df_flow, x='資金佔比%', y='產業', orientation='h', animation_frame='日期', color='加權漲跌幅%',
+                                      color_continuous_scale=['#00da3c', '#ffffff', '#ff0000'], range_color=[-5, 5],
+                                      range_x=[0, float(df_flow['資金佔比%'].max()) * 1.1], category_orders={'產業': list(top_sectors)}, height=700)
+                    st.plotly_chart(fig_flow, use_container_width=True)
+                    fig_grid = px.imshow(df_flow.pivot(index='產業', columns='日期', values='資金變動%').reindex(top_sectors),
+                                         color_continuous_scale=['#00da3c', '#ffffff', '#ff0000'], color_continuous_midpoint=0, aspect='auto',
+                                         title="族群資金佔比日變化 (%)")
+                    st.plotly_chart(fig_grid, use_container_width=True)
+
+        with tab8:
+            st.header("🧪 策略實驗室 (模擬持有至今)")
+            st.info("系統將讀取歷史紀錄，模擬「若當初買進持有到今天」的績效。")
+            c_l1, c_l2 = st.columns([2, 1])
+            lab_strategies = c_l1.multiselect("模擬策略", VALID_STRATEGIES, default=VALID_STRATEGIES)
+            lab_since = c_l2.date_input("進場日起", value=get_taiwan_time().date() - timedelta(days=365))
         
-        if st.button("開始模擬演練"):
-            df_hist = load_history()
+            if long_operation(st.button("開始模擬演練")):
+                df_hist = load_history(strategies=lab_strategies, since=lab_since.strftime('%Y-%m-%d')) if lab_strategies else None
             
-            if df_hist is None or df_hist.empty:
-                st.warning("⚠️ 無歷史紀錄，請先掃描。")
-            else:
-                results = []
-                all_data = df_hist.drop_duplicates(subset=['代號', '篩選日期', '策略'])
-                total_len = len(all_data)
-                bar = st.progress(0.0)
-                
-                for i, row in all_data.iterrows():
-                    bar.progress(min(1.0, (i + 1) / total_len))
-                    ticker = f"{row['代號']}.TW"
-                    entry_date = row['篩選日期']
-                    entry_price = row.get('進場價', row.get('收盤')) 
-                    
-                    if pd.isna(entry_price): continue
-                    
-                    try:
-                        df_sim = yf.Ticker(ticker).history(period="1y")
-                        if df_sim.empty: continue
-                        df_sim.index = df_sim.index.tz_localize(None)
-                        entry_dt = pd.to_datetime(entry_date)
-                        df_hold = df_sim[df_sim.index >= entry_dt]
-                        
-                        if len(df_hold) < 1: continue 
-                        curr_price = df_hold.iloc[-1]['Close']
-                        final_pl = ((curr_price - entry_price) / entry_price) * 100
-                        
-                        results.append({
-                            "策略": row['策略'],
-                            "代號": row['代號'], "名稱": row['名稱'],
-                            "進場日期": entry_date, "進場價": round(entry_price, 2),
-                            "現價": round(curr_price, 2), "報酬率(%)": round(final_pl, 2)
-                        })
-                    except: continue
-                
-                bar.progress(1.0)
+                if df_hist is None or df_hist.empty:
+                    st.warning("⚠️ 無歷史紀錄，請先掃描。")
+                else:
+                    bar = st.progress(0.0)
+                    df_res, df_path = simulate_history_positions(
+                        df_hist, max_workers=fetch_workers, progress_cb=lambda done, total: bar.progress(min(1.0, done / total)))
+                    bar.progress(1.0)
                 
-                if results:
-                    st.success(f"演練完成！共 {len(results)} 筆。")
-                    df_res = pd.DataFrame(results)
-                    available_strats = df_res['策略'].unique()
-                    strat_tabs = st.tabs([f"⚔️ {s}" for s in available_strats])
+                    if df_res is not None and not df_res.empty:
+                        st.success(f"演練完成！共 {len(df_res)} 筆。")
+                        available_strats = df_res['策略'].unique()
+                        strat_tabs = st.tabs([f"⚔️ {s}" for s in available_strats])
                     
-                    for idx, strat in enumerate(available_strats):
-                        with strat_tabs[idx]:
-                            df_s = df_res[df_res['策略'] == strat]
-                            avg_ret = df_s['報酬率(%)'].mean()
-                            win_rate = (df_s['報酬率(%)'] > 0).sum() / len(df_s) * 100
-                            max_win = df_s['報酬率(%)'].max()
+                        for idx, strat in enumerate(available_strats):
+                            with strat_tabs[idx]:
+                                df_s = df_res[df_res['策略'] == strat]
+                                avg_ret = df_s['報酬率(%)'].mean()
+                                win_rate = (df_s['報酬率(%)'] > 0).sum() / len(df_s) * 100
+                                max_win = df_s['報酬率(%)'].max()
                             
-                            c1, c2, c3, c4 = st.columns(4)
-                            c1.metric("交易次數", len(df_s))
-                            c2.metric("平均報酬", f"{avg_ret:.2f}%")
-                            c3.metric("勝率", f"{win_rate:.1f}%")
-                            c4.metric("最高獲利", f"{max_win:.2f}%")
-                            st.markdown("---")
+                                c1, c2, c3, c4 = st.columns(4)
+                                c1.metric("交易次數", len(df_s))
+                                c2.metric("平均報酬", f"{avg_ret:.2f}%")
+                                c3.metric("勝率", f"{win_rate:.1f}%")
+                                c4.metric("最高獲利", f"{max_win:.2f}%")
+
+                                equity, max_dd, holding = summarize_strategy_path(df_path[df_path['策略'] == strat])
+                                c5, c6 = st.columns([1, 3])
+                                c5.metric("最大回撤", f"{max_dd:.2f}%")
+                                c5.dataframe(pd.DataFrame({"平均報酬(%)": holding}).round(2))
+                                c6.line_chart(equity, height=220)
+                                st.markdown("---")
                             
-                            unique_dates = sorted(df_s['進場日期'].unique(), reverse=True)
-                            for d in unique_dates:
-                                df_day = df_s[df_s['進場日期'] == d].copy()
-                                day_avg = df_day['報酬率(%)'].mean()
-                                day_color = "🟢" if day_avg > 0 else "🔴"
-                                with st.expander(f"{day_color} {d} (均報酬 {day_avg:.1f}%)"):
-                                    st.dataframe(
-                                        df_day[['代號', '名稱', '進場價', '現價', '報酬率(%)']],
-                                        hide_index=True, use_container_width=True,
-                                        column_config={
-                                            "報酬率(%)": st.column_config.ProgressColumn(
-                                                "損益", format="%.2f%%", min_value=-20, max_value=20
-                                            )
-                                        }
-                                    )
-                else: st.warning("無模擬結果")
-
-except Exception as e:
-    st.error(f"發生錯誤: {e}")
+                                unique_dates = sorted(df_s['進場日期'].unique(), reverse=True)
+                                for d in unique_dates:
+                                    df_day = df_s[df_s['進場日期'] == d].copy()
+                                    day_avg = df_day['報酬率(%)'].mean()
+                                    day_color = "🟢" if day_avg > 0 else "🔴"
+                                    with st.expander(f"{day_color} {d} (均報酬 {day_avg:.1f}%)"):
+                                        st.dataframe(
+                                            df_day[['代號', '名稱', '進場價', '現價', '報酬率(%)']],
+                                            hide_index=True, use_container_width=True,
+                                            column_config={
+                                                "報酬率(%)": st.column_config.ProgressColumn(
+                                                    "損益", format="%.2f%%", min_value=-20, max_value=20
+                                                )
+                                            }
+                                        )
+                    else: st.warning("無模擬結果")
+
+    except Exception as e:
+        st.error(f"發生錯誤: {e}")
+    report_rerun_budget(rerun_budget_slot, rerun_started)
+    render_profiler_panel(profiler_slot)
+
+def render_intraday_view(settings, strategies):
+    session_key = (str(get_taiwan_time().date()), tuple(strategies), settings['vol_min'], settings.get('min_revenue_yoy'), settings.get('min_revenue_streak'), settings.get('exclude_margin_surge'))
+    session = st.session_state.get('intraday')
+    if session is None or session.get('key') != session_key:
+        with st.spinner("建立盤中面板 (讀取本地快取)..."):
+            rev_map, _ = get_revenue_data_snapshot()
+            margin_map = get_margin_data_snapshot() if settings.get('exclude_margin_surge') else {}
+            universe = prefilter_scan_universe(get_tw_stock_list(), settings, rev_map=rev_map, margin_map=margin_map)
+            session = build_intraday_session(universe)
+        if session is None:
+            st.warning("本地快取沒有可用的日K資料，請先執行一次掃描。"); return
+        session['key'] = session_key
+        st.session_state['intraday'] = session
+    chip_map, chip_date = get_chip_data_snapshot()
+    started = time.perf_counter()
+    df_live = refresh_intraday_session(session, settings, strategies, chip_map)
+    elapsed = time.perf_counter() - started
+    st.caption(f"🕒 報價時間 {session['quote_time'] or '-'} | 已報價 {int(session['quoted'].sum())}/{len(session['codes'])} 檔 | "
+               f"更新耗時 {elapsed:.1f} 秒 | 籌碼為 {chip_date} 資料、成交量為盤中累計")
+    if df_live.empty: st.info("目前沒有符合條件的股票")
+    else: st.dataframe(df_live.sort_values(by="RSI", ascending=False), hide_index=True, column_config=LIVE_COLUMN_CONFIG)
+
+def render_profiler_panel(slot):
+    with slot.container():
+        with st.expander("⏱️ 效能診斷"):
+            summary = profiler_summary()
+            if summary['stages']:
+                st.caption(f"統計起點：{summary['since']}")
+                df_stage = pd.DataFrame(summary['stages']).T.drop(columns='histogram')
+                st.dataframe(df_stage[['count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'total_ms']], use_container_width=True)
+                counters = summary['counters']
+                if summary['cache_hit_rate'] is not None:
+                    st.caption(f"價格快取命中率 {summary['cache_hit_rate']:.1%} (命中 {counters.get('fetch.cache_hit', 0)} / 補資料 {counters.get('fetch.cache_stale', 0)} / 未快取 {counters.get('fetch.cache_miss', 0)} / 失敗 {counters.get('fetch.error', 0)})")
+                if summary['slowest_tickers']:
+                    st.caption("最慢的股票 (毫秒)")
+                    st.dataframe(pd.DataFrame(summary['slowest_tickers']).head(10), hide_index=True, use_container_width=True)
+                st.download_button("💾 匯出 JSON", json.dumps(summary, ensure_ascii=False, indent=2),
+                                   file_name=f"profile_{get_taiwan_time().strftime('%Y%m%d_%H%M')}.json", mime="application/json")
+            else: st.caption("尚無數據 (執行掃描後顯示)")
+            if st.button("🔄 重設統計"): reset_profiler()
+
+# 按鈕觸發的作業 (掃描、回測、回補…) 標記起來，該次重跑不計入預算
+def long_operation(clicked):
+    if clicked: st.session_state['rerun_long_operation'] = True
+    return clicked
+
+# 重跑耗時 (不含按鈕觸發的長時間作業)：近幾次平均與預算比較
+def report_rerun_budget(slot, started):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if st.session_state.pop('rerun_long_operation', False):
+        slot.caption(f"⏳ 本次重跑含按鈕作業 ({elapsed_ms:.0f} ms)，不計入預算")
+        return
+    history = st.session_state.setdefault('rerun_ms', [])
+    history.append(elapsed_ms)
+    del history[:-RERUN_HISTORY]
+    avg_ms = sum(history) / len(history)
+    icon = "🟢" if elapsed_ms <= RERUN_BUDGET_MS else "🟠"
+    slot.caption(f"{icon} 本次重跑 {elapsed_ms:.0f} ms / 預算 {RERUN_BUDGET_MS} ms (近 {len(history)} 次平均 {avg_ms:.0f} ms)")
+
+if __name__ == "__main__":
+    # streamlit run app.py → 網頁；python app.py scan|schedule → 命令列
+    if _running_in_streamlit(): main()
+    else: sys.exit(run_cli(sys.argv[1:]))
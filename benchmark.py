@@ -0,0 +1,271 @@
+# ==========================================
+# 黑武士 效能基準
+# 合成 K 線 + 本地 TWSE / MOPS / yfinance 替身，不連外網、結果可重現
+# 用法：python benchmark.py --sizes 50 200 800 --out bench.json [--baseline old.json]
+# ==========================================
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import warnings
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_SEED = 20240101
+BENCH_SECTORS = ["水泥類指數", "食品類指數", "塑膠類指數", "紡織纖維類指數", "電機機械類指數", "電器電纜類指數",
+                 "化學類指數", "生技醫療類指數", "玻璃陶瓷類指數", "造紙類指數", "鋼鐵類指數", "橡膠類指數",
+                 "汽車類指數", "半導體類指數", "電腦及週邊設備類指數", "光電類指數", "通信網路類指數",
+                 "電子零組件類指數", "電子通路類指數", "資訊服務類指數", "其他電子類指數", "建材營造類指數",
+                 "航運類指數", "觀光餐旅類指數", "金融保險類指數", "貿易百貨類指數", "油電燃氣類指數", "其他類指數"]
+
+def bench_codes(n):
+    return [str(1101 + i) for i in range(n)]
+
+# --- 合成 K 線 (每檔固定種子，帶趨勢、波動叢聚與量能放大日) ---
+def synthetic_ohlcv(code, end_date, years=3):
+    rng = np.random.default_rng(BENCH_SEED + int(code))
+    index = pd.bdate_range(end=end_date, periods=int(years * 252), name='Date')
+    n = len(index)
+    drift = rng.normal(0.0004, 0.0006)
+    vol = 0.012 + 0.02 * np.abs(np.sin(np.arange(n) / rng.uniform(40, 120)))
+    close = rng.uniform(15, 600) * np.exp(np.cumsum(drift + vol * rng.standard_normal(n)))
+    open_ = close * (1 + rng.normal(0, 0.008, n))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.006, n)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.006, n)))
+    base_vol = rng.uniform(3e5, 3e7)
+    volume = base_vol * np.exp(rng.normal(0, 0.35, n)) * np.where(rng.random(n) < 0.05, 3.0, 1.0)
+    return pd.DataFrame({'Open': open_, 'High': high, 'Low': low, 'Close': close, 'Volume': volume.round()}, index=index)
+
+# --- yfinance 替身：Ticker(...).history(period= / start=) 回傳合成資料 ---
+class SyntheticYahoo:
+    def __init__(self, end_date, years):
+        self.end_date, self.years = end_date, years
+
+    def Ticker(self, ticker):
+        return _SyntheticTicker(self, ticker.split('.')[0])
+
+class _SyntheticTicker:
+    def __init__(self, source, code):
+        self.source, self.code = source, code
+        self.info = {'trailingEps': 3.2, 'trailingPE': 15.0, 'returnOnEquity': 0.12}
+
+    def history(self, period=None, start=None):
+        df = synthetic_ohlcv(self.code, self.source.end_date, self.source.years)
+        if start is not None: df = df[df.index >= pd.Timestamp(start)]
+        elif period and period.endswith('y'): df = df[df.index >= df.index[-1] - pd.DateOffset(years=int(period[:-1]))]
+        elif period and period.endswith('d'): df = df.tail(int(period[:-1]))
+        return df
+
+# --- TWSE / MOPS 替身伺服器 (罐頭回應，內容依合成股票池產生) ---
+def _fmt(x): return f"{int(x):,}"
+
+def build_payloads(codes, date_str):
+    rng = np.random.default_rng(BENCH_SEED)
+    n = len(codes)
+    names = [f"合成{c}" for c in codes]
+    net = rng.normal(0, 2e6, n)
+    t86 = {'stat': 'OK', 'date': date_str,
+           'fields': ['證券代號', '證券名稱', '外陸資買賣超股數(不含外資自營商)', '投信買賣超股數', '自營商買賣超股數', '三大法人買賣超股數'],
+           'data': [[c, nm, _fmt(v * 0.6), _fmt(v * 0.3), _fmt(v * 0.1), _fmt(v)] for c, nm, v in zip(codes, names, net)]}
+    prev_bal = rng.uniform(1e3, 5e4, n)
+    cur_bal = prev_bal + rng.normal(0, 300, n)
+    margin = {'stat': 'OK', 'date': date_str, 'tables': [
+        {'title': '信用交易統計', 'fields': ['項目', '買進', '賣出'], 'data': [['融資(交易單位)', '1', '1']]},
+        {'title': '融資融券彙總', 'fields': ['股票代號', '股票名稱', '融資買進', '融資賣出', '融資現金償還', '融資前日餘額', '融資今日餘額'],
+         'data': [[c, nm, '0', '0', '0', _fmt(p * 1000), _fmt(q * 1000)] for c, nm, p, q in zip(codes, names, prev_bal, cur_bal)]}]}
+    close = rng.uniform(15, 600, n)
+    change = rng.normal(0, 0.02, n) * close
+    signs = np.where(change > 0, '<p style= color:red>+</p>', np.where(change < 0, '<p style= color:green>-</p>', '<p> </p>'))
+    mi_index = {'stat': 'OK', 'date': date_str, 'tables': [
+        {'title': '價格指數', 'fields': ['指數', '收盤指數'], 'data': [['發行量加權股價指數', '20,000.00']]},
+        {'title': '每日收盤行情', 'fields': ['證券代號', '證券名稱', '成交股數', '成交筆數', '成交金額', '開盤價', '最高價', '最低價', '收盤價', '漲跌(+/-)', '漲跌價差', '本益比'],
+         'data': [[c, nm, _fmt(v), '1,000', _fmt(v * p), f"{p:.2f}", f"{p * 1.01:.2f}", f"{p * 0.99:.2f}", f"{p:.2f}", s, f"{abs(d):.2f}", '15.00']
+                  for c, nm, v, p, s, d in zip(codes, names, rng.uniform(1e5, 5e7, n), close, signs, change)]}]}
+    amounts = rng.uniform(1e9, 8e10, len(BENCH_SECTORS))
+    bfiamu = {'stat': 'OK', 'date': date_str, 'fields': ['分類指數名稱', '成交股數', '成交金額', '成交筆數', '漲跌指數'],
+              'data': [[s, _fmt(a / 50), _fmt(a), '10,000', f"{rng.normal(0, 1):.2f}"] for s, a in zip(BENCH_SECTORS, amounts)]}
+    rows = "".join(f"<tr><td>{c}</td><td>{nm}</td><td>{_fmt(r)}</td><td>{_fmt(r * 0.95)}</td><td>{_fmt(r * 0.9)}</td>"
+                   f"<td>{m:.2f}</td><td>{y:.2f}</td></tr>"
+                   for c, nm, r, m, y in zip(codes, names, rng.uniform(1e5, 1e8, n), rng.normal(2, 10, n), rng.normal(5, 20, n)))
+    mops = ("<html><body><table><tr><th>公司代號</th><th>公司名稱</th><th>當月營收</th><th>上月營收</th><th>去年當月營收</th>"
+            f"<th>上月比較增減(%)</th><th>去年同月增減(%)</th></tr>{rows}<tr><td>合計</td><td></td><td>0</td><td>0</td><td>0</td><td>0</td><td>0</td></tr></table></body></html>")
+    return {'T86': t86, 'MI_MARGN': margin, 'MI_INDEX': mi_index, 'BFIAMU': bfiamu, 'mops': mops}
+
+def start_stand_in_server(payloads):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            endpoint = url.path.rstrip('/').split('/')[-1]
+            date_str = parse_qs(url.query).get('date', [None])[0]
+            if url.path.startswith('/nas/t21/'):
+                body, ctype = payloads['mops'].encode('utf-8'), 'text/html; charset=utf-8'
+            elif endpoint in payloads:
+                data = payloads[endpoint]
+                # 週末沒有資料 (與 TWSE 相同的回應方式)
+                if date_str and datetime.strptime(date_str, '%Y%m%d').weekday() >= 5: data = {'stat': '很抱歉，沒有符合條件的資料!'}
+                elif date_str: data = {**data, 'date': date_str}
+                body, ctype = json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json'
+            else:
+                self.send_response(404); self.end_headers(); return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# 先設好環境變數與工作目錄，再匯入 app (所有路徑皆相對於工作目錄)
+def import_app(base_url, workdir):
+    os.environ['BW_TWSE_BASE_URL'] = base_url
+    os.environ['BW_MOPS_BASE_URL'] = base_url
+    os.environ['BW_TWSE_MIN_INTERVAL'] = '0'
+    os.chdir(workdir)
+    warnings.filterwarnings('ignore')
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    sys.path.insert(0, APP_DIR)
+    import app
+    return app
+
+def timed(records, size, stage, func, units=None):
+    t0 = time.perf_counter()
+    out = func()
+    seconds = time.perf_counter() - t0
+    row = {'size': size, 'stage': stage, 'seconds': round(seconds, 4)}
+    if units: row['per_unit_ms'] = round(seconds / units * 1000, 3); row['units_per_s'] = round(units / seconds, 1) if seconds > 0 else None
+    records.append(row)
+    print(f"  {stage:<28} {seconds:8.3f}s" + (f"  ({row['per_unit_ms']:.2f} ms/檔)" if units else ""))
+    return out
+
+def reset_http_caches(app):
+    app.get_http_client()['memory'].clear()
+    shutil.rmtree(app.HTTP_CACHE_DIR, ignore_errors=True)
+    # 本地資料庫 (行情 / 類股 / 月營收) 也清掉，端點計時才是冷啟動
+    for d in (app.MARKET_ARCHIVE_DIR, app.REVENUE_ARCHIVE_DIR): shutil.rmtree(d, ignore_errors=True)
+    for f in (app.get_chip_data_snapshot, app.get_margin_data_snapshot, app.get_revenue_data_snapshot,
+              app.get_market_snapshot, app.get_twse_sector_flow_dynamic, app.get_institutional_ranking_smart):
+        f.clear()
+
+def bench_size(app, size, end_date, records):
+    tickers = [f"{c}.TW" for c in bench_codes(size)]
+    settings = {'strategy': app.VALID_STRATEGIES[0], 'vol_surge': False, 'check_rsi_rising': False, 'check_trend_high': False,
+                'check_red_candle': False, 'chip_threshold': 10.0, 'vol_min': 100, 'bias_range': 5.0, 'chip_flow_surge': False}
+    shutil.rmtree(app.PRICE_STORE_DIR, ignore_errors=True)
+    if os.path.exists(app.HISTORY_DB): os.remove(app.HISTORY_DB)
+    print(f"\n▶ 股票池 {size} 檔")
+
+    timed(records, size, 'fetch_raw_data (冷)', lambda: [app.fetch_raw_data(t) for t in tickers], size)
+    frames = timed(records, size, 'fetch_raw_data (快取)', lambda: {t: app.fetch_raw_data(t) for t in tickers}, size)
+    frames = {t: df for t, df in frames.items() if df is not None}
+    timed(records, size, 'fetch_raw_data_bulk (快取)', lambda: list(app.fetch_raw_data_bulk(tickers)), size)
+    timed(records, size, 'add_technical_indicators', lambda: [app.add_technical_indicators(df.copy(), full_recompute=True) for df in frames.values()], size)
+    enriched = timed(records, size, 'indicators_from_state', lambda: {t: app.add_technical_indicators(df.copy()) for t, df in frames.items()}, size)
+
+    chip_map, _ = app.get_chip_data_snapshot()
+    def strategy_loop():
+        return [app.check_stock_strategy_web(df, {**settings, 'strategy': s}, t, chip_map)
+                for t, df in enriched.items() for s in app.VALID_STRATEGIES]
+    timed(records, size, 'check_stock_strategy_web', strategy_loop, size)
+    def panel_screen():
+        panel = app.build_price_panel(frames)
+        app.compute_panel_indicators(panel)
+        return app.screen_panel_strategies(panel, settings, app.VALID_STRATEGIES, chip_map)
+    hits = timed(records, size, 'panel screen (全策略)', panel_screen, size)
+    session = timed(records, size, '盤中面板建立', lambda: app.build_intraday_session(tickers), size)
+    session['quote_source'] = app.get_quote_source(session, 'replay')
+    timed(records, size, '盤中更新 (替身報價)', lambda: app.refresh_intraday_session(session, settings, app.VALID_STRATEGIES, chip_map), size)
+
+    def backtest_loop():
+        return [app.run_vector_backtest(df, {**settings, 'strategy': s}, app._backtest_search_start(df, s))
+                for df in enriched.values() for s in app.VALID_STRATEGIES]
+    timed(records, size, 'tab4 回測 (逐檔)', backtest_loop, size)
+    timed(records, size, 'tab4 全市場研究', lambda: app.run_signal_study(tickers, settings, app.VALID_STRATEGIES), size)
+
+    rows = [{"代號": h.ticker.split('.')[0], "名稱": h.ticker, "產業": "其他", "收盤": round(float(h.Close), 2), "乖離(%)": 0.0,
+             "量(張)": int(h.Volume / 1000), "RSI": round(float(h.RSI), 2), "法人買超(張)": 0, "營收年增(%)": 0.0, "營收月增(%)": 0.0,
+             "EPS": "N/A", "本益比": "N/A", "資料日期": h.資料日期, "策略": h.策略, "籌碼狀態": h.籌碼狀態}
+            for h in hits.itertuples(index=False)] or [{"代號": "1101", "名稱": "合成", "收盤": 10.0, "RSI": 50.0, "策略": settings['strategy']}]
+    timed(records, size, 'save_to_history', lambda: app.save_to_history(rows), len(rows))
+
+    # tab8：過去 120 個交易日隨機進場的歷史紀錄
+    rng = np.random.default_rng(BENCH_SEED + size)
+    picks = []
+    for t, df in list(frames.items()):
+        for d in df.index[rng.choice(np.arange(len(df) - 120, len(df)), size=3, replace=False)]:
+            picks.append({'篩選日期': d.strftime('%Y-%m-%d'), '代號': t.split('.')[0], '名稱': t, '策略': str(rng.choice(app.VALID_STRATEGIES)),
+                          '收盤': float(df.at[d, 'Close']), '進場價': float(df.at[d, 'Close'])})
+    df_hist = pd.DataFrame(picks)
+    timed(records, size, 'tab8 持倉模擬', lambda: app.simulate_history_positions(df_hist), len(df_hist))
+
+def bench_endpoints(app, records, size):
+    print("\n▶ TWSE / MOPS 端點 (替身伺服器，冷快取)")
+    for stage, func in [('T86 籌碼快照', app.get_chip_data_snapshot), ('MI_MARGN 融資快照', app.get_margin_data_snapshot),
+                        ('MOPS 營收快照', app.get_revenue_data_snapshot), ('MI_INDEX 收盤行情', app.get_market_snapshot),
+                        ('BFIAMU 資金流向', app.get_twse_sector_flow_dynamic), ('T86 法人排行', app.get_institutional_ranking_smart)]:
+        reset_http_caches(app)
+        timed(records, size, stage, func)
+
+# 與舊結果比較：同規模同階段變慢超過容許比例即視為退步
+def compare_baseline(records, baseline_path, tolerance):
+    with open(baseline_path, encoding='utf-8') as f: baseline = json.load(f)
+    base = {(r['size'], r['stage']): r['seconds'] for r in baseline['records']}
+    regressions = []
+    for r in records:
+        old = base.get((r['size'], r['stage']))
+        if old and old > 0.01 and r['seconds'] > old * (1 + tolerance):
+            regressions.append({**r, 'baseline_seconds': old, 'ratio': round(r['seconds'] / old, 2)})
+    for r in regressions: print(f"⚠️ 退步：{r['size']} 檔 {r['stage']} {r['baseline_seconds']:.3f}s → {r['seconds']:.3f}s (x{r['ratio']})")
+    if not regressions: print("✅ 與基準相比無退步")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="黑武士 效能基準 (合成資料 + 本地替身服務)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 800], help="股票池大小")
+    parser.add_argument('--years', type=float, default=3, help="每檔合成 K 線年數")
+    parser.add_argument('--out', default=os.path.join(tempfile.gettempdir(), 'bw_bench_results.json'), help="結果 JSON (預設寫到系統暫存目錄，不落在專案裡)")
+    parser.add_argument('--baseline', help="舊的結果 JSON，用來抓退步")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="容許變慢比例")
+    parser.add_argument('--workdir', help="工作目錄 (預設為暫存目錄，結束後刪除)")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bw_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    end_date = pd.Timestamp.today().normalize()
+    while end_date.weekday() >= 5: end_date -= timedelta(days=1)
+    server, base_url = start_stand_in_server(build_payloads(bench_codes(max(args.sizes)), end_date.strftime('%Y%m%d')))
+    app = import_app(base_url, workdir)
+    app.yf = SyntheticYahoo(end_date, args.years)
+    app.get_tw_stock_list = lambda: [f"{c}.TW" for c in bench_codes(max(args.sizes))]
+
+    records = []
+    try:
+        bench_endpoints(app, records, max(args.sizes))
+        for size in sorted(args.sizes): bench_size(app, size, end_date, records)
+    finally:
+        server.shutdown()
+        if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+              'pandas': pd.__version__, 'numpy': np.__version__, 'cpu_count': os.cpu_count(),
+              'years': args.years, 'sizes': sorted(args.sizes), 'records': records}
+    regressions = compare_baseline(records, args.baseline, args.tolerance) if args.baseline else []
+    if regressions: result['regressions'] = regressions
+    with open(args.out, 'w', encoding='utf-8') as f: json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n結果已寫入 {args.out}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())